@@ -0,0 +1,297 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: an asyncio client for the commands server, for driving many servers at once
+Date: 17/10/2026
+"""
+import asyncio
+import logging
+import time
+from client import (COMPRESSION, PHOTO_COMMAND, SERVER_PORT, STOP_SERVER_CONNECTION, CommandError, check_response,
+                    hash_digests, job_id, job_killed, job_lines, listing_lines)
+from protocol import (ARG_SEPARATORS, COMPRESS_COMMAND, FIELD_SEPARATOR, FLAG_COMPRESSED, FRAME_TYPES,
+                      NEGOTIATE_COMMAND, PING_COMMAND, PONG_ANSWER, PROTOCOL_V2, TEXT_TYPES, TYPE_PARTIAL, TYPE_TEXT,
+                      V2_HEADER, V2_MAGIC, Compression, Frame, tune_socket)
+
+# define fleet constants
+# servers driven at the same time by run_fleet()
+FLEET_CONCURRENCY = 200
+
+
+class AsyncSession:
+    """
+    The asyncio twin of client.Session, thousands of them can share one event loop.
+
+    Only protocol v2 servers are supported. Screenshots are returned encoded, so decoding
+    them doesn't block the event loop.
+    """
+
+    def __init__(self, host, port=SERVER_PORT, timeout=None, compression=COMPRESSION):
+        """
+        :param host: The address of the server.
+        :type host: str
+
+        :param port: The port of the server.
+        :type port: int
+
+        :param timeout: The time every command may take in seconds, None to wait forever.
+        :type timeout: float or None
+
+        :param compression: The compression to ask for, see protocol.Compression.parse(), None for none.
+        :type compression: str or None
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.compression_settings = compression
+        # the compression in use, see protocol.FramedConnection.compression
+        self.compression = None
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """
+        Connect to the server and switch the connection to protocol v2.
+
+        :raises ConnectionError: If the server doesn't support protocol v2.
+        """
+        if self.writer is not None:
+            return
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                          self.timeout)
+        try:
+            tune_socket(self.writer.get_extra_info("socket"))
+            # the request and the answer are legacy frames, see protocol.negotiate()
+            self.writer.write(f"0${len(NEGOTIATE_COMMAND)}${NEGOTIATE_COMMAND}".encode())
+            await self.writer.drain()
+            answer = await asyncio.wait_for(self.read_legacy_frame(), self.timeout)
+            if answer != NEGOTIATE_COMMAND:
+                raise ConnectionError(f"{self.host}:{self.port} doesn't support protocol v2")
+            logging.info(f"using protocol v{PROTOCOL_V2} with {self.host}:{self.port}")
+            if self.compression_settings is not None:
+                answer = await asyncio.wait_for(
+                    self.exchange([f"{COMPRESS_COMMAND} {self.compression_settings}"], None), self.timeout)
+                if answer.startswith(COMPRESS_COMMAND + ' '):
+                    self.compression = Compression.parse(answer[len(COMPRESS_COMMAND):])
+        except BaseException:
+            self.disconnect()
+            raise
+
+    def disconnect(self):
+        """
+        Drop the connection without saying goodbye, e.g. after it broke.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+            self.compression = None
+
+    async def close(self):
+        """
+        Tell the server the session is over and close the connection.
+        """
+        if self.writer is None:
+            return
+        try:
+            await self.request(STOP_SERVER_CONNECTION)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        self.disconnect()
+
+    async def read_legacy_frame(self):
+        """
+        :return: The data of a legacy frame, only used for the protocol negotiation.
+        :rtype: str
+        """
+        await self.reader.readuntil(FIELD_SEPARATOR)
+        length = int((await self.reader.readuntil(FIELD_SEPARATOR))[:-1])
+        # the answers of the negotiation are ascii, so characters and bytes count the same
+        return (await self.reader.readexactly(length)).decode()
+
+    async def read_frame(self):
+        """
+        :return: The next frame from the server.
+        :rtype: protocol.Frame
+
+        :raises ValueError: If the frame is malformed.
+        """
+        magic, frame_type, num_of_args, request_id, length = V2_HEADER.unpack(
+            await self.reader.readexactly(V2_HEADER.size))
+        compressed = frame_type & FLAG_COMPRESSED
+        frame_type &= ~FLAG_COMPRESSED
+        if magic != V2_MAGIC or frame_type not in FRAME_TYPES:
+            raise ValueError(f"invalid frame header: magic {magic}, type {frame_type}")
+        data = await self.reader.readexactly(length)
+        if compressed:
+            if self.compression is None:
+                raise ValueError("received a compressed frame without negotiating compression")
+            data = self.compression.decompress(data)
+        if frame_type in TEXT_TYPES:
+            data = data.decode()
+        return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, data)
+
+    async def exchange(self, items, on_partial):
+        """
+        Send a request and read its response, see request().
+        """
+        data = ARG_SEPARATORS[PROTOCOL_V2].join(items).encode()
+        num_of_args = len(items) if len(items) > 1 else 0
+        frame_type = TYPE_TEXT
+        if self.compression is not None and len(data) >= self.compression.threshold:
+            data = self.compression.compress(data)
+            frame_type |= FLAG_COMPRESSED
+        self.writer.write(V2_HEADER.pack(V2_MAGIC, frame_type, num_of_args, 0, len(data)) + data)
+        await self.writer.drain()
+        parts = []
+        frame = await self.read_frame()
+        while frame.frame_type == TYPE_PARTIAL:
+            if on_partial is not None:
+                on_partial(frame.data)
+            else:
+                parts.append(frame.data)
+            frame = await self.read_frame()
+        return '\n'.join(parts + [frame.data]) if parts else frame.data
+
+    async def request(self, command, *paths, on_partial=None):
+        """
+        Send a command with its paths in the same frame and wait for the response.
+
+        :param command: The command with its options, e.g. 'DIR recursive'.
+        :type command: str
+
+        :param paths: The paths the command takes.
+        :type paths: str
+
+        :param on_partial: Called with every partial frame of the response, joined to the
+                           response if None.
+        :type on_partial: callable or None
+
+        :return: The response.
+        :rtype: str or bytes
+
+        :raises ConnectionError: If the connection broke, the next request reconnects.
+        :raises asyncio.TimeoutError: If the server didn't answer in time, the connection is dropped.
+        """
+        async with self.lock:
+            await self.connect()
+            try:
+                return await asyncio.wait_for(self.exchange([command, *paths], on_partial), self.timeout)
+            except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+                self.disconnect()
+                raise ConnectionError(f"lost the connection to {self.host}:{self.port}: {err}")
+            except asyncio.TimeoutError:
+                # the response may still arrive, the connection can't be trusted anymore
+                self.disconnect()
+                raise
+
+    async def dir(self, path, options=""):
+        """
+        List a directory on the server, see client.Session.dir().
+        """
+        pages = []
+        res = await self.request(f"DIR {options}".strip(), path, on_partial=pages.append)
+        return listing_lines(res, pages, PROTOCOL_V2)
+
+    async def delete(self, path):
+        check_response(await self.request("DELETE", path), "FILE DELETED", "DELETE")
+
+    async def copy(self, src, dest):
+        check_response(await self.request("COPY", src, dest), "FILE COPY", "COPY")
+
+    async def execute(self, path, timeout=None):
+        """
+        Start a program on the server in the background, see client.Session.execute().
+        """
+        return job_id(await self.request(f"EXECUTE timeout={timeout}" if timeout else "EXECUTE", path))
+
+    async def job_status(self, job=None):
+        return job_lines(await self.request(f"JOB STATUS {job}" if job is not None else "JOB STATUS"))
+
+    async def job_kill(self, job):
+        return job_killed(await self.request(f"JOB KILL {job}"))
+
+    async def hash(self, paths, options=""):
+        """
+        Hash files on the server, see client.Session.hash().
+        """
+        pages = []
+        res = await self.request(f"HASH {options}".strip(), *paths, on_partial=pages.append)
+        return hash_digests(res, pages)
+
+    async def stats(self, prometheus=False):
+        return await self.request("STATS prometheus" if prometheus else "STATS")
+
+    async def ping(self):
+        """
+        :return: The round trip time to the server in seconds.
+        :rtype: float
+        """
+        started = time.perf_counter()
+        check_response(await self.request(PING_COMMAND), PONG_ANSWER, PING_COMMAND)
+        return time.perf_counter() - started
+
+    async def screenshot(self, options=""):
+        """
+        Take a screenshot of the server screen.
+
+        :param options: The screenshot options, delta screenshots aren't supported here.
+        :type options: str
+
+        :return: The encoded image, e.g. open it with PIL.Image.open(BytesIO(data)).
+        :rtype: bytes
+        """
+        res = await self.request(f"{PHOTO_COMMAND} {options}".strip())
+        if isinstance(res, str):
+            raise CommandError(f"{PHOTO_COMMAND} failed: {res}")
+        return res
+
+
+async def run_fleet(hosts, operation, port=SERVER_PORT, timeout=None, concurrency=FLEET_CONCURRENCY):
+    """
+    Run an operation on many servers at once.
+
+    Example::
+
+        async def clean(server):
+            return [await server.delete(path) for path in await server.dir("/tmp", "glob=*.tmp")]
+
+        results = asyncio.run(run_fleet(hosts, clean, timeout=10))
+
+    :param hosts: The addresses of the servers.
+    :type hosts: iterable of str
+
+    :param operation: A coroutine function that gets an AsyncSession connected to a server.
+    :type operation: callable
+
+    :param port: The port of the servers.
+    :type port: int
+
+    :param timeout: The time every command may take in seconds, None to wait forever.
+    :type timeout: float or None
+
+    :param concurrency: The maximum number of servers connected at the same time.
+    :type concurrency: int
+
+    :return: What the operation returned for every server, or the error it failed with.
+    :rtype: dict[str, object]
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(host):
+        async with semaphore:
+            try:
+                async with AsyncSession(host, port, timeout) as session:
+                    return host, await operation(session)
+            except (OSError, ValueError, CommandError, asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+                logging.warning(f"operation failed on {host}: {err!r}")
+                return host, err
+
+    return dict(await asyncio.gather(*(run(host) for host in hosts)))
@@ -0,0 +1,222 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: asynchronous logging for the commands server, records are written on a thread of their own
+Date: 17/10/2026
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+
+# define logging constants
+DEFAULT_QUEUE_SIZE = 10000
+# characters of a payload that make it into a log message
+PAYLOAD_PREVIEW = 100
+# log messages are cut after this many characters, whatever they hold
+MAX_MESSAGE = 1000
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+# pass as extra= to records logged for every frame, so they can be sampled
+SAMPLED = {"sampled": True}
+
+
+def parse_level(text):
+    """
+    :param text: The name of a level, e.g. 'debug'.
+    :type text: str
+
+    :return: The logging level.
+    :rtype: int
+
+    :raises ValueError: If there is no such level.
+    """
+    name = text.strip().upper()
+    if name not in LEVELS:
+        raise ValueError(f"level must be one of {', '.join(LEVELS).lower()}")
+    return getattr(logging, name)
+
+
+class Payload:
+    """
+    A payload in a log message, formatted only if the message is logged, and then only its beginning.
+
+    Example::
+
+        logging.debug("sending %s", Payload(data))
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        """
+        :param data: The payload.
+        :type data: str or list[str] or bytes
+        """
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return f"<{len(data)} bytes>"
+        if isinstance(data, list) and not data:
+            return "no arguments"
+        if isinstance(data, list):
+            # only join the arguments that can show up in the preview
+            return f"{len(data)} arguments: {Payload('|'.join(map(str, data[:PAYLOAD_PREVIEW])))}"
+        text = str(data)
+        if len(text) <= PAYLOAD_PREVIEW:
+            return text
+        return f"{text[:PAYLOAD_PREVIEW]}... ({len(text)} characters)"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let through one in every few of the records marked with SAMPLED, counted per message.
+    """
+
+    def __init__(self, every=1):
+        """
+        :param every: Log one in this many sampled records, 1 logs all of them.
+        :type every: int
+        """
+        super().__init__()
+        self.every = every
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every <= 1 or not getattr(record, "sampled", False):
+            return True
+        with self.lock:
+            seen = self.seen.get(record.msg, 0)
+            self.seen[record.msg] = seen + 1
+        return seen % self.every == 0
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records over to a bounded queue, dropping them instead of blocking when it is full.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, record_queue=None):
+        """
+        :param queue_size: The number of records waiting to be written before new ones are dropped.
+        :type queue_size: int
+
+        :param record_queue: The queue to hand the records to, None for a new queue of `queue_size`.
+                             A multiprocessing queue lets other processes hand over their records too.
+        :type record_queue: queue.Queue or multiprocessing.Queue or None
+        """
+        super().__init__(queue.Queue(queue_size) if record_queue is None else record_queue)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        if len(record.msg) > MAX_MESSAGE:
+            record.msg = record.message = f"{record.msg[:MAX_MESSAGE]}... ({len(record.msg)} characters)"
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+
+class AsyncLogging:
+    """
+    Write the log on a listener thread, so the threads serving clients only format and queue records.
+
+    Payloads are cut short by Payload and MAX_MESSAGE, records logged for every frame can be
+    sampled, and the level can be changed while the server runs.
+    """
+
+    def __init__(self, filename, fmt, level=logging.INFO, queue_size=DEFAULT_QUEUE_SIZE, sample_every=1,
+                 record_queue=None):
+        """
+        :param filename: The log file.
+        :type filename: str
+
+        :param fmt: The format of the records in the file.
+        :type fmt: str
+
+        :param level: The level of the root logger.
+        :type level: int
+
+        :param queue_size: The number of records waiting to be written before new ones are dropped.
+        :type queue_size: int
+
+        :param sample_every: Log one in this many records marked with SAMPLED.
+        :type sample_every: int
+
+        :param record_queue: The queue of the records, see BoundedQueueHandler.
+        :type record_queue: queue.Queue or multiprocessing.Queue or None
+        """
+        file_handler = logging.FileHandler(filename)
+        file_handler.setFormatter(logging.Formatter(fmt))
+        self.handler = BoundedQueueHandler(queue_size, record_queue)
+        self.handler.addFilter(SamplingFilter(sample_every))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, file_handler)
+        self.level = level
+
+    def start(self):
+        """
+        Route the records of the root logger through the queue and start writing them.
+        """
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Write the records still queued and stop the listener thread.
+        """
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def set_level(self, level):
+        """
+        Change the level of the root logger, the records below it cost nothing but the level check.
+
+        :param level: The new level.
+        :type level: int
+        """
+        self.level = level
+        logging.getLogger().setLevel(level)
+
+    @property
+    def dropped(self):
+        """
+        :return: The records dropped because the queue was full.
+        :rtype: int
+        """
+        return self.handler.dropped
+
+
+def log_to_queue(record_queue, level=logging.INFO, sample_every=1):
+    """
+    Hand the records of the root logger to the AsyncLogging of another process, which writes them,
+    the way the prefork workers of the server log through their supervisor.
+
+    :param record_queue: The multiprocessing queue of that AsyncLogging.
+    :type record_queue: multiprocessing.Queue
+
+    :param level: The level of the root logger.
+    :type level: int
+
+    :param sample_every: Log one in this many records marked with SAMPLED.
+    :type sample_every: int
+
+    :return: The handler, its dropped attribute counts the records lost to a full queue.
+    :rtype: BoundedQueueHandler
+    """
+    handler = BoundedQueueHandler(record_queue=record_queue)
+    handler.addFilter(SamplingFilter(sample_every))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,403 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: a load generator and framing benchmarks for the commands server
+Date: 17/10/2026
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import client
+import server
+from protocol import Compression, FramedConnection
+
+# define load constants
+DEFAULT_MIX = "dir=4,copy=2,delete=2,screenshot=1"
+LOAD_COMMANDS = ["dir", "copy", "delete", "screenshot"]
+DEFAULT_CLIENTS = 8
+DEFAULT_DURATION = 5.0
+DEFAULT_FILES = 200
+FILE_SIZE = 4096
+SCREENSHOT_OPTIONS = "max=640 quality=60"
+
+# define framing constants, every case is a payload and the protocol version it is sent with
+FRAMING_CASES = {
+    "v1 text 64B": (1, "x" * 64, None),
+    "v2 text 64B": (2, "x" * 64, None),
+    "v1 text 64KiB": (1, "path/to/some/file.txt\n" * 2979, None),
+    "v2 text 64KiB": (2, "path/to/some/file.txt\n" * 2979, None),
+    "v2 text 64KiB zlib": (2, "path/to/some/file.txt\n" * 2979, "zlib"),
+    "v2 binary 1MiB": (2, bytes(1024 * 1024), None),
+}
+FRAMING_SECONDS = 1.0
+# changes smaller than this are reported as noise when comparing with a baseline
+NOISE_PERCENT = 5
+
+
+class CountingSocket:
+    """
+    A socket wrapper that counts the socket calls and the bytes going through them.
+    """
+
+    def __init__(self, sock):
+        """
+        :param sock: The socket to wrap.
+        :type sock: socket.socket
+        """
+        self.sock = sock
+        self.calls = 0
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def count(self, amount):
+        self.calls += 1
+        self.bytes += amount
+        return amount
+
+    def recv_into(self, buffer, *args):
+        return self.count(self.sock.recv_into(buffer, *args))
+
+    def send(self, data, *args):
+        return self.count(self.sock.send(data, *args))
+
+    def sendall(self, data, *args):
+        self.sock.sendall(data, *args)
+        self.count(len(data))
+
+    def sendmsg(self, buffers, *args):
+        return self.count(self.sock.sendmsg(buffers, *args))
+
+    def sendfile(self, file, offset=0, count=None):
+        # sendfile loops on the os call, count it as a single call
+        return self.count(self.sock.sendfile(file, offset, count))
+
+
+def percentile(values, fraction):
+    """
+    :param values: The values, sorted.
+    :type values: list[float]
+
+    :param fraction: The percentile, between 0 and 1.
+    :type fraction: float
+
+    :return: The value at the percentile, 0 if there are no values.
+    :rtype: float
+    """
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def parse_mix(text):
+    """
+    Parse the weights of the commands in the load.
+
+    :param text: The weights, e.g. 'dir=4,copy=2,delete=2,screenshot=1'.
+    :type text: str
+
+    :return: The commands and their weights.
+    :rtype: tuple[list[str], list[float]]
+
+    :raises ValueError: If a command is unknown or a weight is invalid.
+    """
+    commands, weights = [], []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in LOAD_COMMANDS:
+            raise ValueError(f"unknown command '{name}', choose from {', '.join(LOAD_COMMANDS)}")
+        commands.append(name)
+        weights.append(float(weight or 1))
+    return commands, weights
+
+
+def start_server(workers=server.MAX_WORKERS):
+    """
+    Start the server on a free local port, in this process.
+
+    :param workers: The number of worker threads of the server.
+    :type workers: int
+
+    :return: The running loop, its thread and the port it listens on.
+    :rtype: tuple[server.ConnectionLoop, threading.Thread, int]
+    """
+    server.set_capture_source(server.synthetic_capture)
+    serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serv.bind(('127.0.0.1', 0))
+    serv.listen(server.Q_LEN)
+    loop = server.ConnectionLoop(serv, max_workers=workers)
+    thread = threading.Thread(target=loop.run, name="server", daemon=True)
+    thread.start()
+    return loop, thread, serv.getsockname()[1]
+
+
+def make_fixture(directory, files):
+    """
+    Fill a directory with files for the load to list and copy.
+
+    :return: The paths of the files.
+    :rtype: list[str]
+    """
+    paths = []
+    payload = os.urandom(FILE_SIZE)
+    for index in range(files):
+        path = os.path.join(directory, f"file{index}.bin")
+        with open(path, 'wb') as file:
+            file.write(payload)
+        paths.append(path)
+    return paths
+
+
+def run_client(number, port, directory, files, mix, deadline, compression, results, lock):
+    """
+    Send random commands until the deadline, runs on its own thread.
+
+    :param number: The number of the client, used to name the files it copies.
+    :type number: int
+
+    :param results: Filled with the latency, bytes and socket calls of every command, per command.
+    :type results: dict
+    """
+    commands, weights = mix
+    session = client.Session('127.0.0.1', port, compression=compression)
+    comm = session.connect()
+    counter = CountingSocket(comm.sock)
+    comm.sock = counter
+    copies = []
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    serial = 0
+    while time.monotonic() < deadline:
+        command = random.choices(commands, weights)[0]
+        if command == "delete" and not copies:
+            # there is nothing of ours to delete, make something
+            path = os.path.join(directory, f"spare{number}_{serial}.bin")
+            shutil.copyfile(files[0], path)
+            copies.append(path)
+        calls, sent = counter.calls, counter.bytes
+        started = time.perf_counter()
+        try:
+            if command == "dir":
+                session.dir(directory)
+            elif command == "copy":
+                serial += 1
+                copy = os.path.join(directory, f"copy{number}_{serial}.bin")
+                session.copy(random.choice(files), copy)
+                copies.append(copy)
+            elif command == "delete":
+                session.delete(copies.pop())
+            else:
+                session.request(f"{client.PHOTO_COMMAND} {SCREENSHOT_OPTIONS}")
+        except (client.CommandError, ConnectionError) as err:
+            logging.warning(f"client {number} failed to {command}: {err}")
+            errors[command] += 1
+            if isinstance(err, ConnectionError):
+                break
+            continue
+        samples[command].append((time.perf_counter() - started, counter.bytes - sent, counter.calls - calls))
+    session.close()
+    with lock:
+        for command, values in samples.items():
+            results["samples"][command].extend(values)
+        for command, count in errors.items():
+            results["errors"][command] += count
+
+
+def process_io():
+    """
+    :return: The read and write system calls of this process so far, None where /proc isn't available.
+    :rtype: tuple[int, int] or None
+    """
+    try:
+        with open("/proc/self/io") as file:
+            fields = dict(line.split(': ') for line in file.read().splitlines())
+        return int(fields["syscr"]), int(fields["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_load(clients, duration, mix, files, workers, compression):
+    """
+    Drive a server with concurrent clients sending a mix of commands.
+
+    :return: The results of every command: ops/s, p50 and p99 latency in ms, bytes and client
+             socket calls per command, and errors. 'total' also has the read and write system
+             calls of the whole process, server included, per command.
+    :rtype: dict
+    """
+    loop, thread, port = start_server(workers)
+    directory = tempfile.mkdtemp(prefix="bench")
+    try:
+        paths = make_fixture(directory, files)
+        results = {"samples": defaultdict(list), "errors": defaultdict(int)}
+        lock = threading.Lock()
+        io_before = process_io()
+        started = time.monotonic()
+        deadline = started + duration
+        threads = [threading.Thread(target=run_client, name=f"client{number}",
+                                    args=(number, port, directory, paths, mix, deadline, compression, results, lock))
+                   for number in range(clients)]
+        for client_thread in threads:
+            client_thread.start()
+        for client_thread in threads:
+            client_thread.join()
+        elapsed = time.monotonic() - started
+        io_after = process_io()
+    finally:
+        loop.stop()
+        thread.join()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {}
+    everything = []
+    for command in LOAD_COMMANDS + ["total"]:
+        samples = everything if command == "total" else results["samples"].get(command, [])
+        if command != "total":
+            everything.extend(samples)
+        if not samples:
+            continue
+        latencies = sorted(sample[0] for sample in samples)
+        report[command] = {
+            "ops_per_s": len(samples) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "bytes_per_op": sum(sample[1] for sample in samples) / len(samples),
+            "socket_calls_per_op": sum(sample[2] for sample in samples) / len(samples),
+            "errors": results["errors"].get(command, 0) if command != "total" else sum(results["errors"].values()),
+        }
+    if "total" in report and io_before is not None and io_after is not None:
+        report["total"]["process_syscalls_per_op"] = \
+            (io_after[0] - io_before[0] + io_after[1] - io_before[1]) / len(everything)
+    return report
+
+
+def bench_framing(version, payload, compression, seconds=FRAMING_SECONDS):
+    """
+    Measure how fast frames go through a local socket pair, writer and reader included.
+
+    :param version: The protocol version of the frames.
+    :type version: int
+
+    :param payload: The payload of every frame.
+    :type payload: str or bytes
+
+    :param compression: The compression settings, None for none.
+    :type compression: str or None
+
+    :return: Frames per second, payload megabytes per second and socket calls per frame.
+    :rtype: dict
+    """
+    left, right = socket.socketpair()
+    writer, reader = FramedConnection(CountingSocket(left)), FramedConnection(CountingSocket(right))
+    writer.version = reader.version = version
+    if compression is not None:
+        writer.compression, reader.compression = Compression.parse(compression), Compression.parse(compression)
+    stop = threading.Event()
+    sent = [0]
+
+    def write():
+        while not stop.is_set():
+            writer.write_frame(payload)
+            sent[0] += 1
+        writer.write_frame("END")
+
+    thread = threading.Thread(target=write, daemon=True)
+    started = time.perf_counter()
+    thread.start()
+    threading.Timer(seconds, stop.set).start()
+    received = 0
+    while True:
+        frame = reader.read_frame()
+        if frame is None or frame.data == "END":
+            break
+        received += 1
+    elapsed = time.perf_counter() - started
+    thread.join()
+    calls = writer.sock.calls + reader.sock.calls
+    left.close()
+    right.close()
+    return {"frames_per_s": received / elapsed,
+            "mb_per_s": received * len(payload) / elapsed / 1e6,
+            "socket_calls_per_frame": calls / max(received, 1)}
+
+
+def run_framing(seconds=FRAMING_SECONDS):
+    """
+    :return: The results of every framing case, see bench_framing().
+    :rtype: dict
+    """
+    return {name: bench_framing(version, payload, compression, seconds)
+            for name, (version, payload, compression) in FRAMING_CASES.items()}
+
+
+def print_report(results, baseline=None):
+    """
+    Print the results as tables, with the change from the baseline if there is one.
+
+    :param results: The results of run_load() and run_framing() by section.
+    :type results: dict
+
+    :param baseline: Results saved by an earlier run.
+    :type baseline: dict or None
+    """
+    for section, rows in results.items():
+        print(f"\n{section}")
+        for name, metrics in rows.items():
+            cells = []
+            for metric, value in metrics.items():
+                cell = f"{metric}={value:.1f}" if isinstance(value, float) else f"{metric}={value}"
+                old = (baseline or {}).get(section, {}).get(name, {}).get(metric)
+                if old:
+                    change = (value - old) / old * 100
+                    cell += f" ({change:+.0f}%)" if abs(change) >= NOISE_PERCENT else " (=)"
+                cells.append(cell)
+            print(f"  {name:<20} " + "  ".join(cells))
+
+
+def main():
+    """
+    the main function; responsible for running the benchmarks
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the commands server")
+    parser.add_argument("--clients", type=int, default=DEFAULT_CLIENTS, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds the load runs")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of the commands in the load")
+    parser.add_argument("--files", type=int, default=DEFAULT_FILES, help="number of files in the listed directory")
+    parser.add_argument("--workers", type=int, default=server.MAX_WORKERS, help="server worker threads")
+    parser.add_argument("--compression", default=client.COMPRESSION, help="compression the clients ask for, or none")
+    parser.add_argument("--skip-load", action="store_true", help="only run the framing benchmarks")
+    parser.add_argument("--skip-framing", action="store_true", help="only run the load")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    if not options.skip_load:
+        compression = None if options.compression.lower() == "none" else options.compression
+        results["load"] = run_load(options.clients, options.duration, parse_mix(options.mix), options.files,
+                                   options.workers, compression)
+    if not options.skip_framing:
+        results["framing"] = run_framing()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+    print_report(results, baseline)
+    if options.save:
+        with open(options.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: rsync style block deltas, to send only the parts of a file the other side doesn't have
+Date: 17/10/2026
+"""
+import hashlib
+import math
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# define sync constants
+MIN_BLOCK = 2048
+MAX_BLOCK = 128 * 1024
+STRONG_SIZE = 16
+# bytes of the new file scanned for matching blocks at a time
+SCAN_WINDOW = 1024 * 1024
+# the encoded operations are sent in frames of about this size
+DELTA_FRAME = 1024 * 1024
+# or sooner, so the receiver hears from the sender while a long stretch of matching blocks is scanned
+DELTA_FLUSH_SECONDS = 5
+SIGNATURE_HEADER = struct.Struct('!IIQI')
+OP_COPY = b'C'
+OP_DATA = b'D'
+COPY_OP = struct.Struct('!QI')
+DATA_OP = struct.Struct('!I')
+OP_HEADERS = {OP_COPY: COPY_OP, OP_DATA: DATA_OP}
+WEAK_MASK = 0xFFFF
+
+Signature = namedtuple('Signature', ['index', 'block_size', 'size', 'weaks', 'strongs'])
+
+
+def block_size(size):
+    """
+    Pick the block size of a file, about the square root of its size like rsync does.
+
+    :param size: The size of the file.
+    :type size: int
+
+    :return: The block size, a multiple of 1024.
+    :rtype: int
+    """
+    return min(MAX_BLOCK, max(MIN_BLOCK, -(-math.isqrt(size) // 1024) * 1024))
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+def weak_checksums(data, length):
+    """
+    The rolling checksum of every window of `length` bytes, like rsync's.
+
+    Computed from prefix sums instead of rolling byte by byte, so a whole window of the file
+    costs a few numpy operations.
+
+    :param data: The bytes, at least `length` of them.
+    :type data: numpy.ndarray
+
+    :param length: The window length.
+    :type length: int
+
+    :return: The checksum of the window starting at every offset, len(data) - length + 1 of them.
+    :rtype: numpy.ndarray
+    """
+    values = data.astype(np.int64)
+    sums = np.concatenate(([0], np.cumsum(values)))
+    weighted = np.concatenate(([0], np.cumsum(values * np.arange(len(values), dtype=np.int64))))
+    a = sums[length:] - sums[:-length]
+    # b(k) = sum((length - i) * data[k + i]) = (length + k) * a(k) - sum(j * data[j]) over the window
+    b = (length + np.arange(len(a), dtype=np.int64)) * a - (weighted[length:] - weighted[:-length])
+    return (a & WEAK_MASK) | ((b & WEAK_MASK) << 16)
+
+
+def fold(weaks):
+    """
+    :return: The weak checksums folded to 16 bits, to index a lookup table.
+    :rtype: numpy.ndarray
+    """
+    return (weaks ^ (weaks >> 16)) & WEAK_MASK
+
+
+def block_checksums(data, length):
+    """
+    The rolling checksum of consecutive blocks, matching weak_checksums() at their offsets.
+
+    :param data: The bytes, a multiple of `length` of them.
+    :type data: numpy.ndarray
+
+    :param length: The block length.
+    :type length: int
+
+    :return: The checksum of every block.
+    :rtype: numpy.ndarray
+    """
+    blocks = data.reshape(-1, length).astype(np.int64)
+    a = blocks.sum(axis=1)
+    b = (blocks * np.arange(length, 0, -1, dtype=np.int64)).sum(axis=1)
+    return (a & WEAK_MASK) | ((b & WEAK_MASK) << 16)
+
+
+def file_signature(file, size, index=0):
+    """
+    Compute the checksums of the blocks of a file, what the sender needs to find them in its copy.
+
+    :param file: The file, opened for binary reading, None if there is no such file yet.
+    :type file: io.BufferedReader or None
+
+    :param size: The size of the file.
+    :type size: int
+
+    :param index: The position of the file in the sync, sent along with the signature.
+    :type index: int
+
+    :return: The signature.
+    :rtype: Signature
+    """
+    length = block_size(size)
+    weaks = []
+    strongs = []
+    if file is not None:
+        # read whole blocks at a time, the last block may be shorter
+        chunk = length * max(1, SCAN_WINDOW // length)
+        while True:
+            data = file.read(chunk)
+            if not data:
+                break
+            full = len(data) - len(data) % length
+            if full:
+                weaks.append(block_checksums(np.frombuffer(data, np.uint8, full), length))
+            if len(data) > full:
+                weaks.append(weak_checksums(np.frombuffer(data, np.uint8)[full:], len(data) - full))
+            strongs.extend(strong_checksum(data[offset:offset + length]) for offset in range(0, len(data), length))
+    weaks = np.concatenate(weaks) if weaks else np.zeros(0, np.int64)
+    return Signature(index, length, size, weaks, strongs)
+
+
+def encode_signature(signature):
+    """
+    :return: The signature as the payload of a binary frame.
+    :rtype: bytes
+    """
+    header = SIGNATURE_HEADER.pack(signature.index, signature.block_size, signature.size, len(signature.strongs))
+    return header + signature.weaks.astype('>u4').tobytes() + b''.join(signature.strongs)
+
+
+def decode_signature(data):
+    """
+    :param data: The payload of a signature frame.
+    :type data: bytes
+
+    :return: The signature.
+    :rtype: Signature
+
+    :raises ValueError: If the payload isn't a signature.
+    """
+    if len(data) < SIGNATURE_HEADER.size:
+        raise ValueError("the signature is too short")
+    index, length, size, count = SIGNATURE_HEADER.unpack_from(data)
+    weak_end = SIGNATURE_HEADER.size + count * 4
+    if len(data) != weak_end + count * STRONG_SIZE or length == 0:
+        raise ValueError("the signature is malformed")
+    weaks = np.frombuffer(data, '>u4', count, SIGNATURE_HEADER.size).astype(np.int64)
+    strongs = [bytes(data[offset:offset + STRONG_SIZE]) for offset in range(weak_end, len(data), STRONG_SIZE)]
+    return Signature(index, length, size, weaks, strongs)
+
+
+def delta_ops(file, signature, hasher=None):
+    """
+    Compare a file with the signature of the other copy and describe it as blocks of that copy
+    and literal data.
+
+    Every offset of the file is checked against the weak checksums at once with numpy, and only
+    the offsets whose weak checksum matches a block get a strong checksum.
+
+    :param file: The new file, opened for binary reading.
+    :type file: io.BufferedReader
+
+    :param signature: The signature of the other copy.
+    :type signature: Signature
+
+    :param hasher: A hashlib object updated with the whole new file.
+    :type hasher: hashlib._Hash or None
+
+    :return: (OP_COPY, block index) and (OP_DATA, bytes) operations, in the order of the file.
+    :rtype: generator of tuple
+    """
+    length = signature.block_size
+    # the last block may be shorter, it is only matched at the very end of the file
+    full_blocks = signature.size // length
+    table = {}
+    for index in range(full_blocks):
+        table.setdefault(int(signature.weaks[index]), []).append(index)
+    keys = np.array(sorted(table), dtype=np.int64)
+    present = np.zeros(1 << 16, dtype=bool)
+    present[fold(keys)] = True
+
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < SCAN_WINDOW + length - 1:
+            data = file.read(SCAN_WINDOW)
+            if not data:
+                eof = True
+                break
+            if hasher is not None:
+                hasher.update(data)
+            buffer += data
+        if len(buffer) < length:
+            break
+        if not table:
+            # nothing to match, a new file is all literal data
+            consumed = len(buffer) if eof else SCAN_WINDOW
+            yield OP_DATA, bytes(buffer[:consumed])
+            del buffer[:consumed]
+            continue
+
+        offsets = len(buffer) - length + 1 if eof else min(SCAN_WINDOW, len(buffer) - length + 1)
+        weaks = weak_checksums(np.frombuffer(buffer, np.uint8, offsets + length - 1), length)
+        # a 64K entry table rules out most offsets, the rest are searched in the sorted checksums
+        candidates = np.flatnonzero(present[fold(weaks)])
+        found = np.minimum(np.searchsorted(keys, weaks[candidates]), len(keys) - 1)
+        candidates = candidates[keys[found] == weaks[candidates]]
+        position = literal = 0
+        at = 0
+        while at < len(candidates):
+            offset = int(candidates[at])
+            strong = strong_checksum(buffer[offset:offset + length])
+            match = next((index for index in table[int(weaks[offset])] if signature.strongs[index] == strong), None)
+            if match is None:
+                at += 1
+                continue
+            if offset > literal:
+                yield OP_DATA, bytes(buffer[literal:offset])
+            yield OP_COPY, match
+            position = literal = offset + length
+            # skip the candidates inside the matched block
+            at = int(np.searchsorted(candidates, position))
+        consumed = max(position, offsets)
+        if consumed > literal:
+            yield OP_DATA, bytes(buffer[literal:consumed])
+        del buffer[:consumed]
+
+    if buffer:
+        last = len(signature.strongs) - 1
+        if last >= 0 and signature.size % length == len(buffer) and \
+                strong_checksum(buffer) == signature.strongs[last]:
+            yield OP_COPY, last
+        else:
+            yield OP_DATA, bytes(buffer)
+
+
+def encode_delta(ops, frame_size=DELTA_FRAME, flush_seconds=DELTA_FLUSH_SECONDS):
+    """
+    Encode delta operations into frame payloads, runs of consecutive blocks become one operation.
+
+    :param ops: The operations, see delta_ops().
+    :type ops: iterator of tuple
+
+    :param frame_size: The payload size to aim for.
+    :type frame_size: int
+
+    :param flush_seconds: The longest time a payload is held back while it is smaller than frame_size.
+    :type flush_seconds: float
+
+    :return: The payloads.
+    :rtype: generator of bytes
+    """
+    payload = bytearray()
+    run_start = run_count = 0
+    flushed = time.monotonic()
+    for op, value in ops:
+        if time.monotonic() - flushed > flush_seconds:
+            if run_count:
+                payload += OP_COPY + COPY_OP.pack(run_start, run_count)
+                run_count = 0
+            if payload:
+                yield bytes(payload)
+                payload.clear()
+            flushed = time.monotonic()
+        if op == OP_COPY:
+            if run_count and value == run_start + run_count:
+                run_count += 1
+                continue
+            if run_count:
+                payload += OP_COPY + COPY_OP.pack(run_start, run_count)
+            run_start, run_count = value, 1
+        else:
+            if run_count:
+                payload += OP_COPY + COPY_OP.pack(run_start, run_count)
+                run_count = 0
+            for offset in range(0, len(value), frame_size):
+                piece = value[offset:offset + frame_size]
+                payload += OP_DATA + DATA_OP.pack(len(piece)) + piece
+                if len(payload) >= frame_size:
+                    yield bytes(payload)
+                    payload.clear()
+        if len(payload) >= frame_size:
+            yield bytes(payload)
+            payload.clear()
+    if run_count:
+        payload += OP_COPY + COPY_OP.pack(run_start, run_count)
+    if payload:
+        yield bytes(payload)
+
+
+class DeltaWriter:
+    """
+    Write the new file a delta describes as the delta arrives, a file-like sink for
+    FramedConnection.read_frame_to(), so a delta frame never has to fit in memory.
+
+    An error doesn't interrupt the stream, the rest of the delta is dropped so the receiver stays
+    in step with the sender, and the error is kept in `error`.
+    """
+
+    def __init__(self, basis, length, output, hasher=None):
+        """
+        :param basis: The old copy of the file, opened for binary reading, None if there was none.
+        :type basis: io.BufferedReader or None
+
+        :param length: The block size of the signature the delta was made from.
+        :type length: int
+
+        :param output: The new file, opened for binary writing.
+        :type output: io.BufferedWriter
+
+        :param hasher: A hashlib object updated with what is written.
+        :type hasher: hashlib._Hash or None
+        """
+        self.basis = basis
+        self.length = length
+        self.output = output
+        self.hasher = hasher
+        # the operation byte and header of an operation split between chunks
+        self.header = bytearray()
+        # the literal bytes of the current data operation still to come
+        self.data_left = 0
+        self.literal = 0
+        self.matched = 0
+        self.error = None
+
+    def write(self, chunk):
+        if self.error is None:
+            try:
+                with memoryview(chunk) as view:
+                    self.apply(view)
+            except (OSError, ValueError) as err:
+                self.error = str(err)
+        return len(chunk)
+
+    def apply(self, view):
+        offset = 0
+        while offset < len(view):
+            if self.data_left:
+                with view[offset:offset + self.data_left] as data:
+                    self.emit(data)
+                    offset += len(data)
+                    self.data_left -= len(data)
+                    self.literal += len(data)
+                continue
+            op = bytes(self.header[:1] or view[offset:offset + 1])
+            if op not in OP_HEADERS:
+                raise ValueError(f"unknown delta operation {op!r}")
+            size = 1 + OP_HEADERS[op].size
+            needed = size - len(self.header)
+            self.header += view[offset:offset + needed]
+            offset += needed
+            if len(self.header) < size:
+                break
+            if op == OP_DATA:
+                self.data_left, = DATA_OP.unpack_from(self.header, 1)
+            else:
+                self.copy(*COPY_OP.unpack_from(self.header, 1))
+            self.header.clear()
+
+    def copy(self, start, count):
+        """
+        Copy a run of blocks from the old copy, a window at a time however long the run is.
+        """
+        if self.basis is None:
+            raise ValueError("invalid copy operation")
+        self.basis.seek(start * self.length)
+        left = count * self.length
+        copied = 0
+        while left > 0:
+            data = self.basis.read(min(left, SCAN_WINDOW))
+            if not data:
+                break
+            self.emit(data)
+            copied += len(data)
+            left -= len(data)
+        if not copied or copied < (count - 1) * self.length + 1:
+            raise ValueError("the copy operation is past the end of the old file")
+        self.matched += copied
+
+    def emit(self, data):
+        self.output.write(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def end_frame(self):
+        """
+        Check that the frame just written ended between operations, like the sender encodes them.
+        """
+        if (self.header or self.data_left) and self.error is None:
+            self.error = "truncated delta operation"
+        self.header.clear()
+        self.data_left = 0
@@ -0,0 +1,300 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: a parallel file copy engine for the commands server that keeps the data in the kernel
+Date: 17/10/2026
+"""
+import errno
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, neither is reflinking
+    fcntl = None
+
+# define copy constants
+COPY_CHUNK = 8 * 1024 * 1024
+DEFAULT_WORKERS = 8
+# the FICLONE ioctl, from linux/fs.h, fcntl only names it since python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+# errors that mean a copy method doesn't work for this pair of files, so the next one is tried
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                      errno.EBADF, errno.ETXTBSY}
+METHOD_REFLINK = "reflink"
+METHOD_COPY_FILE_RANGE = "copy_file_range"
+METHOD_SENDFILE = "sendfile"
+METHOD_READ_WRITE = "read/write"
+
+CopyResult = namedtuple('CopyResult', ['index', 'src', 'dest', 'size', 'seconds', 'method', 'error'])
+CopyProgress = namedtuple('CopyProgress', ['files_done', 'files', 'bytes_done', 'bytes', 'seconds'])
+
+
+class CopyCancelled(Exception):
+    """
+    Raised inside a copy when the bulk copy it belongs to is cancelled.
+    """
+
+
+def kernel_copy(copy, src_fd, dest_fd, size, progress):
+    """
+    Copy a file with a kernel copy call, chunk by chunk so progress can be reported.
+
+    :param copy: os.copy_file_range or os.sendfile.
+    :type copy: callable
+
+    :param src_fd: The source file descriptor, at offset 0.
+    :type src_fd: int
+
+    :param dest_fd: The destination file descriptor, at offset 0.
+    :type dest_fd: int
+
+    :param size: The size of the source file.
+    :type size: int
+
+    :param progress: Called with the amount of bytes copied by every chunk.
+    :type progress: callable
+
+    :return: False if the method isn't supported for these files and nothing was copied.
+    :rtype: bool
+    """
+    copied = 0
+    while True:
+        try:
+            if copy is os.sendfile:
+                count = copy(dest_fd, src_fd, None, COPY_CHUNK)
+            else:
+                count = copy(src_fd, dest_fd, COPY_CHUNK)
+        except OSError as err:
+            if copied == 0 and err.errno in UNSUPPORTED_ERRORS:
+                return False
+            raise
+        if count == 0:
+            # the file may have grown since it was measured, so stop at its real end
+            return copied > 0 or size == 0
+        copied += count
+        progress(count)
+
+
+def copy_data(src_file, dest_file, size, progress):
+    """
+    Copy the content of a file with the fastest method the system and filesystems support.
+
+    A reflink shares the blocks of the source, so the copy costs no I/O at all. Otherwise
+    copy_file_range lets the filesystem copy on its own, even server side on network shares,
+    and sendfile still avoids copying through user space. Reading and writing is the last resort.
+
+    :param src_file: The source file, opened for binary reading.
+    :type src_file: io.BufferedReader
+
+    :param dest_file: The destination file, opened for binary writing and empty.
+    :type dest_file: io.BufferedWriter
+
+    :param size: The size of the source file.
+    :type size: int
+
+    :param progress: Called with the amount of bytes copied as the copy advances.
+    :type progress: callable
+
+    :return: The method used, one of the METHOD_ constants.
+    :rtype: str
+    """
+    src_fd, dest_fd = src_file.fileno(), dest_file.fileno()
+    if fcntl is not None and size > 0:
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, src_fd)
+            progress(size)
+            return METHOD_REFLINK
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRORS:
+                raise
+    if hasattr(os, "copy_file_range") and kernel_copy(os.copy_file_range, src_fd, dest_fd, size, progress):
+        return METHOD_COPY_FILE_RANGE
+    if hasattr(os, "sendfile") and kernel_copy(os.sendfile, src_fd, dest_fd, size, progress):
+        return METHOD_SENDFILE
+
+    buffer = bytearray(COPY_CHUNK)
+    with memoryview(buffer) as view:
+        while True:
+            count = src_file.readinto(view)
+            if not count:
+                break
+            dest_file.write(view[:count])
+            progress(count)
+    return METHOD_READ_WRITE
+
+
+def copy_file(src, dest, progress=None):
+    """
+    Copy a file and its permission bits, like shutil.copy but keeping the data in the kernel.
+
+    :param src: The source path of the file.
+    :type src: str
+
+    :param dest: The destination path, or a directory to copy the file into.
+    :type dest: str
+
+    :param progress: Called with the amount of bytes copied as the copy advances.
+    :type progress: callable or None
+
+    :return: The destination path, the amount of bytes copied and the method used.
+    :rtype: tuple[str, int, str]
+
+    :raises OSError: If the file couldn't be copied.
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError(f"{src!r} and {dest!r} are the same file")
+    copied = 0
+
+    def count(amount):
+        nonlocal copied
+        copied += amount
+        if progress is not None:
+            progress(amount)
+
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        method = copy_data(src_file, dest_file, os.fstat(src_file.fileno()).st_size, count)
+    shutil.copymode(src, dest)
+    return dest, copied, method
+
+
+def plan_tree(src, dest):
+    """
+    List the files of a directory tree and create the directories of its copy.
+
+    :param src: The root of the tree.
+    :type src: str
+
+    :param dest: The root of the copy, created if missing.
+    :type dest: str
+
+    :return: The source and destination path of every file.
+    :rtype: generator of tuple[str, str]
+    """
+    for root, _, files in os.walk(src):
+        relative = os.path.relpath(root, src)
+        # the top of the tree goes right into dest, not into dest/.
+        target = dest if relative == '.' else os.path.join(dest, relative)
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            yield os.path.join(root, name), os.path.join(target, name)
+
+
+class BulkCopy:
+    """
+    Copy many files at once on a bounded thread pool.
+
+    The copies are I/O bound and the kernel copy calls release the GIL, so a few threads are
+    enough to keep the disks busy instead of waiting on one file at a time.
+    """
+
+    def __init__(self, pairs, workers=DEFAULT_WORKERS):
+        """
+        :param pairs: The source and destination path of every file.
+        :type pairs: list[tuple[str, str]]
+
+        :param workers: The number of files copied at the same time.
+        :type workers: int
+        """
+        self.pairs = pairs
+        self.workers = workers
+        self.total_bytes = 0
+        for src, _ in pairs:
+            try:
+                self.total_bytes += os.stat(src).st_size
+            except OSError:
+                # the copy itself reports the error
+                pass
+        self.copied_bytes = 0
+        self.files_done = 0
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.started = None
+
+    def progress(self, amount):
+        """
+        Count bytes copied by a worker, stops the copy if the bulk copy was cancelled.
+
+        :param amount: The amount of bytes copied.
+        :type amount: int
+        """
+        with self.lock:
+            self.copied_bytes += amount
+        if self.cancelled.is_set():
+            raise CopyCancelled()
+
+    def copy_one(self, index):
+        """
+        Copy a single file, runs on the worker threads.
+
+        :param index: The position of the file in the pairs, starting at 1.
+        :type index: int
+
+        :return: The result of the copy.
+        :rtype: CopyResult
+        """
+        src, dest = self.pairs[index - 1]
+        started = time.monotonic()
+        size, method, error = 0, None, None
+        try:
+            if self.cancelled.is_set():
+                raise CopyCancelled()
+            dest, size, method = copy_file(src, dest, self.progress)
+        except CopyCancelled:
+            error = "cancelled"
+        except OSError as err:
+            error = str(err)
+        with self.lock:
+            self.files_done += 1
+        return CopyResult(index, src, dest, size, time.monotonic() - started, method, error)
+
+    def snapshot(self):
+        """
+        :return: The progress of the bulk copy so far.
+        :rtype: CopyProgress
+        """
+        with self.lock:
+            return CopyProgress(self.files_done, len(self.pairs), self.copied_bytes, self.total_bytes,
+                                time.monotonic() - self.started)
+
+    def run(self, progress_interval=None):
+        """
+        Copy the files, reporting every file as soon as it is copied.
+
+        :param progress_interval: Also report the overall progress every this many seconds,
+                                  None to report only the files.
+        :type progress_interval: float or None
+
+        :return: The result of every file, in the order they finish, mixed with the progress reports.
+        :rtype: generator of CopyResult or CopyProgress
+        """
+        self.started = time.monotonic()
+        next_report = self.started + progress_interval if progress_interval else None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="copy") as pool:
+            pending = {pool.submit(self.copy_one, index) for index in range(1, len(self.pairs) + 1)}
+            try:
+                while pending:
+                    timeout = max(next_report - time.monotonic(), 0) if next_report else None
+                    done, pending = wait(pending, timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                    if next_report and time.monotonic() >= next_report:
+                        yield self.snapshot()
+                        next_report += progress_interval
+            finally:
+                # the consumer stopped early, don't leave the copies running
+                if pending:
+                    self.cancel()
+
+    def cancel(self):
+        """
+        Stop the copies, the files copied partly are left as they are.
+        """
+        self.cancelled.set()
@@ -5,13 +5,27 @@ Description: A basic commands server
 Date: 10/11/2023
 """
 import base64
+import hashlib
+import queue
 import socket
 import logging
 import os
 import re
+import select
+import signal
+import struct
+import threading
+import time
+from stat import S_IMODE, S_ISREG
+from contextlib import contextmanager
 from io import BytesIO
 import binascii
 from PIL import Image
+from blocksync import decode_signature, delta_ops, encode_delta
+from filehash import hash_path
+from protocol import (CHECKSUM_ALGORITHM, DELTA_HEADER, DELTA_MAGIC, DELTA_RECT, PART_SUFFIX, PING_COMMAND,
+                      PONG_ANSWER, PROTOCOL_V1, PROTOCOL_V2, TYPE_BINARY, TYPE_PARTIAL, FramedConnection, hash_file,
+                      negotiate, negotiate_compression, split_command, tune_socket)
 
 # define network constants
 SERVER_IP = '127.0.0.1'
@@ -22,10 +36,56 @@ COMMAND_LEN = 4
 HEADER_LEN = 2
 STOP_SERVER_CONNECTION = "EXIT"
 PHOTO_COMMAND = "TAKE SCREENSHOT"
+STREAM_COMMAND = "STREAM SCREEN"
+STOP_STREAM_COMMAND = "STOP"
+TRANSFER_COMMANDS = ["DOWNLOAD", "UPLOAD"]
+BATCH_COMMAND = "BATCH"
+BULK_COPY_COMMAND = "BULK COPY"
+EXECUTE_COMMAND = "EXECUTE"
+JOB_OUTPUT_COMMAND = "JOB OUTPUT"
+HASH_COMMAND = "HASH"
+SYNC_COMMAND = "SYNC"
+# the operations a batch can hold and the number of paths each one takes
+BATCH_OPERATIONS = {"DIR": 1, "DELETE": 1, "COPY": 2}
+# the header field counting the arguments of a frame is 16 bits
+MAX_FRAME_ARGS = 0xFFFF
+# requests sent ahead of the responses when pipelining, bounded so neither side blocks on a full socket
+PIPELINE_WINDOW = 64
 SHOW_COMMAND = "SHOW COMMANDS"
 ERR_INPUT = "ERROR! unknown command!"
-COMMANDS = ["DIR", "DELETE", "COPY", "EXECUTE", "TAKE SCREENSHOT", "EXIT"]
-VALID_COMMANDS = f"valid commands: |{'|'.join(COMMANDS)}|" + ' - {' + SHOW_COMMAND + '}'
+COMMANDS = ["DIR", "DELETE", "COPY", "BULK COPY", "EXECUTE", "JOB STATUS", "JOB OUTPUT", "JOB KILL", "TAKE SCREENSHOT",
+            "STREAM SCREEN", "DOWNLOAD", "UPLOAD", "BATCH", "HASH", "SYNC", "STATS", "LOG LEVEL",
+            "EXIT"]
+VALID_COMMANDS = f"valid commands: |{'|'.join(COMMANDS)}|" + ' - {' + SHOW_COMMAND + '}' + \
+    f"\n{PHOTO_COMMAND} options: format=jpeg|png|webp quality=1-100 max=pixels scale=0-1 gray " \
+    "region=left,top,right,bottom screen=all|primary delta tile=pixels" \
+    "\nDIR options: recursive glob=pattern regex=pattern sort=name|size|mtime reverse limit=count meta files" \
+    f"\n{STREAM_COMMAND} options: the {PHOTO_COMMAND} options and fps=rate frames=count, ctrl+c stops it" \
+    f"\n{BATCH_COMMAND} options: parallel=count, then enter {'|'.join(BATCH_OPERATIONS)} operations, " \
+    "an empty line runs them" \
+    f"\n{BULK_COPY_COMMAND} options: tree parallel=count progress=seconds quiet, then enter source and " \
+    "destination paths, an empty line starts the copy" \
+    f"\n{EXECUTE_COMMAND} options: timeout=seconds follow, ctrl+c stops following the output" \
+    f"\nJOB STATUS [id] | {JOB_OUTPUT_COMMAND} id | JOB KILL id: inspect the programs started by {EXECUTE_COMMAND}" \
+    f"\n{HASH_COMMAND} options: algorithm=sha256|sha512|sha1|md5|blake2b|blake2s|sha3_256 parallel=count mmap, " \
+    "then enter a file or a directory to hash its whole tree" \
+    f"\n{SYNC_COMMAND} options: delete checksum, then enter a local directory and the server directory to bring " \
+    "in line with it" \
+    "\nSTATS options: prometheus, to get every metric in the prometheus text format" \
+    "\nLOG LEVEL [debug|info|warning|error|critical]: get or change the level of the server log"
+
+NO_PATH_ERROR = "no files found at path specified"
+# compression asked for the large text responses, see protocol.Compression.parse()
+COMPRESSION = "zlib level=6 threshold=512"
+# idle connections kept for every server by a SessionPool
+POOL_SIZE = 4
+# a connection unused for this many seconds is checked before it is used again, the server may have dropped it
+PROBE_AFTER = 1.0
+# new connections tried when one breaks, the delay doubles after every failed attempt
+RECONNECT_ATTEMPTS = 3
+RECONNECT_DELAY = 0.1
+# commands that are safe to send again when the connection broke before their response arrived
+IDEMPOTENT_COMMANDS = ["DIR", "HASH", "STATS", "JOB STATUS", PHOTO_COMMAND, PING_COMMAND]
 
 # define log constants
 LOG_FORMAT = '%(levelname)s | %(asctime)s | %(processName)s | %(message)s'
@@ -34,57 +94,510 @@ LOG_DIR = 'log'
 LOG_FILE = LOG_DIR + '/loggerClient.log'
 
 
-def decode_image(base64_bytes):
+def apply_delta(frame, delta):
     """
-    Decode a base64-encoded image, save it to a file, and show it.
+    Patch the last screenshot with a delta screenshot.
+
+    :param frame: The last screenshot, None if there is none yet.
+    :type frame: PIL.Image.Image or None
 
-    :param base64_bytes: The base64-encoded image data.
-    :type base64_bytes: str
+    :param delta: The delta received from the server.
+    :type delta: bytes
 
-    :return: None
+    :return: The patched screenshot.
+    :rtype: PIL.Image.Image
     """
-    try:
-        # Save the base64 string to a file (optional)
-        with open('encoded_image.txt', 'w') as txt_file:
-            txt_file.write(base64_bytes)
+    view = memoryview(delta)
+    _, key_frame, width, height, count = DELTA_HEADER.unpack_from(view)
+    offset = DELTA_HEADER.size
+    if key_frame or frame is None or frame.size != (width, height):
+        frame = None
+    else:
+        frame = frame.copy()
+    for _ in range(count):
+        left, top, length = DELTA_RECT.unpack_from(view, offset)
+        offset += DELTA_RECT.size
+        rect = Image.open(BytesIO(view[offset:offset + length]))
+        offset += length
+        if frame is None:
+            frame = Image.new(rect.mode, (width, height))
+        frame.paste(rect, (left, top))
+    return frame
 
-        # Decode the base64 string back to image data
-        decoded_image = base64.b64decode(base64_bytes)
 
-        # Create a PIL Image object from the decoded image data
-        image = Image.open(BytesIO(decoded_image))
+def decode_image(image_data, frame=None, show=True):
+    """
+    Decode a screenshot received from the server and show it.
+
+    :param image_data: The encoded image or delta, base64 text when using the legacy protocol.
+    :type image_data: bytes or str
+
+    :param frame: The last screenshot shown, patched when a delta is received.
+    :type frame: PIL.Image.Image or None
+
+    :param show: Show the decoded screenshot.
+    :type show: bool
+
+    :return: The decoded screenshot, None if it couldn't be decoded.
+    :rtype: PIL.Image.Image or None
+    """
+    image = None
+    try:
+        if isinstance(image_data, str):
+            # the legacy protocol can only carry text
+            image_data = base64.b64decode(image_data)
 
-        # Save the image
-        image.save('output_image.jpg')
-        image.show()
+        if image_data[:len(DELTA_MAGIC)] == DELTA_MAGIC:
+            image = apply_delta(frame, image_data)
+        else:
+            # Create a PIL Image object straight from the received bytes
+            image = Image.open(BytesIO(image_data))
+        if show:
+            image.show()
     except binascii.Error as err:
         logging.error(f"eror while trying to decode image! '{err}'")
         print(f"Error decoding base64: {err}")
+    except (OSError, struct.error) as err:
+        logging.error(f"error while trying to open image! '{err}'")
+        print(f"Error opening image: {err}")
+
+    return image
+
+
+def watch_stream(comm, frame=None):
+    """
+    Receive the frames of a screen stream until the server ends it.
+
+    Pressing ctrl+c cancels the stream, the last frame received is shown at the end.
+
+    :param comm: The communication channel, after sending the stream command.
+    :type comm: protocol.FramedConnection
+
+    :param frame: The last screenshot shown, deltas are applied on it.
+    :type frame: PIL.Image.Image or None
+
+    :return: The last frame and the message the server ended the stream with.
+    :rtype: tuple[PIL.Image.Image or None, str or None]
+    """
+    frames = 0
+    received_bytes = 0
+    started = time.monotonic()
+    # ctrl+c only marks the stream as cancelled, interrupting a receive would lose the frame
+    cancelled = threading.Event()
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGINT, lambda signum, stack: cancelled.set())
+    stop_sent = False
+    try:
+        while True:
+            res, _ = receive(comm)
+            if not isinstance(res, (bytes, bytearray)):
+                break
+            frames += 1
+            received_bytes += len(res)
+            frame = decode_image(res, frame, show=False) or frame
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(f"\rframe {frames} | {frames / elapsed:.1f} fps | {received_bytes / elapsed / 1024:.0f} KiB/s",
+                  end='', flush=True)
+            if cancelled.is_set() and not stop_sent:
+                # ask the server to stop, the frames already on the way are still read
+                stop_sent = send(comm, STOP_STREAM_COMMAND) == 0
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+    print()
+    if frame is not None:
+        frame.show()
+    return frame, res
+
+
+def follow_job(comm, request):
+    """
+    Send a request that streams the output of a job and print the output until the job ends.
+
+    Pressing ctrl+c stops following the output, the job keeps running on the server.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param request: The request, e.g. ['EXECUTE follow', path] or 'JOB OUTPUT 3'.
+    :type request: str or list[str]
+
+    :return: The message the server ended the stream with.
+    :rtype: str or None
+    """
+    if send(comm, request, len(request) if isinstance(request, list) else 0) != 0:
+        return "error! couldn't send data to server!"
+    detached = threading.Event()
+
+    def detach(signum, stack):
+        # the server may be waiting for output, so ask it to stop right away
+        if not detached.is_set():
+            detached.set()
+            send(comm, STOP_STREAM_COMMAND)
+
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGINT, detach)
+    try:
+        res, _ = receive(comm, print)
+    finally:
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+    return res
+
+
+def download_file(comm, remote_path, local_path):
+    """
+    Download a file from the server, resuming a previous download of it if there is one.
+
+    The data is written to a partial file next to `local_path` as it arrives, which replaces
+    `local_path` once the checksum of the whole file matches the server's.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param remote_path: The path of the file on the server.
+    :type remote_path: str
+
+    :param local_path: The path to save the file at.
+    :type local_path: str
+
+    :return: The message to show the user.
+    :rtype: str
+    """
+    part = local_path + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    if send(comm, "DOWNLOAD") != 0 or receive(comm)[0] is None:
+        return "error! couldn't send data to server!"
+    if send(comm, [remote_path, str(offset)], 2) != 0:
+        return "error! couldn't send data to server!"
+    res, _ = receive(comm)
+    try:
+        size, offset, checksum = res.split()
+        size, offset = int(size), int(offset)
+    except (AttributeError, ValueError):
+        # the server couldn't send the file, res is its error message
+        return res
+
+    with open(part, 'r+b' if os.path.isfile(part) else 'w+b') as file:
+        file.truncate(offset)
+        hasher = hash_file(file, offset)
+        file.seek(offset)
+        frame = comm.read_frame_to(file, hasher)
+    if frame is None or frame.frame_type != TYPE_BINARY:
+        return "error! the download was interrupted, run it again to resume"
+
+    res, _ = receive(comm)
+    if offset + frame.data != size or hasher.hexdigest() != checksum:
+        os.remove(part)
+        return "error! the downloaded file is corrupted"
+    os.replace(part, local_path)
+    return res
+
+
+def upload_file(comm, local_path, remote_path):
+    """
+    Upload a file to the server, the server resumes a previous upload of it if there is one.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param local_path: The path of the file to upload.
+    :type local_path: str
 
+    :param remote_path: The path to save the file at on the server.
+    :type remote_path: str
 
-def send(comm, data, args=0):
+    :return: The message to show the user.
+    :rtype: str
+    """
+    try:
+        file = open(local_path, 'rb')
+    except OSError as err:
+        return f"error! couldn't read {local_path}: {err}"
+
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        checksum = hash_file(file).hexdigest()
+        if send(comm, "UPLOAD") != 0 or receive(comm)[0] is None:
+            return "error! couldn't send data to server!"
+        if send(comm, [remote_path, str(size), checksum], 3) != 0:
+            return "error! couldn't send data to server!"
+        res, _ = receive(comm)
+        if res is None or not res.startswith("OFFSET "):
+            return res
+        offset = int(res.split()[1])
+        comm.send_file(file, offset, size - offset)
+
+    res, _ = receive(comm)
+    return res
+
+
+def run_batch(comm, operations, options="", on_result=print):
+    """
+    Run many operations on the server in a single round trip.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param operations: The operations, every one is its command, with options for DIR,
+                       followed by its paths, e.g. [('DELETE', 'a.txt'), ('DIR recursive', 'logs')].
+    :type operations: list[tuple[str, ...]]
+
+    :param options: The batch options, e.g. 'parallel=8'.
+    :type options: str
+
+    :param on_result: Called with the result of every operation as it arrives, the result
+                      starts with the position of the operation in the batch.
+    :type on_result: callable
+
+    :return: The summary the server ended the batch with.
+    :rtype: str or None
+    """
+    items = [f"{BATCH_COMMAND} {options}".strip()]
+    for operation in operations:
+        items.extend(operation)
+    if len(items) > MAX_FRAME_ARGS:
+        return f"error! a batch holds at most {MAX_FRAME_ARGS - 1} commands and paths"
+    if send(comm, items, len(items)) != 0:
+        return "error! couldn't send data to server!"
+    res, _ = receive(comm, on_result)
+    return res
+
+
+def bulk_copy(comm, pairs, options="", on_progress=print):
+    """
+    Copy many files, or whole trees with the 'tree' option, on the server in parallel.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param pairs: The source and destination path of every file or tree.
+    :type pairs: list[tuple[str, str]]
+
+    :param options: The bulk copy options, e.g. 'tree parallel=16 progress=0.5'.
+    :type options: str
+
+    :param on_progress: Called with every file copied and every progress report as they arrive.
+    :type on_progress: callable
+
+    :return: The summary the server ended the copy with.
+    :rtype: str or None
+    """
+    items = [f"{BULK_COPY_COMMAND} {options}".strip()]
+    for pair in pairs:
+        items.extend(pair)
+    if len(items) > MAX_FRAME_ARGS:
+        return f"error! a bulk copy holds at most {(MAX_FRAME_ARGS - 1) // 2} pairs of paths"
+    if send(comm, items, len(items)) != 0:
+        return "error! couldn't send data to server!"
+    res, _ = receive(comm, on_progress)
+    return res
+
+
+def build_manifest(local, checksum=False):
+    """
+    Describe the files of a local directory for the sync command.
+
+    :param local: The path of the directory.
+    :type local: str
+
+    :param checksum: Add the digest of every file, for the server to compare contents.
+    :type checksum: bool
+
+    :return: The path of every file, and the manifest lines the server reads.
+    :rtype: tuple[list[str], str]
+    """
+    paths = []
+    lines = []
+    for root, dirs, files in os.walk(local):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, local).replace(os.sep, '/')
+            try:
+                stat = os.stat(path)
+                if '\n' in rel or not S_ISREG(stat.st_mode):
+                    continue
+                digest = hash_path(path)[0] if checksum else '-'
+            except OSError as err:
+                logging.warning(f"skipping {path} in the sync: {err}")
+                continue
+            paths.append(path)
+            lines.append(f"{stat.st_size} {stat.st_mtime_ns} {S_IMODE(stat.st_mode):o} {digest} {rel}")
+    return paths, '\n'.join(lines)
+
+
+def sync_directory(comm, local, remote, options="", on_report=print):
+    """
+    Bring a directory on the server in line with a local one, sending only what changed.
+
+    The server answers the manifest with a signature of every file it needs, and every such file
+    is sent as a delta against the server's copy: the blocks the server already has, wherever
+    they moved to, and literal data for the rest.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param local: The path of the local directory.
+    :type local: str
+
+    :param remote: The path of the directory on the server.
+    :type remote: str
+
+    :param options: The sync options, 'delete' to remove the files the local directory doesn't
+                    have, 'checksum' to compare contents instead of sizes and modification times.
+    :type options: str
+
+    :param on_report: Called with the report of the changed files as it arrives.
+    :type on_report: callable
+
+    :return: The summary the server ended the sync with.
+    :rtype: str or None
+    """
+    if not os.path.isdir(local):
+        return f"error! {local} isn't a directory"
+    paths, manifest = build_manifest(local, "checksum" in options.lower().split())
+    if send(comm, [f"{SYNC_COMMAND} {options}".strip(), remote, manifest], 3) != 0:
+        return "error! couldn't send data to server!"
+
+    signatures = []
+    while True:
+        try:
+            frame = comm.read_frame()
+        except (socket.error, ValueError) as err:
+            print(err)
+            return None
+        if frame is None:
+            return None
+        if frame.frame_type != TYPE_BINARY:
+            if not frame.data.startswith("END OF PLAN"):
+                return frame.data
+            logging.info(frame.data)
+            break
+        try:
+            signatures.append(decode_signature(frame.data))
+        except ValueError as err:
+            return f"error! the server sent an invalid signature: {err}"
+
+    for signature in signatures:
+        hasher = hashlib.new(CHECKSUM_ALGORITHM)
+        try:
+            with open(paths[signature.index], 'rb') as file:
+                for payload in encode_delta(delta_ops(file, signature, hasher)):
+                    if send(comm, payload) != 0:
+                        return "error! couldn't send data to server!"
+            end = f"DONE {hasher.hexdigest()}"
+        except (OSError, IndexError) as err:
+            # the server drops what it got of the file and keeps its copy
+            end = f"SKIP {err}"
+        if send(comm, end) != 0:
+            return "error! couldn't send data to server!"
+
+    res, _ = receive(comm, on_report)
+    return res
+
+
+def read_copy_pairs():
+    """
+    Ask the user for the paths of a bulk copy.
+
+    :return: The source and destination path of every file or tree.
+    :rtype: list[tuple[str, str]]
+    """
+    pairs = []
+    while True:
+        src = input("Enter source path (empty line to start the copy): ")
+        if not src:
+            return pairs
+        pairs.append((src, input("Enter destination path: ")))
+
+
+def pipeline(comm, requests, window=PIPELINE_WINDOW):
+    """
+    Send requests without waiting for the response of each one before sending the next.
+
+    Every request carries its paths in the command frame and its own request id, which the
+    server echoes on the responses.
+
+    :param comm: The communication channel, must use protocol v2.
+    :type comm: protocol.FramedConnection
+
+    :param requests: The requests, every one is its command followed by its paths,
+                     e.g. [('DELETE', 'a.txt'), ('COPY', 'b.txt', 'c.txt')].
+    :type requests: iterable of tuple[str, ...]
+
+    :param window: The maximum number of requests waiting for a response.
+    :type window: int
+
+    :return: The request id and the response of every request, in the order they were sent.
+             Request ids start at 1.
+    :rtype: generator of tuple[int, str or bytes]
+    """
+    waiting = 0
+    for request_id, request in enumerate(requests, start=1):
+        if send(comm, list(request), len(request), request_id) != 0:
+            break
+        waiting += 1
+        if waiting == window:
+            res, _ = receive(comm)
+            if res is None:
+                return
+            waiting -= 1
+            yield comm.request_id, res
+    for _ in range(waiting):
+        res, _ = receive(comm)
+        if res is None:
+            return
+        yield comm.request_id, res
+
+
+def read_batch():
+    """
+    Ask the user for the operations of a batch.
+
+    :return: The operations, see run_batch().
+    :rtype: list[tuple[str, ...]]
+    """
+    operations = []
+    while True:
+        command = input("Enter batch operation (empty line to run): ").strip()
+        if not command:
+            return operations
+        name, options = split_command(command, list(BATCH_OPERATIONS))
+        if name not in BATCH_OPERATIONS:
+            print(f"{ERR_INPUT} a batch holds only {'|'.join(BATCH_OPERATIONS)}")
+            continue
+        paths = [input("Enter path: ") for _ in range(BATCH_OPERATIONS[name])]
+        operations.append((f"{name} {options}".strip(), *paths))
+
+
+def send(comm, data, args=0, request_id=None):
     """
     Send data over a communication channel.
 
     :param args: number of arguments (not commands) the client sends to the server
     :type args: int
     :param comm: The communication channel.
-    :type comm: socket.socket
+    :type comm: protocol.FramedConnection
+
+    :param data: The data to be sent, a list is sent as separate arguments.
+    :type data: str or list[str] or bytes
 
-    :param data: The data to be sent.
-    :type data: string
+    :param request_id: The id the server answers the request with, requires protocol v2.
+    :type request_id: int or None
 
     :return: 0 if successful, error code otherwise.
     :rtype: int
     """
     return_code = 0
-    data_len = len(data)
-    # Include type information along with the data length and actual data
-    data = str(args) + '$' + str(data_len) + '$' + data
-    sent = 0
     try:
-        while sent < len(data):
-            sent += comm.send(data[sent:].encode())
+        comm.write_frame(data, args, request_id)
+
+    except ValueError as err:
+        print(err)
+        return_code = 1
 
     except socket.error as err:
         print(err)
@@ -94,60 +607,39 @@ def send(comm, data, args=0):
     return return_code
 
 
-def receive(comm):
+def receive(comm, on_partial=None):
     """
     Receive data over a communication channel.
 
+    A response may be sent in several partial frames followed by a final one. Partial frames
+    are handed to `on_partial` as they arrive, or joined with the final frame if it is None.
+
     :param comm: The communication channel.
-    :type comm: socket.socket
+    :type comm: protocol.FramedConnection
 
-    :return: string of the data from the client if successful, None otherwise.
-    :rtype: str or None
+    :param on_partial: Called with the text of every partial frame.
+    :type on_partial: callable or None
+
+    :return: the data from the server if successful (None otherwise) and the number of
+             arguments the server expects next.
+    :rtype: tuple[str or bytes or None, int or None]
     """
-    data_len_str = ""
-    received_data = ""
-    num_of_args = ""
+    received_data = None
+    num_of_args = None
+    parts = []
     try:
-        # Receive num of args
-        while True:
-            buff = comm.recv(1).decode()
-            if buff == '$':
-                break
-            if buff == '':
-                num_of_args = None
-                break
-            num_of_args += buff
-
-        if num_of_args is not None:
-            num_of_args = int(num_of_args)
-
-            # Receive length of the data
-            while True:
-                buff = comm.recv(1).decode()
-                if buff == '$':
-                    break
-                if buff == '':
-                    data_len_str = None
-                    break
-                data_len_str += buff
-
-            # Convert the length to an integer
-            if data_len_str is not None:
-                data_len = int(data_len_str)
-
-                # Receive the actual data
-                i = 0
-                while len(received_data) < data_len:
-                    buff = comm.recv(data_len - len(received_data)).decode()
-                    if buff == '':
-                        received_data = None
-                        break
-                    received_data += buff
+        frame = comm.read_frame()
+        while frame is not None and frame.frame_type == TYPE_PARTIAL:
+            if on_partial is not None:
+                on_partial(frame.data)
             else:
-                received_data = None
-        else:
-            received_data = None
-    except socket.error as err:
+                parts.append(frame.data)
+            frame = comm.read_frame()
+        if frame is not None:
+            num_of_args, received_data = frame.num_of_args, frame.data
+            if parts:
+                received_data = '\n'.join(parts + [received_data])
+    except (socket.error, ValueError) as err:
         print(err)
         # Return None for failure
         received_data = None
@@ -156,15 +648,624 @@ def receive(comm):
         return received_data, num_of_args
 
 
+class CommandError(Exception):
+    """
+    Raised by the sessions when the server answers a command with an error.
+    """
+
+
+def check_response(res, expected, command):
+    """
+    :raises CommandError: If a command wasn't answered with the expected response.
+    """
+    if res != expected:
+        raise CommandError(f"{command} failed: {res}")
+
+
+def listing_lines(res, pages, version):
+    """
+    Turn the response of DIR into the lines of the listing.
+
+    :param res: The final frame of the response.
+    :type res: str
+
+    :param pages: The partial frames of the response.
+    :type pages: list[str]
+
+    :param version: The protocol version of the connection.
+    :type version: int
+
+    :return: The lines of the listing, empty if nothing was found.
+    :rtype: list[str]
+
+    :raises CommandError: If the listing failed.
+    """
+    if res == NO_PATH_ERROR:
+        return []
+    if version == PROTOCOL_V1:
+        return res.split('\n')
+    if not res.startswith("END OF LIST"):
+        raise CommandError(f"DIR failed: {res}")
+    return [line for page in pages for line in page.split('\n')]
+
+
+def hash_digests(res, pages):
+    """
+    Turn the response of HASH into the digest of every file.
+
+    :param res: The final frame of the response, the summary. Over protocol v1 the digest lines
+                come first, in the same frame.
+    :type res: str
+
+    :param pages: The partial frames of the response.
+    :type pages: list[str]
+
+    :return: The digest of every file by its path, None for the files that couldn't be hashed.
+    :rtype: dict[str, str or None]
+
+    :raises CommandError: If the files couldn't be hashed at all.
+    """
+    lines = [line for page in pages + [res] for line in page.split('\n')]
+    summary = lines.pop()
+    if not summary.startswith("END OF HASH"):
+        raise CommandError(f"{HASH_COMMAND} failed: {summary}")
+    digests = {}
+    for line in lines:
+        if line.startswith("FAILED "):
+            digests[line[len("FAILED "):].rsplit(": ", 1)[0]] = None
+        else:
+            digest, _, path = line.partition("  ")
+            digests[path] = digest
+    return digests
+
+
+def job_id(res):
+    """
+    :return: The id of the job in the response of EXECUTE.
+    :rtype: int
+
+    :raises CommandError: If the program wasn't started.
+    """
+    if not res.startswith("JOB ") or not res.endswith(" STARTED"):
+        raise CommandError(f"EXECUTE failed: {res}")
+    return int(res.split()[1])
+
+
+def job_lines(res):
+    """
+    :return: The lines of the response of JOB STATUS.
+    :rtype: list[str]
+
+    :raises CommandError: If there is no such job.
+    """
+    if res.startswith("NO SUCH JOB"):
+        raise CommandError(res)
+    return [] if res == "NO JOBS" else res.split('\n')
+
+
+def job_killed(res):
+    """
+    :return: The response of JOB KILL, False if the job had already ended.
+    :rtype: bool
+
+    :raises CommandError: If there is no such job.
+    """
+    if not res.startswith("JOB "):
+        raise CommandError(res)
+    return res.endswith("KILLED")
+
+
+class Session:
+    """
+    A persistent connection to the server for scripts, with a method for every command.
+
+    The connection is opened on the first command and kept for the next ones. If it breaks,
+    or the server dropped it while it was idle, the next command opens a new one, and commands
+    that are safe to repeat are sent again. With a heartbeat the session pings the server while
+    it is idle, which keeps the connection from being dropped. A session can be shared by
+    threads, they take turns.
+
+    Example::
+
+        with Session("10.0.0.5") as server:
+            for path in server.dir("C:/logs", "glob=*.log"):
+                server.copy(path, "D:/backup")
+    """
+
+    def __init__(self, host=SERVER_IP, port=SERVER_PORT, timeout=None, compression=COMPRESSION, heartbeat=None,
+                 retries=RECONNECT_ATTEMPTS):
+        """
+        :param host: The address of the server.
+        :type host: str
+
+        :param port: The port of the server.
+        :type port: int
+
+        :param timeout: The socket timeout in seconds, None to wait forever.
+        :type timeout: float or None
+
+        :param compression: The compression to ask for, see protocol.Compression.parse(), None for none.
+        :type compression: str or None
+
+        :param heartbeat: Ping the server after this many idle seconds, None for no heartbeat.
+        :type heartbeat: float or None
+
+        :param retries: The connection attempts after the first one fails, and the times a command
+                        in IDEMPOTENT_COMMANDS is sent again.
+        :type retries: int
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.compression = compression
+        self.retries = retries
+        self.comm = None
+        self.lock = threading.RLock()
+        # the last screenshot, kept to apply delta screenshots on
+        self.frame = None
+        # when the connection was last handed out, see connect()
+        self.last_used = 0.0
+        self.heartbeat = heartbeat
+        self.stopped = threading.Event()
+        if heartbeat is not None:
+            threading.Thread(target=self.beat, name=f"heartbeat {host}:{port}", daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """
+        Connect to the server if the session isn't connected.
+
+        :return: The connection.
+        :rtype: protocol.FramedConnection
+        """
+        with self.lock:
+            if self.comm is not None and self.is_stale():
+                logging.info(f"the connection to {self.host}:{self.port} was closed while idle, reconnecting")
+                self.disconnect()
+            if self.comm is None:
+                self.comm = self.open_connection()
+            self.last_used = time.monotonic()
+            return self.comm
+
+    def open_connection(self):
+        """
+        Open a connection and negotiate the protocol and the compression, trying again with a
+        growing delay if the server can't be reached.
+
+        :return: The connection.
+        :rtype: protocol.FramedConnection
+
+        :raises OSError: If every attempt failed.
+        """
+        delay = RECONNECT_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                sock = socket.create_connection((self.host, self.port), self.timeout)
+            except socket.error as err:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"can't connect to {self.host}:{self.port}: {err}, trying again in {delay:g}s")
+                time.sleep(delay)
+                delay *= 2
+                continue
+            tune_socket(sock)
+            comm = FramedConnection(sock)
+            try:
+                logging.info(f"using protocol v{negotiate(comm)} with {self.host}:{self.port}")
+                if comm.version == PROTOCOL_V2 and self.compression is not None:
+                    negotiate_compression(comm, self.compression)
+            except (socket.error, ValueError):
+                comm.close()
+                raise
+            return comm
+
+    def is_stale(self):
+        """
+        Check, without waiting, if the server closed the connection while it was idle.
+
+        The server only sends in answer to a request, so an idle connection with something to
+        read was closed, or is out of step.
+
+        :return: True if the connection can't be used.
+        :rtype: bool
+        """
+        if time.monotonic() - self.last_used < PROBE_AFTER:
+            return False
+        try:
+            return self.comm.pending() or bool(select.select([self.comm], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def beat(self):
+        """
+        Ping the server whenever the session was idle for a heartbeat, runs on a thread of its own
+        until the session is closed.
+        """
+        while not self.stopped.wait(self.heartbeat):
+            # a command that is running is as good as a heartbeat
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                if self.comm is not None and time.monotonic() - self.last_used >= self.heartbeat:
+                    self.ping()
+            except (CommandError, OSError) as err:
+                logging.warning(f"heartbeat to {self.host}:{self.port} failed: {err}")
+            finally:
+                self.lock.release()
+
+    def disconnect(self):
+        """
+        Drop the connection without saying goodbye, e.g. after it broke.
+        """
+        with self.lock:
+            if self.comm is not None:
+                self.comm.close()
+                self.comm = None
+
+    def close(self):
+        """
+        Tell the server the session is over and close the connection.
+        """
+        self.stopped.set()
+        with self.lock:
+            if self.comm is not None:
+                if send(self.comm, STOP_SERVER_CONNECTION) == 0:
+                    receive(self.comm)
+                self.disconnect()
+
+    def request(self, command, *paths, on_partial=None):
+        """
+        Send a command with its paths in the same frame and wait for the response.
+
+        :param command: The command with its options, e.g. 'DIR recursive'.
+        :type command: str
+
+        :param paths: The paths the command takes.
+        :type paths: str
+
+        :param on_partial: Called with every partial frame of the response, joined to the
+                           response if None.
+        :type on_partial: callable or None
+
+        :return: The response.
+        :rtype: str or bytes
+
+        :raises ConnectionError: If the connection broke, the next request reconnects.
+        """
+        items = [command, *paths]
+        retries = self.retries if split_command(command, IDEMPOTENT_COMMANDS)[0] in IDEMPOTENT_COMMANDS else 0
+        # a response that was partly handed over can't be asked for again
+        partial_frames = []
+
+        def forward(data):
+            partial_frames.append(True)
+            on_partial(data)
+
+        with self.lock:
+            for attempt in range(retries + 1):
+                comm = self.connect()
+                if send(comm, items if paths else command, len(items) if paths else 0) == 0:
+                    res, _ = receive(comm, forward if on_partial is not None else None)
+                    if res is not None:
+                        return res
+                self.disconnect()
+                if partial_frames:
+                    break
+                if attempt < retries:
+                    logging.warning(f"lost the connection to {self.host}:{self.port}, sending {command} again")
+            raise ConnectionError(f"lost the connection to {self.host}:{self.port}")
+
+    def ping(self):
+        """
+        Check that the server answers.
+
+        :return: The round trip time in seconds.
+        :rtype: float
+
+        :raises ConnectionError: If the server can't be reached.
+        """
+        started = time.perf_counter()
+        check_response(self.request(PING_COMMAND), PONG_ANSWER, PING_COMMAND)
+        return time.perf_counter() - started
+
+    def dir(self, path, options=""):
+        """
+        List a directory on the server.
+
+        :param path: The path of the directory.
+        :type path: str
+
+        :param options: The dir options, e.g. 'recursive glob=*.py meta'.
+        :type options: str
+
+        :return: The lines of the listing, empty if nothing was found.
+        :rtype: list[str]
+        """
+        pages = []
+        with self.lock:
+            res = self.request(f"DIR {options}".strip(), path, on_partial=pages.append)
+            return listing_lines(res, pages, self.comm.version)
+
+    def delete(self, path):
+        """
+        Delete a file on the server.
+
+        :param path: The path of the file.
+        :type path: str
+        """
+        check_response(self.request("DELETE", path), "FILE DELETED", "DELETE")
+
+    def copy(self, src, dest):
+        """
+        Copy a file on the server.
+
+        :param src: The source path of the file.
+        :type src: str
+
+        :param dest: The destination path, or a directory to copy the file into.
+        :type dest: str
+        """
+        check_response(self.request("COPY", src, dest), "FILE COPY", "COPY")
+
+    def execute(self, path, timeout=None):
+        """
+        Start a program on the server in the background.
+
+        :param path: The path of the program.
+        :type path: str
+
+        :param timeout: Kill the program after this many seconds, None to let it run.
+        :type timeout: float or None
+
+        :return: The id of the job, see job_status().
+        :rtype: int
+        """
+        command = f"EXECUTE timeout={timeout}" if timeout else "EXECUTE"
+        return job_id(self.request(command, path))
+
+    def job_status(self, job=None):
+        """
+        :param job: The id of a job, None for all of them.
+        :type job: int or None
+
+        :return: A line describing every job, e.g. 'JOB 3 exited code=0 seconds=1.2 lines=10 /bin/ls'.
+        :rtype: list[str]
+        """
+        return job_lines(self.request(f"JOB STATUS {job}" if job is not None else "JOB STATUS"))
+
+    def job_kill(self, job):
+        """
+        Kill a job.
+
+        :param job: The id of the job.
+        :type job: int
+
+        :return: False if the job had already ended.
+        :rtype: bool
+        """
+        return job_killed(self.request(f"JOB KILL {job}"))
+
+    def hash(self, paths, options=""):
+        """
+        Hash files on the server, directories are hashed file by file with their whole tree.
+
+        A single request checks any number of copies, compare the digests with local ones.
+
+        :param paths: The paths of the files and directories.
+        :type paths: list[str]
+
+        :param options: The hash options, e.g. 'algorithm=blake2b parallel=8'.
+        :type options: str
+
+        :return: The digest of every file by its path, None for the files that couldn't be hashed.
+        :rtype: dict[str, str or None]
+        """
+        pages = []
+        res = self.request(f"{HASH_COMMAND} {options}".strip(), *paths, on_partial=pages.append)
+        return hash_digests(res, pages)
+
+    def stats(self, prometheus=False):
+        """
+        Get the metrics of the server: latencies, counts and bytes per command, errors and connections.
+
+        :param prometheus: Get every metric in the Prometheus text format instead of a summary.
+        :type prometheus: bool
+
+        :return: The metrics.
+        :rtype: str
+        """
+        return self.request("STATS prometheus" if prometheus else "STATS")
+
+    def screenshot(self, options=""):
+        """
+        Take a screenshot of the server screen.
+
+        :param options: The screenshot options, e.g. 'format=png max=1280 delta'.
+        :type options: str
+
+        :return: The screenshot.
+        :rtype: PIL.Image.Image
+        """
+        with self.lock:
+            res = self.request(f"{PHOTO_COMMAND} {options}".strip())
+            if isinstance(res, str) and self.comm.version != PROTOCOL_V1:
+                raise CommandError(f"{PHOTO_COMMAND} failed: {res}")
+            image = decode_image(res, self.frame, show=False)
+            if image is None:
+                raise CommandError(f"{PHOTO_COMMAND} sent an image that can't be decoded")
+            self.frame = image
+            return image
+
+    def download(self, remote_path, local_path):
+        """
+        Download a file, resuming a previous download of it if there is one.
+        """
+        with self.lock:
+            check_response(download_file(self.connect(), remote_path, local_path), "FILE DOWNLOADED", "DOWNLOAD")
+
+    def upload(self, local_path, remote_path):
+        """
+        Upload a file, resuming a previous upload of it if there is one.
+        """
+        with self.lock:
+            check_response(upload_file(self.connect(), local_path, remote_path), "FILE UPLOADED", "UPLOAD")
+
+    def batch(self, operations, options=""):
+        """
+        Run many operations in a single round trip, see run_batch().
+
+        :return: The result of every operation, in the order they finished, and the summary.
+        :rtype: tuple[list[str], str]
+        """
+        results = []
+        with self.lock:
+            res = run_batch(self.connect(), operations, options, results.append)
+        if res is None or not res.startswith("END OF BATCH"):
+            raise CommandError(f"{BATCH_COMMAND} failed: {res}")
+        return results, res
+
+    def bulk_copy(self, pairs, options=""):
+        """
+        Copy many files or trees in parallel, see bulk_copy().
+
+        :return: The report of every file and the progress reports, and the summary.
+        :rtype: tuple[list[str], str]
+        """
+        reports = []
+        with self.lock:
+            res = bulk_copy(self.connect(), pairs, options, reports.append)
+        if res is None or not res.startswith("END OF COPY"):
+            raise CommandError(f"{BULK_COPY_COMMAND} failed: {res}")
+        return reports, res
+
+    def sync(self, local, remote, options=""):
+        """
+        Bring a directory on the server in line with a local one, see sync_directory().
+
+        :return: The report of every changed file, and the summary.
+        :rtype: tuple[list[str], str]
+        """
+        reports = []
+        with self.lock:
+            res = sync_directory(self.connect(), local, remote, options, reports.append)
+        if res is None or not res.startswith("END OF SYNC"):
+            raise CommandError(f"{SYNC_COMMAND} failed: {res}")
+        return reports, res
+
+    def pipeline(self, requests, window=PIPELINE_WINDOW):
+        """
+        Send many requests without waiting for each response, see pipeline().
+
+        :return: The response of every request, in the order they were sent.
+        :rtype: list[str or bytes]
+        """
+        requests = list(requests)
+        with self.lock:
+            responses = [res for _, res in pipeline(self.connect(), requests, window)]
+            if len(responses) != len(requests):
+                self.disconnect()
+                raise ConnectionError(f"lost the connection to {self.host}:{self.port}")
+        return responses
+
+
+class SessionPool:
+    """
+    Sessions to many servers, reused across threads so every command doesn't pay for a new
+    connection and protocol negotiation.
+
+    Example::
+
+        pool = SessionPool()
+        with pool.session("10.0.0.5") as server:
+            server.delete("C:/temp/old.log")
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=None, compression=COMPRESSION, heartbeat=None):
+        """
+        :param size: The maximum number of idle sessions kept for every server.
+        :type size: int
+
+        :param timeout: The socket timeout of the sessions in seconds, None to wait forever.
+        :type timeout: float or None
+
+        :param compression: The compression the sessions ask for, None for none.
+        :type compression: str or None
+
+        :param heartbeat: Ping the servers after this many idle seconds, keeping idle sessions
+                          connected, None for no heartbeat.
+        :type heartbeat: float or None
+        """
+        self.size = size
+        self.timeout = timeout
+        self.compression = compression
+        self.heartbeat = heartbeat
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self, host, port=SERVER_PORT):
+        """
+        Borrow a session to a server, it goes back to the pool at the end of the with block.
+
+        :param host: The address of the server.
+        :type host: str
+
+        :param port: The port of the server.
+        :type port: int
+
+        :return: The session.
+        :rtype: generator of Session
+        """
+        with self.lock:
+            idle = self.idle.setdefault((host, port), queue.LifoQueue())
+        try:
+            session = idle.get_nowait()
+        except queue.Empty:
+            session = Session(host, port, self.timeout, self.compression, self.heartbeat)
+        try:
+            yield session
+        except CommandError:
+            raise
+        except BaseException:
+            # the connection may be left in the middle of a response
+            session.disconnect()
+            raise
+        finally:
+            # a session that lost its connection reconnects when it is used again
+            if idle.qsize() < self.size:
+                idle.put(session)
+            else:
+                session.close()
+
+    def close(self):
+        """
+        Close every idle session.
+        """
+        with self.lock:
+            pools, self.idle = list(self.idle.values()), {}
+        for idle in pools:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
 def main():
     """
        the main function; responsible for running the client code
        """
-    # define an ipv4 tcp socket and listen for an incoming connection
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # the session reconnects when the server dropped the connection while the prompt waited
+    session = Session(SERVER_IP, SERVER_PORT)
+    client = None
     try:
         logging.info(f"trying to connect to server at ({SERVER_IP}, {SERVER_PORT})")
-        client.connect((SERVER_IP, SERVER_PORT))
+        client = session.connect()
+        if client.version == PROTOCOL_V2:
+            compression = client.compression
+            logging.info(f"compression: {compression.describe() if compression is not None else 'none'}")
 
         print("connected to server")
         logging.info("client established connection with server")
@@ -174,39 +1275,87 @@ def main():
 
         res = None
         args = 0
+        # the last screenshot, kept to apply delta screenshots on
+        frame = None
         while not want_to_exit:
             # Get args inputs from the user
-            command = [input(f"Enter command: ") for _ in range(max(args, 1))]
+            inputs = [input(f"Enter command: ") for _ in range(max(args, 1))]
             # Join the inputs using '$' and print the result
-            command = '$'.join(command)
+            command = '$'.join(inputs)
             logging.debug(f"user entered: {command}")
 
-            # if args is 0 then change to command uppercase
+            # the server drops clients that stay idle too long, check the connection before a new command
+            if args == 0 and session.connect() is not client:
+                client = session.comm
+                print("reconnected to server")
+                # the delta screenshots of the old connection don't apply to the new one
+                frame = None
+
+            # if args is 0 then change the command name to uppercase, options keep their case
+            name = None
             if args == 0:
-                command = command.upper()
+                name, options = split_command(command, COMMANDS + [SHOW_COMMAND])
+                command = f"{name} {options}".strip()
 
-            if command == "SHOW COMMANDS":
+            if name == SHOW_COMMAND:
                 print(VALID_COMMANDS)
 
-            elif command in COMMANDS or args != 0:
+            elif name in [STREAM_COMMAND, BATCH_COMMAND, BULK_COPY_COMMAND, SYNC_COMMAND] + TRANSFER_COMMANDS \
+                    and client.version == PROTOCOL_V1:
+                print(f"error! the server doesn't support {name}")
+
+            elif name == EXECUTE_COMMAND and "follow" in options.lower().split() and client.version != PROTOCOL_V1:
+                res = follow_job(client, [command, input("Enter path: ")])
+
+            elif name == JOB_OUTPUT_COMMAND and client.version != PROTOCOL_V1:
+                res = follow_job(client, command)
+
+            elif name == "DOWNLOAD":
+                res = download_file(client, input("Enter server path: "), input("Enter local path: "))
+
+            elif name == "UPLOAD":
+                res = upload_file(client, input("Enter local path: "), input("Enter server path: "))
+
+            elif name == BATCH_COMMAND:
+                res = run_batch(client, read_batch(), options)
+
+            elif name == BULK_COPY_COMMAND:
+                res = bulk_copy(client, read_copy_pairs(), options)
+
+            elif name == SYNC_COMMAND:
+                res = sync_directory(client, input("Enter local directory: "), input("Enter server directory: "),
+                                     options)
+
+            elif name == STREAM_COMMAND:
+                if send(client, command) == 0:
+                    frame, res = watch_stream(client, frame)
+                else:
+                    print("error! couldn't send data to server!")
+                    want_to_exit = True
+
+            elif name in COMMANDS or args != 0:
                 # we know we are sending command or receiving final response
-                if send(client, command, args) == 0:
-                    res, args = receive(client)
+                # arguments are sent as a list so the protocol picks the separator
+                if send(client, inputs if args != 0 else command, args) == 0:
+                    # long responses like listings are shown page by page as they arrive
+                    res, args = receive(client, print)
                 else:
                     print("error! couldn't send data to server!")
                     want_to_exit = True
             else:
                 print(ERR_INPUT + ' ' + VALID_COMMANDS)
 
-            if command != PHOTO_COMMAND and res is not None:
-                print(f"server: {res}")
+            # over protocol v2 images arrive as binary, text is an error message
+            if name == PHOTO_COMMAND and res is not None and \
+                    (client.version == PROTOCOL_V1 or not isinstance(res, str)):
+                frame = decode_image(res, frame)
                 res = None
 
-            elif command == PHOTO_COMMAND and res is not None:
-                decode_image(res)
+            elif res is not None:
+                print(f"server: {res}")
                 res = None
 
-            if command == STOP_SERVER_CONNECTION:
+            if name == STOP_SERVER_CONNECTION:
                 want_to_exit = True
 
     except socket.error as err:
@@ -220,14 +1369,14 @@ def main():
         # sending the EXIT command to the server
         # note: even if I didn't add this part the server would still close the socket,
         # and everything would work as expected. It's just more correct to do it this way.
-        if send(client, STOP_SERVER_CONNECTION) != 1:
+        if client is not None and send(client, STOP_SERVER_CONNECTION) != 1:
             res, args = receive(client)
             if res is not None:
                 print(f"server: {res}")
                 logging.debug(f"the server responded with {res}")
 
     finally:
-        client.close()
+        session.disconnect()
         print("client disconnected")
         logging.info("terminated client")
 
@@ -0,0 +1,389 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: a directory listing cache for the commands server, invalidated by inotify
+Date: 17/10/2026
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# define cache constants
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# rough memory cost of a cached entry on top of its path
+ENTRY_OVERHEAD = 120
+# entries validated by polling that include sizes and times are trusted for this long
+POLL_MAX_AGE = 30
+
+# define inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# events that change which entries a directory has
+STRUCTURE_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# events that only change the size or times of an entry
+CONTENT_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """
+    A minimal ctypes binding of the Linux inotify API.
+    """
+
+    def __init__(self):
+        """
+        :raises OSError: If inotify isn't available on this system.
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a directory.
+
+        :param path: The path of the directory.
+        :type path: str
+
+        :param mask: The events to watch.
+        :type mask: int
+
+        :return: The watch descriptor, the same one for every call on the same directory.
+        :rtype: int
+
+        :raises OSError: If the watch couldn't be added, e.g. when out of watches.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stop watching a directory.
+
+        :param wd: The watch descriptor.
+        :type wd: int
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """
+        Wait for events.
+
+        :param timeout: The maximum time to wait in seconds.
+        :type timeout: float
+
+        :return: The watch descriptor and mask of every event.
+        :rtype: list[tuple[int, int]]
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += INOTIFY_EVENT.size + name_len
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CachedListing:
+    """
+    A cached listing and what is needed to tell when it gets stale.
+    """
+
+    def __init__(self, entries, stamps, with_stat, size):
+        """
+        :param entries: The listed entries.
+        :type entries: list
+
+        :param stamps: The modification time of every directory scanned, taken before scanning it.
+        :type stamps: list[tuple[str, int]]
+
+        :param with_stat: The entries hold sizes and times, so content changes make them stale.
+        :type with_stat: bool
+
+        :param size: The estimated memory the listing takes.
+        :type size: int
+        """
+        self.entries = entries
+        self.stamps = stamps
+        self.with_stat = with_stat
+        self.size = size
+        self.created = time.monotonic()
+        # the inotify watches covering the listing, None if it is validated by polling
+        self.wds = None
+
+
+class ListingCache:
+    """
+    An LRU cache of directory listings with a memory cap.
+
+    Listings are invalidated by inotify events on Linux. When inotify isn't available, or the
+    system runs out of watches, a listing is validated by comparing the modification times of
+    its directories instead, which costs a stat per directory rather than a full rescan.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, use_inotify=True):
+        """
+        :param max_bytes: The estimated memory all the cached listings may take.
+        :type max_bytes: int
+
+        :param use_inotify: Use inotify if the system has it.
+        :type use_inotify: bool
+        """
+        self.max_bytes = max_bytes
+        self.listings = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # watch descriptor -> keys of the listings it covers
+        self.watched = {}
+        self.inotify = None
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as err:
+                logging.info(f"inotify isn't available, validating listings by polling: {err}")
+
+    def get(self, key):
+        """
+        Get a cached listing if it is still valid.
+
+        :param key: The listing key.
+        :type key: tuple
+
+        :return: The cached entries, None if the listing isn't cached or got stale.
+        :rtype: list or None
+        """
+        with self.lock:
+            listing = self.listings.get(key)
+            if listing is not None and listing.wds is None and not self.still_valid(listing):
+                self.remove(key)
+                listing = None
+            if listing is None:
+                self.misses += 1
+                return None
+            self.listings.move_to_end(key)
+            self.hits += 1
+            return listing.entries
+
+    def collect(self, key, entries, stamps, with_stat):
+        """
+        Pass entries through while caching them once they are all consumed.
+
+        A listing that isn't consumed to the end, or that grows above the memory cap, isn't cached.
+
+        :param key: The listing key.
+        :type key: tuple
+
+        :param entries: The entries as they are scanned.
+        :type entries: iterator
+
+        :param stamps: Filled by the scan with the modification time of every directory scanned.
+        :type stamps: list[tuple[str, int]]
+
+        :param with_stat: The entries hold sizes and times.
+        :type with_stat: bool
+
+        :return: The same entries.
+        :rtype: generator
+        """
+        collected = []
+        size = 0
+        for entry in entries:
+            if collected is not None:
+                size += len(entry[0]) + ENTRY_OVERHEAD
+                if size > self.max_bytes:
+                    collected = None
+                else:
+                    collected.append(entry)
+            yield entry
+        if collected is not None:
+            self.put(key, CachedListing(collected, stamps, with_stat, size))
+
+    def put(self, key, listing):
+        """
+        Cache a listing, evicting the least recently used ones to stay within the memory cap.
+
+        :param key: The listing key.
+        :type key: tuple
+
+        :param listing: The listing.
+        :type listing: CachedListing
+        """
+        if self.inotify is not None:
+            listing.wds = self.watch(key, listing)
+        # something may have changed while the directories were scanned
+        if not self.still_valid(listing, check_age=False):
+            self.unwatch(key, listing)
+            return
+        with self.lock:
+            if key in self.listings:
+                self.remove(key)
+            self.listings[key] = listing
+            self.size += listing.size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.listings)))
+
+    def watch(self, key, listing):
+        """
+        Add inotify watches on the directories of a listing.
+
+        :param key: The listing key.
+        :type key: tuple
+
+        :param listing: The listing.
+        :type listing: CachedListing
+
+        :return: The watch descriptors, None if some directory couldn't be watched.
+        :rtype: list[int] or None
+        """
+        wds = []
+        try:
+            for path, _ in listing.stamps:
+                wds.append(self.inotify.add_watch(path, STRUCTURE_EVENTS | CONTENT_EVENTS | IN_ONLYDIR))
+        except OSError as err:
+            logging.warning(f"can't watch {err.filename}, validating the listing by polling: {err}")
+            with self.lock:
+                for wd in wds:
+                    self.release_watch(wd, None)
+            return None
+
+        with self.lock:
+            for wd in wds:
+                self.watched.setdefault(wd, set()).add(key)
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch_events, name="dircache", daemon=True)
+                self.watcher.start()
+        return wds
+
+    def unwatch(self, key, listing):
+        """
+        Release the inotify watches of a listing.
+
+        :param key: The listing key.
+        :type key: tuple
+
+        :param listing: The listing.
+        :type listing: CachedListing
+        """
+        with self.lock:
+            for wd in listing.wds or []:
+                self.release_watch(wd, key)
+
+    def release_watch(self, wd, key):
+        """
+        Drop a listing from a watch, removing the watch once no listing uses it.
+        The lock must be held.
+
+        :param wd: The watch descriptor.
+        :type wd: int
+
+        :param key: The listing key, None if the listing never used the watch.
+        :type key: tuple or None
+        """
+        keys = self.watched.get(wd, set())
+        keys.discard(key)
+        if not keys:
+            self.watched.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def watch_events(self):
+        """
+        Invalidate listings as inotify events arrive, runs on its own thread.
+        """
+        while True:
+            for wd, mask in self.inotify.read_events(timeout=1):
+                with self.lock:
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, nothing can be trusted
+                        self.clear_locked()
+                        continue
+                    for key in list(self.watched.get(wd, ())):
+                        listing = self.listings.get(key)
+                        if listing is not None and (mask & ~CONTENT_EVENTS or listing.with_stat):
+                            self.remove(key)
+                    if mask & IN_IGNORED:
+                        self.watched.pop(wd, None)
+
+    def still_valid(self, listing, check_age=True):
+        """
+        Check by polling that none of the directories of a listing changed.
+
+        :param listing: The listing.
+        :type listing: CachedListing
+
+        :param check_age: Expire listings with sizes and times after POLL_MAX_AGE seconds.
+        :type check_age: bool
+
+        :return: True if the listing is still valid.
+        :rtype: bool
+        """
+        if check_age and listing.with_stat and time.monotonic() - listing.created > POLL_MAX_AGE:
+            return False
+        try:
+            return all(os.stat(path).st_mtime_ns == mtime for path, mtime in listing.stamps)
+        except OSError:
+            return False
+
+    def remove(self, key):
+        """
+        Remove a listing, the lock must be held.
+
+        :param key: The listing key.
+        :type key: tuple
+        """
+        listing = self.listings.pop(key)
+        self.size -= listing.size
+        for wd in listing.wds or []:
+            self.release_watch(wd, key)
+
+    def clear_locked(self):
+        """
+        Remove every listing, the lock must be held.
+        """
+        for key in list(self.listings):
+            self.remove(key)
+
+    def clear(self):
+        """
+        Remove every listing.
+        """
+        with self.lock:
+            self.clear_locked()
@@ -0,0 +1,302 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: file hashing for the commands server, parallel and cached by file identity
+Date: 17/10/2026
+"""
+import hashlib
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    # the xxhash algorithms are offered only when the package is installed
+    xxhash = None
+
+# define hash constants
+DEFAULT_ALGORITHM = "sha256"
+HASHLIB_ALGORITHMS = ["sha256", "sha512", "sha1", "md5", "blake2b", "blake2s", "sha3_256"]
+XXHASH_ALGORITHMS = ["xxh64", "xxh3_64", "xxh3_128"]
+ALGORITHMS = HASHLIB_ALGORITHMS + (XXHASH_ALGORITHMS if xxhash is not None else [])
+# hashlib releases the GIL while it hashes a chunk, so the workers really hash in parallel
+HASH_CHUNK = 4 * 1024 * 1024
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_ENTRIES = 100000
+
+HashResult = namedtuple('HashResult', ['index', 'path', 'digest', 'size', 'cached', 'error'])
+
+
+class HashCancelled(Exception):
+    """
+    Raised inside a hash when the run it belongs to is stopped.
+    """
+
+
+def new_hasher(algorithm):
+    """
+    :param algorithm: One of ALGORITHMS.
+    :type algorithm: str
+
+    :return: A new hash object, with update() and hexdigest() like the hashlib ones.
+    """
+    if algorithm in XXHASH_ALGORITHMS:
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def hash_mapped(file, size, hasher, cancelled=None):
+    """
+    Hash a whole file through a memory map, chunk by chunk.
+
+    The pages are read straight from the page cache, without copying them into a buffer first.
+    A file truncated while it is mapped makes the process fault on the missing pages, so files
+    that may be written meanwhile should be read instead, see hash_path().
+
+    :param file: The file, opened for binary reading.
+    :type file: io.BufferedReader
+
+    :param size: The size of the file, more than 0.
+    :type size: int
+
+    :param hasher: The hash object to update.
+
+    :param cancelled: Stop hashing once it is set.
+    :type cancelled: threading.Event or None
+
+    :raises OSError: If the file can't be mapped.
+    """
+    with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, HASH_CHUNK):
+                if cancelled is not None and cancelled.is_set():
+                    raise HashCancelled()
+                with view[offset:offset + HASH_CHUNK] as chunk:
+                    hasher.update(chunk)
+
+
+def hash_read(file, hasher, cancelled=None):
+    """
+    Hash a file from its current position to the end, through a buffer, chunk by chunk.
+
+    :param file: The file, opened for binary reading.
+    :type file: io.BufferedReader
+
+    :param hasher: The hash object to update.
+
+    :param cancelled: Stop hashing once it is set.
+    :type cancelled: threading.Event or None
+
+    :return: The amount of bytes hashed.
+    :rtype: int
+    """
+    total = 0
+    chunk = bytearray(HASH_CHUNK)
+    with memoryview(chunk) as view:
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                raise HashCancelled()
+            count = file.readinto(view)
+            if not count:
+                return total
+            hasher.update(view[:count])
+            total += count
+
+
+def hash_path(path, algorithm=DEFAULT_ALGORITHM, cancelled=None, mapped=False):
+    """
+    Hash a file through a buffer, or memory mapped when asked to and possible.
+
+    :param path: The path of the file.
+    :type path: str
+
+    :param algorithm: One of ALGORITHMS.
+    :type algorithm: str
+
+    :param mapped: Map the file, only safe if nothing truncates it meanwhile, see hash_mapped().
+    :type mapped: bool
+
+    :param cancelled: Stop hashing once it is set.
+    :type cancelled: threading.Event or None
+
+    :return: The hex digest and the amount of bytes hashed.
+    :rtype: tuple[str, int]
+
+    :raises OSError: If the file couldn't be read.
+    :raises HashCancelled: If `cancelled` was set before the end of the file.
+    """
+    hasher = new_hasher(algorithm)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if mapped and size:
+            try:
+                hash_mapped(file, size, hasher, cancelled)
+                return hasher.hexdigest(), size
+            except (OSError, ValueError):
+                # special files, and files that shrank, can't be mapped, read them instead
+                file.seek(0)
+                hasher = new_hasher(algorithm)
+        size = hash_read(file, hasher, cancelled)
+    return hasher.hexdigest(), size
+
+
+def plan_hashes(paths):
+    """
+    List the files to hash, every directory is replaced by the files of its tree.
+
+    :param paths: Paths of files and directories.
+    :type paths: list[str]
+
+    :return: The paths of the files, the files of every tree in sorted order.
+    :rtype: generator of str
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+class HashCache:
+    """
+    An LRU cache of digests keyed by the path, size, modification time and inode of the file.
+
+    A file that changes gets a new key, so a stale digest is never returned, it just ages out.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        """
+        :param max_entries: The number of digests kept.
+        :type max_entries: int
+        """
+        self.max_entries = max_entries
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, stat, algorithm):
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm
+
+    def get(self, key):
+        """
+        :param key: The key of the file, see key().
+        :type key: tuple
+
+        :return: The cached digest, None if the file wasn't hashed in this state.
+        :rtype: str or None
+        """
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is None:
+                self.misses += 1
+                return None
+            self.digests.move_to_end(key)
+            self.hits += 1
+            return digest
+
+    def put(self, key, digest):
+        with self.lock:
+            self.digests[key] = digest
+            self.digests.move_to_end(key)
+            while len(self.digests) > self.max_entries:
+                self.digests.popitem(last=False)
+
+
+class FileHasher:
+    """
+    Hash many files on a bounded thread pool, reading every file once at most.
+    """
+
+    def __init__(self, paths, algorithm=DEFAULT_ALGORITHM, workers=DEFAULT_WORKERS, cache=None, mapped=False):
+        """
+        :param paths: The paths of the files.
+        :type paths: list[str]
+
+        :param algorithm: One of ALGORITHMS.
+        :type algorithm: str
+
+        :param workers: The number of files hashed at the same time.
+        :type workers: int
+
+        :param cache: Digests of files hashed before, None to hash every file.
+        :type cache: HashCache or None
+
+        :param mapped: Map the files, only safe if nothing truncates them meanwhile, see hash_mapped().
+        :type mapped: bool
+        """
+        self.paths = paths
+        self.algorithm = algorithm
+        self.workers = workers
+        self.cache = cache
+        self.mapped = mapped
+        self.hashed_bytes = 0
+        self.cached_files = 0
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.started = None
+
+    def hash_one(self, index):
+        """
+        Hash a single file, runs on the worker threads.
+
+        :param index: The position of the file in the paths, starting at 1.
+        :type index: int
+
+        :return: The result of the hash.
+        :rtype: HashResult
+        """
+        path = self.paths[index - 1]
+        try:
+            if self.cancelled.is_set():
+                raise HashCancelled()
+            stat = os.stat(path)
+            key = HashCache.key(path, stat, self.algorithm)
+            digest = self.cache.get(key) if self.cache is not None else None
+            if digest is not None:
+                with self.lock:
+                    self.cached_files += 1
+                return HashResult(index, path, digest, stat.st_size, True, None)
+            digest, size = hash_path(path, self.algorithm, self.cancelled, self.mapped)
+            if self.cache is not None and size == stat.st_size:
+                self.cache.put(key, digest)
+            with self.lock:
+                self.hashed_bytes += size
+            return HashResult(index, path, digest, size, False, None)
+        except HashCancelled:
+            return HashResult(index, path, None, 0, False, "cancelled")
+        except OSError as err:
+            return HashResult(index, path, None, 0, False, err.strerror or str(err))
+
+    def run(self):
+        """
+        Hash the files, reporting them in the order of the paths.
+
+        :return: The result of every file.
+        :rtype: generator of HashResult
+        """
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash") as pool:
+            futures = [pool.submit(self.hash_one, index) for index in range(1, len(self.paths) + 1)]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                # stop the hashes still running if the consumer stopped early
+                self.cancel()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def seconds(self):
+        return time.monotonic() - self.started
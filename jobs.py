@@ -0,0 +1,275 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: background jobs for the commands server, programs that run without blocking it
+Date: 17/10/2026
+"""
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+# define job constants
+DEFAULT_MAX_JOBS = 8
+# output lines kept for every job, older lines are dropped
+MAX_OUTPUT_LINES = 10000
+# finished jobs kept for JOB STATUS, the oldest ones are forgotten
+MAX_FINISHED_JOBS = 100
+# seconds a killed program gets to exit before it is killed forcefully
+KILL_GRACE = 5
+STATUS_RUNNING = "running"
+STATUS_EXITED = "exited"
+STATUS_KILLED = "killed"
+STATUS_TIMED_OUT = "timed out"
+STDOUT = "stdout"
+STDERR = "stderr"
+
+
+class JobLimitError(Exception):
+    """
+    Raised when a job is started while the maximum number of jobs is running.
+    """
+
+
+class Job:
+    """
+    A program running in the background and the output it printed.
+    """
+
+    def __init__(self, job_id, path, timeout=None):
+        """
+        :param job_id: The id of the job.
+        :type job_id: int
+
+        :param path: The path of the program.
+        :type path: str
+
+        :param timeout: Kill the program after this many seconds, None to let it run.
+        :type timeout: float or None
+
+        :raises OSError: If the program couldn't be started.
+        """
+        self.id = job_id
+        self.path = path
+        self.timeout = timeout
+        self.status = STATUS_RUNNING
+        self.returncode = None
+        self.started = time.monotonic()
+        self.ended = None
+        # (stream, line) pairs, output[0] is line number `dropped` of the whole output
+        self.output = deque(maxlen=MAX_OUTPUT_LINES)
+        self.dropped = 0
+        self.changed = threading.Condition()
+        # a new session lets a kill reach the children the program started too
+        self.process = subprocess.Popen(path, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, start_new_session=os.name == "posix")
+        self.readers = [threading.Thread(target=self.read_stream, args=(stream, name), daemon=True)
+                        for stream, name in ((self.process.stdout, STDOUT), (self.process.stderr, STDERR))]
+        for reader in self.readers:
+            reader.start()
+
+    def read_stream(self, stream, name):
+        """
+        Collect the output of the program line by line, runs on its own thread.
+
+        :param stream: The pipe to read.
+        :type stream: io.BufferedReader
+
+        :param name: STDOUT or STDERR.
+        :type name: str
+        """
+        with stream:
+            for line in iter(stream.readline, b''):
+                with self.changed:
+                    if len(self.output) == self.output.maxlen:
+                        self.dropped += 1
+                    self.output.append((name, line.decode(errors='replace').rstrip('\r\n')))
+                    self.changed.notify_all()
+
+    def wait(self):
+        """
+        Wait for the program to exit, killing it on timeout.
+
+        :return: The exit code of the program.
+        :rtype: int
+        """
+        try:
+            self.process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            logging.warning(f"job {self.id} timed out after {self.timeout} seconds")
+            self.kill(STATUS_TIMED_OUT)
+            self.process.wait()
+        for reader in self.readers:
+            reader.join()
+        with self.changed:
+            self.returncode = self.process.returncode
+            self.ended = time.monotonic()
+            if self.status == STATUS_RUNNING:
+                self.status = STATUS_EXITED
+            self.changed.notify_all()
+        return self.returncode
+
+    def kill(self, status=STATUS_KILLED):
+        """
+        Ask the program to exit, it is killed forcefully if it is still running after KILL_GRACE seconds.
+
+        :param status: The status the job ends with.
+        :type status: str
+
+        :return: False if the program had already exited.
+        :rtype: bool
+        """
+        with self.changed:
+            if self.process.poll() is not None:
+                return False
+            self.status = status
+        self.signal(force=False)
+        timer = threading.Timer(KILL_GRACE, self.signal, kwargs={"force": True})
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def signal(self, force):
+        """
+        Signal the program and the processes it started.
+
+        :param force: Kill it instead of asking it to exit.
+        :type force: bool
+        """
+        if self.process.poll() is not None:
+            return
+        try:
+            if os.name == "posix":
+                os.killpg(self.process.pid, signal.SIGKILL if force else signal.SIGTERM)
+            elif force:
+                self.process.kill()
+            else:
+                self.process.terminate()
+        except OSError as err:
+            logging.warning(f"can't signal job {self.id}: {err}")
+
+    def read_output(self, position, timeout):
+        """
+        Get the output lines printed since a position, waiting for some if there are none yet.
+
+        :param position: The number of lines already read.
+        :type position: int
+
+        :param timeout: The maximum time to wait in seconds.
+        :type timeout: float
+
+        :return: The new lines, the position after them and the number of lines that were
+                 dropped before they could be read.
+        :rtype: tuple[list[tuple[str, str]], int, int]
+        """
+        with self.changed:
+            end = self.dropped + len(self.output)
+            if position >= end and self.ended is None:
+                self.changed.wait(timeout)
+                end = self.dropped + len(self.output)
+            skipped = max(self.dropped - position, 0)
+            position = max(position, self.dropped)
+            lines = list(itertools.islice(self.output, position - self.dropped, None))
+            return lines, end, skipped
+
+    def describe(self):
+        """
+        :return: A line describing the job, e.g. 'JOB 3 exited code=0 seconds=1.2 lines=10 /bin/ls'.
+        :rtype: str
+        """
+        with self.changed:
+            seconds = (self.ended or time.monotonic()) - self.started
+            code = f" code={self.returncode}" if self.returncode is not None else ""
+            lines = self.dropped + len(self.output)
+            return f"JOB {self.id} {self.status}{code} seconds={seconds:.1f} lines={lines} {self.path}"
+
+
+class JobManager:
+    """
+    Start programs in the background and keep track of them.
+
+    Every job has a waiter thread and a reader thread for each output stream, so programs never
+    block the threads serving the clients.
+    """
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS):
+        """
+        :param max_jobs: The maximum number of jobs running at the same time.
+        :type max_jobs: int
+        """
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.finished = deque()
+        self.running = 0
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def start(self, path, timeout=None):
+        """
+        Start a program in the background.
+
+        :param path: The path of the program.
+        :type path: str
+
+        :param timeout: Kill the program after this many seconds, None to let it run.
+        :type timeout: float or None
+
+        :return: The new job.
+        :rtype: Job
+
+        :raises JobLimitError: If max_jobs jobs are already running.
+        :raises OSError: If the program couldn't be started.
+        """
+        with self.lock:
+            if self.running >= self.max_jobs:
+                raise JobLimitError(f"{self.max_jobs} jobs are already running")
+            self.running += 1
+        try:
+            job = Job(next(self.ids), path, timeout)
+        except (OSError, ValueError):
+            with self.lock:
+                self.running -= 1
+            raise
+        with self.lock:
+            self.jobs[job.id] = job
+        threading.Thread(target=self.wait, args=(job,), name=f"job-{job.id}", daemon=True).start()
+        logging.info(f"started job {job.id}: {path}")
+        return job
+
+    def wait(self, job):
+        """
+        Wait for a job to end and release its slot, runs on its own thread.
+
+        :param job: The job.
+        :type job: Job
+        """
+        returncode = job.wait()
+        logging.info(f"job {job.id} ended: {job.status} with code {returncode}")
+        with self.lock:
+            self.running -= 1
+            self.finished.append(job.id)
+            while len(self.finished) > MAX_FINISHED_JOBS:
+                self.jobs.pop(self.finished.popleft(), None)
+
+    def get(self, job_id):
+        """
+        :param job_id: The id of the job.
+        :type job_id: int
+
+        :return: The job, None if there is no such job.
+        :rtype: Job or None
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """
+        :return: The jobs, oldest first.
+        :rtype: list[Job]
+        """
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.id)
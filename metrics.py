@@ -0,0 +1,352 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: in-process metrics for the commands server, with a Prometheus text exporter
+Date: 17/10/2026
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# define metrics constants
+PREFIX = "commands_server_"
+# upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PATH = "/metrics"
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bound of every bucket, ascending and ending with infinity.
+        :type buckets: tuple[float]
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """
+        Estimate a quantile, as the upper bound of the bucket it falls in.
+
+        :param fraction: The quantile, between 0 and 1.
+        :type fraction: float
+
+        :return: The estimate, 0 if nothing was observed.
+        :rtype: float
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0
+
+
+def format_labels(labels, extra=None):
+    """
+    :param labels: The labels as sorted (name, value) pairs.
+    :type labels: tuple
+
+    :param extra: One more label, e.g. the bucket bound of a histogram line.
+    :type extra: tuple[str, str] or None
+
+    :return: The labels in the Prometheus format, e.g. '{command="DIR"}', empty if there are none.
+    :rtype: str
+    """
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    Thread safe counters, gauges and latency histograms, each kept per set of labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        # called before rendering, to set gauges that are cheaper to read than to keep updated
+        self.collectors = []
+
+    def add_collector(self, collector):
+        """
+        Register a function that updates some metrics whenever they are rendered.
+
+        :param collector: Called with this Metrics object.
+        :type collector: callable
+        """
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as err:
+                logging.warning(f"metrics collector {collector} failed: {err}")
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increase a counter.
+
+        :param name: The name of the counter, e.g. 'bytes_sent_total'.
+        :type name: str
+
+        :param amount: The amount to add.
+        :type amount: int or float
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set a gauge to a value.
+        """
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add_gauge(self, name, amount, **labels):
+        """
+        Move a gauge up or down.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Count a value in a histogram.
+
+        :param name: The name of the histogram, e.g. 'command_seconds'.
+        :type name: str
+
+        :param value: The value, usually seconds.
+        :type value: float
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the time the with block takes in a histogram.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter_value(self, name, **labels):
+        """
+        :return: The value of a counter, 0 if it was never increased.
+        :rtype: int or float
+        """
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def counter_values(self, name):
+        """
+        :param name: The name of the counter.
+        :type name: str
+
+        :return: The labels and value of every counter with this name.
+        :rtype: list[tuple[dict, int or float]]
+        """
+        with self.lock:
+            return [(dict(labels), value) for (counter, labels), value in sorted(self.counters.items())
+                    if counter == name]
+
+    def gauge_value(self, name, **labels):
+        """
+        :return: The value of a gauge, 0 if it was never set.
+        :rtype: int or float
+        """
+        with self.lock:
+            return self.gauges.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """
+        :return: Every metric, after running the collectors, in a form that can be pickled and merged,
+                 see merge().
+        :rtype: dict
+        """
+        self.collect()
+        with self.lock:
+            histograms = {key: (histogram.buckets, list(histogram.counts), histogram.count, histogram.sum)
+                          for key, histogram in self.histograms.items()}
+            return {"started": self.started, "counters": dict(self.counters), "gauges": dict(self.gauges),
+                    "histograms": histograms}
+
+    def merge(self, snapshot, gauges=True):
+        """
+        Add the metrics of a snapshot to these, e.g. those of another process of the server.
+
+        Counters and gauges are summed and histograms are added bucket by bucket.
+
+        :param snapshot: The metrics to add, see snapshot().
+        :type snapshot: dict
+
+        :param gauges: Add the gauges too, False to add only what accumulates, like for a process that ended.
+        :type gauges: bool
+        """
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in snapshot["gauges"].items() if gauges else ():
+                self.gauges[key] = self.gauges.get(key, 0) + value
+            for key, (buckets, counts, count, total) in snapshot["histograms"].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(buckets)
+                histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+
+    def load(self, snapshot):
+        """
+        Replace every metric with those of a snapshot, at once for the threads reading them.
+
+        :param snapshot: The metrics, see snapshot().
+        :type snapshot: dict
+        """
+        loaded = Metrics()
+        loaded.merge(snapshot)
+        with self.lock:
+            self.counters = loaded.counters
+            self.gauges = loaded.gauges
+            self.histograms = loaded.histograms
+            self.started = snapshot["started"]
+
+    def render_prometheus(self):
+        """
+        :return: Every metric in the Prometheus text exposition format.
+        :rtype: str
+        """
+        self.collect()
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(bound)
+                        lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        lines.append(f"# TYPE {PREFIX}uptime_seconds gauge")
+        lines.append(f"{PREFIX}uptime_seconds {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def render_summary(self, histogram_name, label):
+        """
+        Summarize a histogram and the counters that share its label, one line per label value.
+
+        :param histogram_name: The name of the histogram, e.g. 'command_seconds'.
+        :type histogram_name: str
+
+        :param label: The label the lines are made by, e.g. 'command'.
+        :type label: str
+
+        :return: Lines like 'DIR count=12 avg=1.20ms p50<=2.5ms p99<=5ms bytes_sent_total=6012'.
+        :rtype: list[str]
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                labels = dict(labels)
+                if name != histogram_name or label not in labels:
+                    continue
+                line = f"{labels[label]} count={histogram.count} avg={histogram.sum / histogram.count * 1000:.2f}ms " \
+                       f"p50<={histogram.quantile(0.5) * 1000:g}ms p99<={histogram.quantile(0.99) * 1000:g}ms"
+                totals = {}
+                for (counter, counter_labels), value in self.counters.items():
+                    if dict(counter_labels).get(label) == labels[label]:
+                        totals[counter] = totals.get(counter, 0) + value
+                lines.append(" ".join([line] + [f"{counter}={value}" for counter, value in sorted(totals.items())]))
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics of the server the handler class is made for, see start_exporter().
+    """
+    metrics = None
+
+    def do_GET(self):
+        if self.path != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics exporter: {format % args}")
+
+
+def start_exporter(metrics, port, host="127.0.0.1"):
+    """
+    Serve the metrics in the Prometheus text format over HTTP, on a thread of its own.
+
+    :param metrics: The metrics to serve.
+    :type metrics: Metrics
+
+    :param port: The port to listen on, 0 for any free port.
+    :type port: int
+
+    :param host: The address to listen on, local only by default.
+    :type host: str
+
+    :return: The running HTTP server, call shutdown() on it to stop it.
+    :rtype: ThreadingHTTPServer
+    """
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"metrics": metrics})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"serving metrics on http://{host}:{httpd.server_address[1]}{METRICS_PATH}")
+    return httpd
@@ -0,0 +1,313 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: prefork mode of the commands server, worker processes run and restarted by a supervisor
+Date: 17/10/2026
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing.connection import wait
+
+from metrics import Metrics
+
+# define prefork constants
+# the workers are started fresh rather than forked from a supervisor that already runs threads
+START_METHOD = "spawn"
+# seconds between the metrics a worker sends up, and the merged metrics the supervisor sends back
+METRICS_INTERVAL = 1.0
+EVENT_QUEUE_SIZE = 1000
+# a worker that dies sooner than this after starting is restarted after a delay, doubled every time
+RESTART_WINDOW = 5.0
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+# seconds the workers get to finish once asked to stop, before they are terminated
+STOP_TIMEOUT = 10.0
+# the exit code of a worker that couldn't start serving, e.g. because the port is taken
+EXIT_STARTUP_FAILED = 3
+
+
+def shared_queue(size):
+    """
+    :param size: The most items the queue holds.
+    :type size: int
+
+    :return: A queue the supervisor and its workers can all use, e.g. for log records.
+    :rtype: multiprocessing.Queue
+    """
+    return multiprocessing.get_context(START_METHOD).Queue(size)
+
+
+class WorkerLink:
+    """
+    What a worker process holds of its supervisor.
+
+    A thread sends the metrics of the worker up every METRICS_INTERVAL seconds and takes the
+    supervisor's messages: the merged metrics of all the workers, a new log level, or to stop.
+    """
+
+    def __init__(self, index, events, control, log_queue):
+        """
+        :param index: The position of the worker, starting at 0.
+        :type index: int
+
+        :param events: The queue of what the workers send to the supervisor.
+        :type events: multiprocessing.Queue
+
+        :param control: The end of the pipe the supervisor writes to.
+        :type control: multiprocessing.connection.Connection
+
+        :param log_queue: The queue of the log records, see asynclog.log_to_queue().
+        :type log_queue: multiprocessing.Queue or None
+        """
+        self.index = index
+        self.events = events
+        self.control = control
+        self.log_queue = log_queue
+        # the metrics of all the workers, None until the supervisor sends them
+        self.cluster = None
+
+    def start(self, metrics, stop):
+        """
+        Start talking with the supervisor, on a thread of its own.
+
+        :param metrics: The metrics of the worker.
+        :type metrics: metrics.Metrics
+
+        :param stop: Stops the worker, called when the supervisor says so or goes away.
+        :type stop: callable
+        """
+        threading.Thread(target=self.run, args=(metrics, stop), name="supervisor", daemon=True).start()
+
+    def run(self, metrics, stop):
+        next_report = time.monotonic()
+        while True:
+            if time.monotonic() >= next_report:
+                self.send("metrics", metrics.snapshot())
+                next_report = time.monotonic() + METRICS_INTERVAL
+            try:
+                if not self.control.poll(max(0.0, next_report - time.monotonic())):
+                    continue
+                kind, value = self.control.recv()
+            except (EOFError, OSError):
+                # the supervisor is gone, a worker doesn't outlive it nor waits to flush what it can't read
+                self.events.cancel_join_thread()
+                if self.log_queue is not None:
+                    self.log_queue.cancel_join_thread()
+                kind, value = "stop", None
+            if kind == "metrics":
+                cluster = self.cluster or Metrics()
+                cluster.load(value)
+                self.cluster = cluster
+            elif kind == "level":
+                logging.getLogger().setLevel(value)
+            elif kind == "stop":
+                stop()
+                return
+
+    def send(self, kind, value):
+        """
+        Send an event to the supervisor, dropped if it is too far behind to take it.
+        """
+        try:
+            self.events.put_nowait((kind, self.index, value))
+        except queue.Full:
+            pass
+
+    def set_level(self, level):
+        """
+        Change the log level of every worker and of the supervisor.
+
+        :param level: The new level.
+        :type level: int
+        """
+        self.send("level", level)
+
+
+class Worker:
+    """
+    A worker process as the supervisor sees it.
+    """
+    __slots__ = ("process", "control", "started", "restart_at", "delay", "failed")
+
+    def __init__(self):
+        self.process = None
+        self.control = None
+        self.started = 0.0
+        # when a dead worker is due to start again, None while it runs
+        self.restart_at = None
+        self.delay = 0.0
+        # the worker last exited with EXIT_STARTUP_FAILED and hasn't served since
+        self.failed = False
+
+
+class Supervisor:
+    """
+    Run a number of worker processes, restarting the ones that die, and gather what they report.
+
+    Every worker serves clients on its own, see server.serve_worker(), so the commands spread over
+    the cores instead of sharing one interpreter lock. The workers send their metrics up, which
+    are merged into `metrics` and sent back to every worker, and log through a shared queue.
+    """
+
+    def __init__(self, target, processes, args=(), log_queue=None):
+        """
+        :param target: Runs a worker, called in the worker process with its index, its WorkerLink
+                       and `args`.
+        :type target: callable
+
+        :param processes: The number of workers.
+        :type processes: int
+
+        :param args: More arguments of the target, they must pickle.
+        :type args: tuple
+
+        :param log_queue: The queue the workers log to, see shared_queue().
+        :type log_queue: multiprocessing.Queue or None
+        """
+        self.context = multiprocessing.get_context(START_METHOD)
+        self.target = target
+        self.args = args
+        self.log_queue = log_queue
+        self.events = self.context.Queue(EVENT_QUEUE_SIZE)
+        self.workers = [Worker() for _ in range(processes)]
+        # the last metrics of every running worker, and all that the workers that ended counted
+        self.reports = {}
+        self.retired = Metrics()
+        # the supervisor's own counters, like the restarts
+        self.own = Metrics()
+        # the merged metrics of the whole server, what the exporter serves
+        self.metrics = Metrics()
+        self.running = False
+
+    def run(self):
+        """
+        Start the workers and supervise them until stop() is called or the process is interrupted.
+
+        :return: 0, or 1 if every worker failed to start serving.
+        :rtype: int
+        """
+        self.running = True
+        for index in range(len(self.workers)):
+            self.spawn(index)
+        next_merge = time.monotonic() + METRICS_INTERVAL
+        try:
+            while self.running:
+                sentinels = {worker.process.sentinel: index for index, worker in enumerate(self.workers)
+                             if worker.restart_at is None}
+                for sentinel in wait(list(sentinels), METRICS_INTERVAL / 4):
+                    self.reap(sentinels[sentinel])
+                if all(worker.failed for worker in self.workers):
+                    # nothing can serve, restarting the workers again won't change that
+                    logging.critical("every worker failed to start serving, stopping the server")
+                    return 1
+                self.read_events()
+                for index, worker in enumerate(self.workers):
+                    if worker.restart_at is not None and time.monotonic() >= worker.restart_at:
+                        self.spawn(index)
+                if time.monotonic() >= next_merge:
+                    self.merge()
+                    next_merge = time.monotonic() + METRICS_INTERVAL
+        finally:
+            self.stop()
+        return 0
+
+    def spawn(self, index):
+        """
+        Start the worker at `index`, or start it again.
+        """
+        worker = self.workers[index]
+        receiver, sender = self.context.Pipe(duplex=False)
+        link = WorkerLink(index, self.events, receiver, self.log_queue)
+        worker.process = self.context.Process(target=self.target, args=(index, link) + tuple(self.args),
+                                              name=f"worker-{index + 1}")
+        worker.process.start()
+        receiver.close()
+        worker.control = sender
+        # a restarted worker keeps the log level the clients set since the start
+        sender.send(("level", logging.getLogger().level))
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        self.own.set_gauge("workers", sum(other.restart_at is None for other in self.workers))
+        logging.info(f"started worker {index + 1}, pid {worker.process.pid}")
+
+    def reap(self, index):
+        """
+        Collect a worker that ended and plan its restart, later if it keeps dying right after starting.
+        """
+        worker = self.workers[index]
+        worker.process.join()
+        worker.control.close()
+        # keep what the worker counted, its last report is at most METRICS_INTERVAL old
+        report = self.reports.pop(index, None)
+        if report is not None:
+            self.retired.merge(report, gauges=False)
+        lived = time.monotonic() - worker.started
+        worker.failed = worker.process.exitcode == EXIT_STARTUP_FAILED
+        worker.delay = 0.0 if lived > RESTART_WINDOW else min(MAX_RESTART_DELAY, worker.delay * 2 or RESTART_DELAY)
+        worker.restart_at = time.monotonic() + worker.delay
+        self.own.inc("worker_restarts_total")
+        self.own.set_gauge("workers", sum(other.restart_at is None for other in self.workers))
+        logging.error(f"worker {index + 1} exited with code {worker.process.exitcode} after {lived:.1f}s, "
+                      f"restarting it in {worker.delay:g}s")
+
+    def read_events(self):
+        """
+        Take everything the workers sent since the last time.
+        """
+        while True:
+            try:
+                kind, index, value = self.events.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "metrics" and self.workers[index].restart_at is None:
+                # a worker reports once it listens, so it started serving
+                self.workers[index].failed = False
+                self.reports[index] = value
+            elif kind == "level":
+                logging.getLogger().setLevel(value)
+                self.broadcast("level", value)
+
+    def merge(self):
+        """
+        Merge the metrics of all the workers, for the exporter and for the STATS of every worker.
+        """
+        merged = Metrics()
+        merged.started = self.own.started
+        for report in [self.own.snapshot(), self.retired.snapshot()] + list(self.reports.values()):
+            merged.merge(report)
+        snapshot = merged.snapshot()
+        self.metrics.load(snapshot)
+        self.broadcast("metrics", snapshot)
+
+    def broadcast(self, kind, value):
+        for worker in self.workers:
+            if worker.restart_at is None:
+                try:
+                    worker.control.send((kind, value))
+                except OSError:
+                    # the worker just died, it is reaped on the next round
+                    pass
+
+    def stop(self):
+        """
+        Ask every worker to stop and wait for them, terminating the ones that don't stop in time.
+        """
+        self.running = False
+        self.broadcast("stop", None)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        alive = processes
+        while alive and time.monotonic() < deadline:
+            # keep reading the events, a worker can't exit while its last ones are stuck in the pipe
+            self.read_events()
+            wait([process.sentinel for process in alive], METRICS_INTERVAL / 4)
+            alive = [process for process in alive if process.is_alive()]
+        for process in alive:
+            logging.warning(f"{process.name} didn't stop in time, terminating it")
+            process.terminate()
+        for process in processes:
+            process.join()
+        self.events.close()
@@ -0,0 +1,1026 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: framing helpers shared by the commands server and client
+Date: 17/10/2026
+"""
+import codecs
+import hashlib
+import lzma
+import socket
+import struct
+import zlib
+from collections import namedtuple
+
+# define framing constants
+RECV_CHUNK = 64 * 1024
+FIELD_SEPARATOR = b'$'
+MAX_HEADER_FIELD = 20
+# payloads are allocated up front up to this size, bigger ones grow as their bytes arrive,
+# so a length field alone can't make the receiver allocate memory
+PREALLOCATE_LIMIT = 1024 * 1024
+
+# define protocol constants
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+NEGOTIATE_COMMAND = "PROTOCOL V2"
+# magic, frame type, number of args, request id, payload length
+V2_HEADER = struct.Struct('!BBHIQ')
+# legacy frames always start with an ascii digit, so this byte tells the versions apart
+V2_MAGIC = 0xA7
+TYPE_TEXT = 0
+TYPE_BINARY = 1
+# a text frame that is followed by more frames of the same response
+TYPE_PARTIAL = 2
+FRAME_TYPES = (TYPE_TEXT, TYPE_BINARY, TYPE_PARTIAL)
+TEXT_TYPES = (TYPE_TEXT, TYPE_PARTIAL)
+# v2 separates arguments with NUL, which unlike '$' can't appear in a path
+ARG_SEPARATORS = {PROTOCOL_V1: '$', PROTOCOL_V2: '\0'}
+
+# payload compression, the flag is set on the frame type of compressed frames
+FLAG_COMPRESSED = 0x80
+COMPRESS_COMMAND = "COMPRESS"
+# the minimum, maximum and default level of every algorithm
+COMPRESSION_LEVELS = {"zlib": (1, 9, 6), "lzma": (0, 9, 1)}
+# smaller frames, like short replies, cost more to compress than they save
+COMPRESSION_THRESHOLD = 512
+# every zlib sync flush ends with these bytes, so they are stripped before sending
+SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+# delta screenshots: magic, key frame flag, width, height, number of rectangles
+DELTA_MAGIC = b'DLTA'
+DELTA_HEADER = struct.Struct('!4s?HHI')
+# every rectangle: left, top, length of the encoded image that follows
+DELTA_RECT = struct.Struct('!HHI')
+
+# file transfers
+CHECKSUM_ALGORITHM = "sha256"
+PART_SUFFIX = ".part"
+
+# define keepalive constants
+# an idle connection is probed after this many seconds, every interval, and dropped after count failed probes
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+# the application level heartbeat, answered right away by the server
+PING_COMMAND = "PING"
+PONG_ANSWER = "PONG"
+
+Frame = namedtuple('Frame', ['version', 'frame_type', 'num_of_args', 'request_id', 'data'])
+
+
+class FrameTooLarge(ValueError):
+    """
+    Raised when a frame, or its payload once decompressed, is larger than the receiver accepts.
+    """
+
+
+class Compression:
+    """
+    Compress the text frames of a connection that are larger than a threshold.
+
+    zlib keeps one stream per direction for the whole connection and flushes it at the end of
+    every frame, so the paths and words of earlier frames serve as the dictionary of later ones.
+    The lzma module can't flush a stream without ending it, so with lzma every frame is
+    compressed on its own.
+    """
+
+    def __init__(self, algorithm="zlib", level=None, threshold=COMPRESSION_THRESHOLD):
+        """
+        :param algorithm: One of COMPRESSION_LEVELS.
+        :type algorithm: str
+
+        :param level: The compression level, None for the default of the algorithm.
+        :type level: int or None
+
+        :param threshold: Frames smaller than this many bytes are sent as they are.
+        :type threshold: int
+        """
+        self.algorithm = algorithm
+        self.level = COMPRESSION_LEVELS[algorithm][2] if level is None else level
+        self.threshold = threshold
+        if algorithm == "zlib":
+            # raw deflate, the zlib header and checksum are useless inside a frame
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self.filters = [{"id": lzma.FILTER_LZMA2, "preset": self.level}]
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse compression settings.
+
+        :param text: The settings, e.g. 'zlib level=6 threshold=512', or 'none'.
+        :type text: str
+
+        :return: The compression, None for 'none'.
+        :rtype: Compression or None
+
+        :raises ValueError: If an algorithm, a setting or a value is invalid.
+        """
+        words = text.split()
+        algorithm = words[0].lower() if words else "zlib"
+        if algorithm == "none":
+            return None
+        if algorithm not in COMPRESSION_LEVELS:
+            raise ValueError(f"unknown compression '{algorithm}'")
+        settings = {}
+        for word in words[1:]:
+            key, _, value = word.partition('=')
+            if key.lower() not in ("level", "threshold") or not value.isdigit():
+                raise ValueError(f"invalid compression setting '{word}'")
+            settings[key.lower()] = int(value)
+        lowest, highest, _ = COMPRESSION_LEVELS[algorithm]
+        if not lowest <= settings.get("level", lowest) <= highest:
+            raise ValueError(f"{algorithm} level must be between {lowest} and {highest}")
+        return cls(algorithm, settings.get("level"), settings.get("threshold", COMPRESSION_THRESHOLD))
+
+    def describe(self):
+        """
+        :return: The settings in the form parse() reads.
+        :rtype: str
+        """
+        return f"{self.algorithm} level={self.level} threshold={self.threshold}"
+
+    def compress(self, data):
+        """
+        :param data: The payload of a frame.
+        :type data: bytes
+
+        :return: The compressed payload.
+        :rtype: bytes
+        """
+        if self.algorithm == "zlib":
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            return data[:-len(SYNC_FLUSH_TAIL)]
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data, limit=None):
+        """
+        :param data: The compressed payload of a frame.
+        :type data: bytes
+
+        :param limit: The most bytes the payload may decompress to, None for no limit.
+        :type limit: int or None
+
+        :return: The payload.
+        :rtype: bytes
+
+        :raises FrameTooLarge: If the payload decompresses to more than `limit` bytes.
+        :raises ValueError: If the payload can't be decompressed.
+        """
+        stream = self.stream(limit)
+        return stream.feed(data) + stream.finish()
+
+    def stream(self, limit=None):
+        """
+        :param limit: The most bytes the payload may decompress to, None for no limit.
+        :type limit: int or None
+
+        :return: A decompressor for the payload of the next frame, fed chunk by chunk.
+        :rtype: FrameDecompressor
+        """
+        if self.algorithm == "zlib":
+            return FrameDecompressor(self.decompressor, True, limit)
+        return FrameDecompressor(lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=self.filters), False, limit)
+
+
+class FrameDecompressor:
+    """
+    Decompress the payload of one frame as its chunks arrive, stopping as soon as it grows past a limit,
+    so a small payload can't inflate into more memory than a frame may take.
+    """
+
+    def __init__(self, decompressor, sync_flushed, limit=None):
+        """
+        :param decompressor: A zlib or lzma decompressor object.
+
+        :param sync_flushed: The payload is a zlib sync flush without its tail, see Compression.compress().
+        :type sync_flushed: bool
+
+        :param limit: The most bytes the payload may decompress to, None for no limit.
+        :type limit: int or None
+        """
+        self.decompressor = decompressor
+        self.sync_flushed = sync_flushed
+        self.left = limit
+
+    def feed(self, data):
+        """
+        :param data: The next chunk of the compressed payload.
+        :type data: bytes
+
+        :return: The bytes it decompressed to.
+        :rtype: bytes
+
+        :raises FrameTooLarge: If the payload decompressed to more than the limit so far.
+        :raises ValueError: If the payload can't be decompressed.
+        """
+        try:
+            if self.left is None:
+                return self.decompressor.decompress(data)
+            # ask for one byte more than allowed, getting it means the payload is too large
+            data = self.decompressor.decompress(data, self.left + 1)
+        except (zlib.error, lzma.LZMAError) as err:
+            raise ValueError(f"can't decompress frame: {err}")
+        if len(data) > self.left:
+            raise FrameTooLarge("the frame decompresses to more than the limit")
+        self.left -= len(data)
+        return data
+
+    def finish(self):
+        """
+        :return: The last bytes of the payload.
+        :rtype: bytes
+
+        :raises ValueError: If the payload ended in the middle of the compressed stream.
+        """
+        if self.sync_flushed:
+            return self.feed(SYNC_FLUSH_TAIL)
+        if not self.decompressor.eof:
+            raise ValueError("can't decompress frame: the compressed data is truncated")
+        return b''
+
+
+class ArgumentSplitter:
+    """
+    Split a text payload into its arguments as its chunks arrive, a file-like sink for
+    FramedConnection.copy_to().
+
+    Only the arguments are kept, the payload is never held whole, neither as bytes nor as text.
+    """
+
+    def __init__(self, separator, decompressor=None):
+        """
+        :param separator: The separator of the arguments, see ARG_SEPARATORS.
+        :type separator: str
+
+        :param decompressor: Decompresses the chunks of a compressed payload, None if it isn't compressed.
+        :type decompressor: FrameDecompressor or None
+        """
+        self.separator = separator
+        self.decompressor = decompressor
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.args = []
+        # the pieces of the argument whose separator didn't arrive yet
+        self.pieces = []
+
+    def write(self, chunk):
+        data = bytes(chunk)
+        if self.decompressor is not None:
+            data = self.decompressor.feed(data)
+        self.split(self.decoder.decode(data))
+        return len(chunk)
+
+    def split(self, text):
+        parts = text.split(self.separator)
+        if len(parts) > 1:
+            self.pieces.append(parts[0])
+            parts[0] = ''.join(self.pieces)
+            self.pieces = []
+            self.args.extend(parts[:-1])
+        if parts[-1]:
+            self.pieces.append(parts[-1])
+
+    def close(self):
+        """
+        :return: The arguments.
+        :rtype: list[str]
+
+        :raises ValueError: If the payload isn't valid utf-8 or can't be decompressed.
+        """
+        if self.decompressor is not None:
+            self.split(self.decoder.decode(self.decompressor.finish()))
+        self.split(self.decoder.decode(b'', final=True))
+        self.args.append(''.join(self.pieces))
+        return self.args
+
+
+class FramedConnection:
+    """
+    A socket wrapper that reads frames through an internal receive buffer.
+
+    Data is read from the socket in large chunks into a reusable bytearray and frames are
+    parsed out of it, so a header costs no extra syscalls and a body is copied only once.
+    Bytes that belong to the next frame stay buffered for the next read.
+
+    Frames kept in memory may be limited in size, payloads streamed to a file by read_frame_to()
+    aren't, they only ever take one buffer.
+    """
+
+    def __init__(self, sock, chunk_size=RECV_CHUNK, max_frame=None):
+        """
+        :param sock: A connected socket.
+        :type sock: socket.socket
+
+        :param chunk_size: The amount of bytes requested from the socket on every read.
+        :type chunk_size: int
+
+        :param max_frame: The largest payload read into memory, in bytes once decompressed,
+                          None for no limit.
+        :type max_frame: int or None
+        """
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.max_frame = max_frame
+        self.buffer = bytearray(chunk_size)
+        # buffer[start:end] holds the received bytes that were not consumed yet
+        self.start = 0
+        self.end = 0
+        self.version = PROTOCOL_V1
+        # id of the last request received, echoed back on the responses
+        self.request_id = 0
+        # the negotiated compression of text frames, None while it is off
+        self.compression = None
+        # state the application keeps for this connection
+        self.session = {}
+        # bytes moved over the socket, read by the server metrics
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # the time to wait for a frame to start and for the socket to make progress, see set_deadlines()
+        self.idle_timeout = None
+        self.io_timeout = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.bytes_sent += sent
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+        self.idle_timeout = self.io_timeout = timeout
+
+    def set_deadlines(self, io_timeout, idle_timeout):
+        """
+        Limit how long the connection waits on the peer.
+
+        A frame may take as long as it takes to arrive, but the socket has to make progress every
+        `io_timeout` seconds, so a peer that stalls in the middle of a frame, or stops reading what
+        is sent to it, can't hold the connection forever. Waiting for the next frame to start is
+        bounded by `idle_timeout` instead, the peer may be a person typing an answer.
+
+        :param io_timeout: The seconds every read and write may block, None to wait forever.
+        :type io_timeout: float or None
+
+        :param idle_timeout: The seconds to wait for the first byte of a frame, None to wait forever.
+        :type idle_timeout: float or None
+        """
+        self.sock.settimeout(io_timeout)
+        self.io_timeout = io_timeout
+        self.idle_timeout = idle_timeout
+
+    def start_frame(self):
+        """
+        Wait for the first byte of the next frame, up to the idle timeout.
+
+        :return: True if a byte is buffered, False if the peer closed the connection.
+        :rtype: bool
+
+        :raises socket.timeout: If nothing arrived in time.
+        """
+        if self.pending() or self.idle_timeout == self.io_timeout:
+            return self.fill(1)
+        self.sock.settimeout(self.idle_timeout)
+        try:
+            return self.fill(1)
+        finally:
+            self.sock.settimeout(self.io_timeout)
+
+    def close(self):
+        self.sock.close()
+
+    def pending(self):
+        """
+        Check if there are received bytes that were not consumed yet.
+
+        :return: True if the buffer holds unread data.
+        :rtype: bool
+        """
+        return self.end > self.start
+
+    def fill(self, needed=1):
+        """
+        Read from the socket until at least `needed` unread bytes are buffered.
+
+        :param needed: The amount of unread bytes required.
+        :type needed: int
+
+        :return: True if enough bytes are buffered, False if the peer closed the connection.
+        :rtype: bool
+        """
+        while self.end - self.start < needed:
+            if self.end == len(self.buffer):
+                self.make_room(needed)
+            with memoryview(self.buffer) as view:
+                received = self.sock.recv_into(view[self.end:])
+            if received == 0:
+                return False
+            self.bytes_received += received
+            self.end += received
+        return True
+
+    def make_room(self, needed):
+        """
+        Move the unread bytes to the front of the buffer, growing it if they still don't fit.
+
+        :param needed: The amount of unread bytes the buffer has to hold.
+        :type needed: int
+        """
+        unread = self.end - self.start
+        if self.start > 0:
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+        if len(self.buffer) < max(needed, unread + 1):
+            self.buffer.extend(bytes(max(needed, unread + self.chunk_size) - len(self.buffer)))
+
+    def peek(self, size):
+        """
+        Copy `size` buffered bytes without consuming them.
+
+        :param size: The amount of bytes to copy, must already be buffered.
+        :type size: int
+
+        :return: The buffered bytes.
+        :rtype: bytes
+        """
+        with memoryview(self.buffer) as view:
+            return bytes(view[self.start:self.start + size])
+
+    def skip(self, size):
+        """
+        Drop `size` buffered bytes.
+
+        :param size: The amount of bytes to drop, must already be buffered.
+        :type size: int
+        """
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+            # don't keep a buffer that grew for one big frame around
+            if len(self.buffer) > self.chunk_size:
+                self.buffer = bytearray(self.chunk_size)
+
+    def consume(self, size):
+        """
+        Take `size` buffered bytes out of the buffer.
+
+        :param size: The amount of bytes to take, must already be buffered.
+        :type size: int
+
+        :return: The consumed bytes.
+        :rtype: bytes
+        """
+        data = self.peek(size)
+        self.skip(size)
+        return data
+
+    def read_field(self, separator=FIELD_SEPARATOR, limit=MAX_HEADER_FIELD):
+        """
+        Read a header field that ends with a separator.
+
+        :param separator: The byte that ends the field.
+        :type separator: bytes
+
+        :param limit: The maximum length of the field.
+        :type limit: int
+
+        :return: The field without the separator, None if the peer closed the connection.
+        :rtype: bytes or None
+
+        :raises ValueError: If the separator isn't found within `limit` bytes.
+        """
+        # offset from the start of the unread bytes that was already searched
+        searched = 0
+        while True:
+            index = self.buffer.find(separator, self.start + searched, self.end)
+            if index != -1:
+                field = self.consume(index - self.start)
+                self.skip(1)
+                return field
+            searched = self.end - self.start
+            if searched > limit:
+                raise ValueError("header field is too long")
+            if not self.fill(searched + 1):
+                return None
+
+    def check_length(self, length):
+        """
+        :param length: The payload length of a frame that is about to be read into memory.
+        :type length: int
+
+        :raises FrameTooLarge: If the payload is larger than max_frame.
+        """
+        if self.max_frame is not None and length > self.max_frame:
+            raise FrameTooLarge(f"the frame has {length} bytes, the limit is {self.max_frame}")
+
+    def read_exact(self, size):
+        """
+        Read exactly `size` bytes.
+
+        Whatever is buffered is copied once and the rest is received directly into the result,
+        which grows as the bytes arrive past PREALLOCATE_LIMIT instead of being allocated whole.
+
+        :param size: The amount of bytes to read.
+        :type size: int
+
+        :return: The bytes read, None if the peer closed the connection before sending them all.
+        :rtype: bytearray or None
+        """
+        buffered = min(size, self.end - self.start)
+        data = bytearray(min(size, max(buffered, PREALLOCATE_LIMIT)))
+        with memoryview(self.buffer) as view:
+            data[:buffered] = view[self.start:self.start + buffered]
+        self.skip(buffered)
+        received = buffered
+        while received < size:
+            if received == len(data):
+                # double the result, it can't be resized while a view of it is held
+                data.extend(bytes(min(len(data), size - len(data))))
+            with memoryview(data) as view:
+                count = self.sock.recv_into(view[received:])
+            if count == 0:
+                return None
+            self.bytes_received += count
+            received += count
+        return data
+
+    def read_text(self, length):
+        """
+        Read a utf-8 string of `length` characters.
+
+        :param length: The amount of characters to read.
+        :type length: int
+
+        :return: The decoded string, None if the peer closed the connection.
+        :rtype: str or None
+        """
+        # every character takes at least one byte, so `length` bytes is the minimum to read
+        if not self.fill(length):
+            return None
+        data = self.peek(length)
+        if data.isascii():
+            self.skip(length)
+            return data.decode()
+
+        # count the characters by their lead bytes, continuation bytes look like 0b10xxxxxx
+        size = 0
+        chars = 0
+        while True:
+            while self.start + size < self.end:
+                if self.buffer[self.start + size] & 0xC0 != 0x80:
+                    if chars == length:
+                        return self.consume(size).decode()
+                    chars += 1
+                size += 1
+            if chars == length and self.is_complete_char(size):
+                return self.consume(size).decode()
+            if not self.fill(size + 1):
+                return None
+
+    def is_complete_char(self, size):
+        """
+        Check if the last character in the first `size` unread bytes is complete.
+
+        :param size: The amount of unread bytes to check.
+        :type size: int
+
+        :return: True if the bytes end on a character boundary.
+        :rtype: bool
+        """
+        lead = size - 1
+        while lead > 0 and self.buffer[self.start + lead] & 0xC0 == 0x80:
+            lead -= 1
+        first = self.buffer[self.start + lead]
+        expected = 1 if first < 0x80 else 2 if first < 0xE0 else 3 if first < 0xF0 else 4
+        return size - lead >= expected
+
+    def read_frame(self):
+        """
+        Read the next frame, in whichever protocol version the peer used for it.
+
+        :return: The frame, None if the peer closed the connection.
+        :rtype: Frame or None
+
+        :raises ValueError: If the frame header is malformed.
+        """
+        if not self.start_frame():
+            return None
+        if self.buffer[self.start] == V2_MAGIC:
+            return self.read_v2_frame()
+        return self.read_legacy_frame()
+
+    def read_legacy_frame(self):
+        """
+        Read a frame of the form `args$len$data`, where len counts characters.
+
+        :return: The frame, None if the peer closed the connection.
+        :rtype: Frame or None
+
+        :raises ValueError: If the frame header is malformed.
+        """
+        num_of_args = self.read_field()
+        if num_of_args is None:
+            return None
+        data_len = self.read_field()
+        if data_len is None:
+            return None
+        # the length counts characters, so the payload may take up to 4 times as many bytes
+        self.check_length(int(data_len))
+        data = self.read_text(int(data_len))
+        if data is None:
+            return None
+        return Frame(PROTOCOL_V1, TYPE_TEXT, int(num_of_args), 0, data)
+
+    def read_v2_header(self):
+        """
+        Read the fixed size header of a v2 frame.
+
+        :return: The frame type, number of arguments, request id, payload length and whether
+                 the payload is compressed, None if the peer closed the connection.
+        :rtype: tuple or None
+
+        :raises ValueError: If the frame header is malformed.
+        """
+        if not self.fill(V2_HEADER.size):
+            return None
+        magic, frame_type, num_of_args, request_id, length = V2_HEADER.unpack(self.consume(V2_HEADER.size))
+        compressed = bool(frame_type & FLAG_COMPRESSED)
+        frame_type &= ~FLAG_COMPRESSED
+        if magic != V2_MAGIC or frame_type not in FRAME_TYPES or (compressed and frame_type not in TEXT_TYPES):
+            raise ValueError(f"malformed v2 header (magic {magic}, frame type {frame_type})")
+        self.request_id = request_id
+        return frame_type, num_of_args, request_id, length, compressed
+
+    def read_text_payload(self, length, compressed):
+        """
+        Read the payload of a text frame.
+
+        :param length: The length of the payload on the wire.
+        :type length: int
+
+        :param compressed: The payload is compressed.
+        :type compressed: bool
+
+        :return: The text, None if the peer closed the connection.
+        :rtype: str or None
+
+        :raises FrameTooLarge: If the payload is larger than max_frame.
+        :raises ValueError: If the payload is compressed without compression negotiated, or corrupted.
+        """
+        self.check_length(length)
+        if compressed and self.compression is None:
+            raise ValueError("received a compressed frame without negotiating compression")
+        data = self.read_exact(length)
+        if data is None:
+            return None
+        if compressed:
+            data = self.compression.decompress(data, self.max_frame)
+        return data.decode()
+
+    def read_args(self):
+        """
+        Read the next frame, splitting a text payload into its arguments as it arrives.
+
+        Unlike read_frame() followed by split(), only the arguments are ever held in memory, not the
+        payload as well. Legacy payloads count characters, so they are read whole before splitting.
+
+        :return: The frame, the data is the list of arguments, or a list holding the payload of a
+                 binary frame. None if the peer closed the connection.
+        :rtype: Frame or None
+
+        :raises FrameTooLarge: If the payload is larger than max_frame.
+        :raises ValueError: If the frame is malformed.
+        """
+        if not self.start_frame():
+            return None
+        if self.buffer[self.start] != V2_MAGIC:
+            frame = self.read_legacy_frame()
+            if frame is None:
+                return None
+            return frame._replace(data=frame.data.split(ARG_SEPARATORS[PROTOCOL_V1]))
+        header = self.read_v2_header()
+        if header is None:
+            return None
+        frame_type, num_of_args, request_id, length, compressed = header
+        self.check_length(length)
+        if frame_type not in TEXT_TYPES:
+            data = self.read_exact(length)
+            if data is None:
+                return None
+            return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, [data])
+        decompressor = None
+        if compressed:
+            if self.compression is None:
+                raise ValueError("received a compressed frame without negotiating compression")
+            decompressor = self.compression.stream(self.max_frame)
+        splitter = ArgumentSplitter(ARG_SEPARATORS[PROTOCOL_V2], decompressor)
+        if not self.copy_to(splitter, length):
+            return None
+        return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, splitter.close())
+
+    def read_v2_frame(self):
+        """
+        Read a frame with a fixed size binary header followed by a raw payload.
+
+        :return: The frame, None if the peer closed the connection.
+        :rtype: Frame or None
+
+        :raises ValueError: If the frame header is malformed.
+        """
+        header = self.read_v2_header()
+        if header is None:
+            return None
+        frame_type, num_of_args, request_id, length, compressed = header
+        if frame_type in TEXT_TYPES:
+            data = self.read_text_payload(length, compressed)
+        else:
+            self.check_length(length)
+            data = self.read_exact(length)
+        if data is None:
+            return None
+        return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, data)
+
+    def read_frame_to(self, file, hasher=None):
+        """
+        Read the next frame, writing a binary payload to a file instead of keeping it in memory.
+
+        :param file: The file a binary payload is written to, or any object with a write() that
+                     takes the payload chunk by chunk.
+        :type file: io.BufferedIOBase
+
+        :param hasher: A hashlib object updated with the binary payload.
+        :type hasher: hashlib._Hash or None
+
+        :return: The frame, for a binary frame the data is the number of bytes written.
+                 None if the peer closed the connection.
+        :rtype: Frame or None
+
+        :raises ValueError: If the frame header is malformed.
+        """
+        if not self.start_frame():
+            return None
+        if self.buffer[self.start] != V2_MAGIC:
+            return self.read_legacy_frame()
+        header = self.read_v2_header()
+        if header is None:
+            return None
+        frame_type, num_of_args, request_id, length, compressed = header
+        if frame_type in TEXT_TYPES:
+            data = self.read_text_payload(length, compressed)
+            if data is None:
+                return None
+            return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, data)
+        if not self.copy_to(file, length, hasher):
+            return None
+        return Frame(PROTOCOL_V2, frame_type, num_of_args, request_id, length)
+
+    def copy_to(self, file, length, hasher=None):
+        """
+        Copy `length` bytes of the stream to a file through the receive buffer.
+
+        Only one buffer worth of data is held in memory, whatever the length is.
+
+        :param file: The file to write to.
+        :type file: io.BufferedIOBase
+
+        :param length: The amount of bytes to copy.
+        :type length: int
+
+        :param hasher: A hashlib object updated with the copied bytes.
+        :type hasher: hashlib._Hash or None
+
+        :return: True if all the bytes were copied, False if the peer closed the connection.
+        :rtype: bool
+        """
+        remaining = length
+        while remaining > 0:
+            if not self.pending():
+                if not self.fill(1):
+                    return False
+            size = min(remaining, self.end - self.start)
+            with memoryview(self.buffer) as view:
+                chunk = view[self.start:self.start + size]
+                file.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                chunk.release()
+            self.skip(size)
+            remaining -= size
+        return True
+
+    def send_file(self, file, offset, count, num_of_args=0):
+        """
+        Send part of a file as a binary frame, using sendfile() where the system has it.
+
+        :param file: The file to send, opened in binary mode.
+        :type file: io.BufferedReader
+
+        :param offset: The position in the file to start from.
+        :type offset: int
+
+        :param count: The amount of bytes to send.
+        :type count: int
+
+        :param num_of_args: The number of arguments, see send() of the client and server.
+        :type num_of_args: int
+        """
+        header = V2_HEADER.pack(V2_MAGIC, TYPE_BINARY, num_of_args, self.request_id, count)
+        self.sendall(header)
+        if count > 0:
+            self.bytes_sent += self.sock.sendfile(file, offset, count)
+
+    def write_frame(self, data, num_of_args=0, request_id=None, partial=False):
+        """
+        Send a frame in the protocol version negotiated for this connection.
+
+        :param data: The text, the list of text arguments or the binary payload to send.
+        :type data: str or list[str] or bytes
+
+        :param num_of_args: The number of arguments, see send() of the client and server.
+        :type num_of_args: int
+
+        :param request_id: The request the frame answers, defaults to the last request received.
+        :type request_id: int or None
+
+        :param partial: Mark a text frame as one part of a response that continues in more frames.
+        :type partial: bool
+
+        :raises ValueError: If a binary payload or a partial frame is sent over the legacy protocol.
+        """
+        if isinstance(data, list):
+            data = ARG_SEPARATORS[self.version].join(data)
+
+        if self.version == PROTOCOL_V1:
+            if not isinstance(data, str) or partial:
+                raise ValueError("the legacy protocol can only carry whole text responses")
+            # the legacy length field counts characters, not bytes
+            self.sendall(f"{num_of_args}${len(data)}${data}".encode())
+            return
+
+        frame_type = TYPE_PARTIAL if partial else TYPE_TEXT
+        if isinstance(data, str):
+            data = data.encode()
+            if self.compression is not None and len(data) >= self.compression.threshold:
+                data = self.compression.compress(data)
+                frame_type |= FLAG_COMPRESSED
+        else:
+            # binary payloads, images and files, are sent as they are
+            frame_type = TYPE_BINARY
+        request_id = self.request_id if request_id is None else request_id
+        header = V2_HEADER.pack(V2_MAGIC, frame_type, num_of_args, request_id, len(data))
+        self.send_buffers(header, data)
+
+    def send_buffers(self, *buffers):
+        """
+        Send several buffers back to back without joining them into one.
+
+        :param buffers: The buffers to send.
+        :type buffers: bytes or bytearray or memoryview
+        """
+        if not hasattr(self.sock, "sendmsg"):
+            for buff in buffers:
+                self.sendall(buff)
+            return
+
+        views = [memoryview(buff).cast('B') for buff in buffers if len(buff) > 0]
+        while views:
+            sent = self.sock.sendmsg(views)
+            self.bytes_sent += sent
+            # drop what was sent and keep a view of the rest, nothing is copied
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
+
+
+def tune_socket(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """
+    Set up a connected socket for request and response traffic.
+
+    Nagle's algorithm is turned off, so a small frame isn't held back waiting for the ack of the
+    last one, and TCP keepalive is turned on, so a peer that vanished is noticed even when the
+    connection is idle.
+
+    :param sock: A connected TCP socket.
+    :type sock: socket.socket
+
+    :param idle: The idle seconds before the first keepalive probe.
+    :type idle: int
+
+    :param interval: The seconds between probes.
+    :type interval: int
+
+    :param count: The number of unanswered probes before the connection is dropped.
+    :type count: int
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the timing options are named differently, or missing, on some systems
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPALIVE", idle), ("TCP_KEEPINTVL", interval),
+                          ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def hash_file(file, length=None, hasher=None):
+    """
+    Hash the start of an open file in chunks.
+
+    :param file: The file to hash, read from its current position.
+    :type file: io.BufferedIOBase
+
+    :param length: The amount of bytes to hash, None to hash until the end of the file.
+    :type length: int or None
+
+    :param hasher: A hashlib object to update, a new CHECKSUM_ALGORITHM one if None.
+    :type hasher: hashlib._Hash or None
+
+    :return: The updated hashlib object.
+    :rtype: hashlib._Hash
+    """
+    hasher = hashlib.new(CHECKSUM_ALGORITHM) if hasher is None else hasher
+    chunk = bytearray(RECV_CHUNK)
+    with memoryview(chunk) as view:
+        while length is None or length > 0:
+            count = file.readinto(view if length is None else view[:min(length, len(chunk))])
+            if not count:
+                break
+            hasher.update(view[:count])
+            if length is not None:
+                length -= count
+    return hasher
+
+
+def negotiate(comm):
+    """
+    Ask the server to switch the connection to protocol v2.
+
+    The request is sent as a legacy frame, a server that doesn't know it answers with
+    an error and the connection simply stays on the legacy protocol.
+
+    :param comm: A connection to the server that is still on the legacy protocol.
+    :type comm: FramedConnection
+
+    :return: The protocol version the connection uses from now on.
+    :rtype: int
+    """
+    comm.write_frame(NEGOTIATE_COMMAND)
+    frame = comm.read_frame()
+    if frame is not None and frame.data == NEGOTIATE_COMMAND:
+        comm.version = PROTOCOL_V2
+    return comm.version
+
+
+def negotiate_compression(comm, settings="zlib"):
+    """
+    Ask the server to compress the large text frames of the connection, in both directions.
+
+    A server that doesn't know compression answers with an error and the frames simply
+    stay uncompressed.
+
+    :param comm: A connection to the server that uses protocol v2.
+    :type comm: FramedConnection
+
+    :param settings: The compression settings, see Compression.parse().
+    :type settings: str
+
+    :return: The compression the server agreed to, None if there is none.
+    :rtype: Compression or None
+    """
+    comm.write_frame(f"{COMPRESS_COMMAND} {settings}")
+    frame = comm.read_frame()
+    answer = frame.data if frame is not None and isinstance(frame.data, str) else ""
+    if answer.startswith(COMPRESS_COMMAND + ' '):
+        # the answer is read before switching, the server switched right after sending it
+        comm.compression = Compression.parse(answer[len(COMPRESS_COMMAND):])
+    return comm.compression
+
+
+def split_command(command, names):
+    """
+    Split a command line into the command name and the options written after it.
+
+    :param command: The command line, e.g. 'take screenshot format=png'.
+    :type command: str
+
+    :param names: The known command names, in uppercase.
+    :type names: list[str]
+
+    :return: The uppercase command name and the options text, keeping its case.
+    :rtype: tuple[str, str]
+    """
+    upper = command.strip().upper()
+    # try the longest names first so a name that prefixes another one doesn't win
+    for name in sorted(names, key=len, reverse=True):
+        if upper == name or upper.startswith(name + ' '):
+            return name, command.strip()[len(name):].strip()
+    return upper, ''
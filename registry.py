@@ -0,0 +1,166 @@
+"""
+Author: Yonathan Chapal
+Program name: Exc 2.7
+Description: the table of the commands the server knows, routed by name with dict lookups
+Date: 17/10/2026
+"""
+import importlib
+
+from protocol import PROTOCOL_V2
+
+# define registry constants
+# the args of a command that takes any number of arguments
+ANY_ARGS = -1
+# the function a plugin module defines to add its commands
+PLUGIN_ENTRY = "register"
+
+
+class Command:
+    """
+    A command of the server and what its requests may hold, so they are validated once, before
+    the handler runs.
+    """
+    __slots__ = ("name", "handler", "options", "args", "v2", "blocking", "streams")
+
+    def __init__(self, name, handler, options=None, args=0, v2=False, blocking=False, streams=False):
+        """
+        :param name: The name, in uppercase, e.g. 'BULK COPY'.
+        :type name: str
+
+        :param handler: Called with the client connection, the parsed options and the arguments sent
+                        in the command frame. Returns True if the client should be disconnected.
+        :type handler: callable
+
+        :param options: Parses the options written after the name, raising ValueError if they are invalid.
+                        None if the command takes no options.
+        :type options: callable or None
+
+        :param args: The number of arguments the command takes, sent in the command frame or asked for
+                     by the handler. ANY_ARGS for any number of them.
+        :type args: int
+
+        :param v2: The command requires protocol v2.
+        :type v2: bool
+
+        :param blocking: The command may wait long on the disk, the screen or other programs, so it runs
+                         on the blocking pool and doesn't hold up quick commands.
+        :type blocking: bool
+
+        :param streams: The command sends its response in many frames as it goes.
+        :type streams: bool
+        """
+        self.name = name
+        self.handler = handler
+        self.options = options
+        self.args = args
+        self.v2 = v2
+        self.blocking = blocking
+        self.streams = streams
+
+    def prepare(self, text, items, version):
+        """
+        Validate a request for the command.
+
+        :param text: The options written after the name.
+        :type text: str
+
+        :param items: The arguments sent in the command frame.
+        :type items: list[str]
+
+        :param version: The protocol version of the client.
+        :type version: int
+
+        :return: The parsed options, None if the command takes none.
+
+        :raises ValueError: With the answer for the client, if the request is invalid.
+        """
+        if text and self.options is None:
+            raise ValueError(f"{self.name} TAKES NO OPTIONS")
+        if items and self.args != ANY_ARGS and len(items) != self.args:
+            raise ValueError(f"{self.name} TAKES {self.args or 'NO'} ARGUMENTS")
+        if self.v2 and version != PROTOCOL_V2:
+            raise ValueError(f"{self.name} REQUIRES PROTOCOL V2")
+        if self.options is None:
+            return None
+        try:
+            return self.options(text)
+        except ValueError as err:
+            raise ValueError(f"INVALID OPTIONS: {err}") from err
+
+
+class CommandRegistry:
+    """
+    The commands of the server by name.
+
+    Requests are routed with a dict lookup per word count of the names instead of comparing the
+    request with every name, and plugins add commands without touching the dispatch.
+    """
+
+    def __init__(self, commands=()):
+        """
+        :param commands: The commands to start with.
+        :type commands: iterable of Command
+        """
+        self.commands = {}
+        # the most words in a name, e.g. 2 for 'TAKE SCREENSHOT'
+        self.max_words = 1
+        for command in commands:
+            self.add(command)
+
+    def add(self, command):
+        """
+        :param command: The command to add.
+        :type command: Command
+
+        :raises ValueError: If there is a command with this name already.
+        """
+        if command.name in self.commands:
+            raise ValueError(f"the command {command.name} is already registered")
+        self.commands[command.name] = command
+        self.max_words = max(self.max_words, command.name.count(' ') + 1)
+
+    def get(self, name):
+        """
+        :return: The command with this name, None if there is none.
+        :rtype: Command or None
+        """
+        return self.commands.get(name)
+
+    def names(self):
+        return list(self.commands)
+
+    def route(self, text):
+        """
+        Split a command line into the command name and the options written after it.
+
+        Same as protocol.split_command() with the names of the registry, the longest name wins.
+
+        :param text: The command line, e.g. 'take screenshot format=png'.
+        :type text: str
+
+        :return: The uppercase command name and the options text, keeping its case.
+        :rtype: tuple[str, str]
+        """
+        text = text.strip()
+        upper = text.upper()
+        words = upper.split(' ', self.max_words)
+        for count in range(min(len(words), self.max_words), 0, -1):
+            name = ' '.join(words[:count])
+            if name in self.commands:
+                return name, text[len(name):].strip()
+        return upper, ''
+
+    def load_plugin(self, module_name):
+        """
+        Import a module and let it add its commands, by calling its register() with this registry.
+
+        :param module_name: The name of the module, e.g. 'mycommands'.
+        :type module_name: str
+
+        :raises ImportError: If the module can't be imported or has no register().
+        """
+        module = importlib.import_module(module_name)
+        register = getattr(module, PLUGIN_ENTRY, None)
+        if register is None:
+            raise ImportError(f"the plugin {module_name} has no {PLUGIN_ENTRY}() function")
+        register(self)
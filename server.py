@@ -4,179 +4,1848 @@ Program name: Exc 2.7
 Description: A basic commands server
 Date: 10/11/2023
 """
+import argparse
 import base64
+import errno
+import queue
+import re
+import select
+import selectors
+import signal
 import socket
+import sys
 import logging
-import glob
+import fnmatch
+import hashlib
+import heapq
 import os
-import shutil
-import subprocess
-from PIL import ImageGrab
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import partial
+from io import BytesIO
+from itertools import islice
+from operator import itemgetter
+import time
+import numpy as np
+from PIL import Image, ImageDraw, ImageGrab
+import bulkcopy
+from asynclog import SAMPLED, AsyncLogging, Payload, log_to_queue, parse_level
+from blocksync import DeltaWriter, encode_signature, file_signature
+from bulkcopy import BulkCopy, CopyProgress, plan_tree
+from dircache import ListingCache
+from filehash import ALGORITHMS, FileHasher, HashCache, plan_hashes
+from jobs import JobLimitError, JobManager
+from metrics import Metrics, start_exporter
+from prefork import EXIT_STARTUP_FAILED, Supervisor, shared_queue
+from protocol import (CHECKSUM_ALGORITHM, COMPRESS_COMMAND, DELTA_HEADER, DELTA_MAGIC, DELTA_RECT, NEGOTIATE_COMMAND,
+                      PART_SUFFIX, PING_COMMAND, PONG_ANSWER, PROTOCOL_V1, PROTOCOL_V2, TYPE_BINARY, Compression,
+                      FrameTooLarge, FramedConnection, hash_file, split_command, tune_socket)
+from registry import ANY_ARGS, Command, CommandRegistry
 
 # define network constants
 LISTEN_IP = '0.0.0.0'
 LISTEN_PORT = 17207
-Q_LEN = 1
+Q_LEN = 64
 MAX_PACKET = 1024
+MAX_CONNECTIONS = 256
+MAX_WORKERS = 16
+# threads running the blocking commands, so they can't take all the workers from the quick ones
+MAX_BLOCKING_WORKERS = 32
+SELECT_TIMEOUT = 1
+# seconds a socket may make no progress in the middle of a frame before the client is dropped
+IO_TIMEOUT = 30
+# seconds a client may stay silent between frames, connected but idle, before it is dropped
+IDLE_TIMEOUT = 300
+# the largest request frame read into memory, uploads and sync deltas are streamed to disk whatever their size
+MAX_FRAME = 64 * 1024 * 1024
+BUSY_MESSAGE = "SERVER BUSY"
 EXCEPTED_REQUEST_TYPE = 'str'
 NO_PATH_ERROR = "no files found at path specified"
+DIR_DEFAULTS = {"recursive": False, "glob": None, "regex": None, "sort": None, "reverse": False,
+                "limit": 0, "meta": False, "files": False, "page": 500}
+DIR_CACHE_BYTES = 64 * 1024 * 1024
+# the position of each sort key in the tuples made by entry_info()
+DIR_SORT_KEYS = {"name": 0, "size": 2, "mtime": 3}
+SCREENSHOT_FORMATS = {"JPEG": "JPEG", "JPG": "JPEG", "PNG": "PNG", "WEBP": "WEBP"}
+SCREENSHOT_DEFAULTS = {"format": "JPEG", "quality": 75, "max": None, "scale": 1.0,
+                       "gray": False, "region": None, "screen": "all", "delta": False, "tile": 64}
+SYNTHETIC_SCREEN_SIZE = (1920, 1080)
+STREAM_DEFAULTS = dict(SCREENSHOT_DEFAULTS, fps=5.0, frames=0)
+MAX_STREAM_FPS = 60
+STREAM_QUEUE_LEN = 2
+STREAM_POLL_INTERVAL = 0.05
+STOP_STREAM_COMMAND = "STOP"
+BATCH_OPERATIONS = ["DIR", "DELETE", "COPY"]
+BATCH_DEFAULTS = {"parallel": 1}
+MAX_BATCH_PARALLEL = 32
+BULK_COPY_DEFAULTS = {"parallel": bulkcopy.DEFAULT_WORKERS, "tree": False, "progress": 1.0, "quiet": False}
+MAX_COPY_PARALLEL = 64
+# a timeout of 0 lets the program run until it exits
+EXECUTE_DEFAULTS = {"timeout": 0.0, "follow": False}
+MAX_JOBS = 8
+# files are read through a buffer unless mmap is asked for, a mapped file truncated by a writer kills the server
+HASH_DEFAULTS = {"algorithm": "sha256", "parallel": 4, "mmap": False}
+MAX_HASH_PARALLEL = 32
+# digest lines sent in every partial frame
+HASH_PAGE = 256
+HASH_CACHE_ENTRIES = 100000
+SYNC_DEFAULTS = {"delete": False, "checksum": False}
+# files being synced are written next to their final path with this suffix, then renamed
+SYNC_SUFFIX = ".sync"
+# modification times closer than this many seconds are the same, floats can't hold every nanosecond
+SYNC_MTIME_WINDOW = 0.001
+# report lines sent in every partial frame
+SYNC_PAGE = 256
+# commands that aren't known are counted under this name, so clients can't add metrics at will
+UNKNOWN_COMMAND_LABEL = "UNKNOWN"
+# 0 leaves the prometheus exporter off
+METRICS_PORT = 0
 
 # define log constants
 LOG_FORMAT = '%(levelname)s | %(asctime)s | %(processName)s | %(message)s'
-LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
 LOG_DIR = 'log'
 LOG_FILE = LOG_DIR + '/loggerServer.log'
+LOG_QUEUE_SIZE = 10000
+# 1 logs every frame, more logs one in this many of the records written for every frame
+LOG_SAMPLE = 1
 
+# directory listings, invalidated when the directories change
+listing_cache = ListingCache(DIR_CACHE_BYTES)
+# programs started by EXECUTE, shared by all the clients
+job_manager = JobManager(MAX_JOBS)
+# digests of the files hashed before, valid as long as the files keep their size, time and inode
+hash_cache = HashCache(HASH_CACHE_ENTRIES)
+# latencies, counters and sizes of everything the server does, read by STATS and the exporter
+metrics = Metrics()
+# the link of a prefork worker to its supervisor, None when the server runs as one process
+worker_link = None
 
-def get_file_list(path):
+
+def dir_options(text):
+    """
+    Parse and validate the options of the dir command.
+
+    :param text: The options written after the command name,
+                 e.g. 'recursive glob=*.py regex=test sort=size reverse limit=100 meta files page=200'.
+    :type text: str
+
+    :return: The dir options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
+    """
+    options = dict(DIR_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key not in options:
+            raise ValueError(f"unknown option '{key}'")
+        if key in ("recursive", "reverse", "meta", "files"):
+            value = value is True or str(value).lower() in ("1", "yes", "true")
+        elif value is True:
+            raise ValueError(f"option '{key}' needs a value")
+        elif key == "regex":
+            try:
+                value = re.compile(value)
+            except re.error as err:
+                raise ValueError(f"invalid regex: {err}")
+        elif key == "sort":
+            value = value.lower()
+            if value not in DIR_SORT_KEYS:
+                raise ValueError(f"sort must be one of {', '.join(DIR_SORT_KEYS)}")
+        elif key in ("limit", "page"):
+            value = int(value)
+            if value < 0 or (key == "page" and value == 0):
+                raise ValueError(f"invalid {key} {value}")
+        options[key] = value
+    return options
+
+
+def scan_directory(path, options, stamps=None):
+    """
+    Walk a directory with os.scandir and yield the entries that pass the filters.
+
+    Directories are walked with an explicit stack, so deep trees don't hit the recursion
+    limit, and entries are yielded as they are found instead of being collected first.
+
+    :param path: The path of the directory.
+    :type path: str
+
+    :param options: The dir options, see dir_options().
+    :type options: dict
+
+    :param stamps: Filled with every directory scanned and its modification time before the scan.
+    :type stamps: list or None
+
+    :return: The matching entries and whether each one is a directory.
+    :rtype: generator of tuple[os.DirEntry, bool]
+    """
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        try:
+            if stamps is not None:
+                stamps.append((current, os.stat(current).st_mtime_ns))
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    # the entry type comes with the directory listing, it costs no extra stat
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if is_dir and options["recursive"]:
+                        pending.append(entry.path)
+                    if is_dir and options["files"]:
+                        continue
+                    if options["glob"] is not None and not fnmatch.fnmatch(entry.name, options["glob"]):
+                        continue
+                    if options["regex"] is not None and not options["regex"].search(entry.path):
+                        continue
+                    yield entry, is_dir
+        except OSError as err:
+            logging.warning(f"can't list directory {current}: {err}")
+
+
+def entry_info(entry, is_dir, with_stat):
+    """
+    Turn a directory entry into a small tuple that is cheap to keep and sort.
+
+    :param entry: The directory entry.
+    :type entry: os.DirEntry
+
+    :param is_dir: Whether the entry is a directory.
+    :type is_dir: bool
+
+    :param with_stat: Fetch the size and modification time, which may cost a stat call.
+    :type with_stat: bool
+
+    :return: The path, whether it is a directory, its size and its modification time.
+    :rtype: tuple[str, bool, int, float]
+    """
+    size = mtime = 0
+    if with_stat:
+        try:
+            # DirEntry caches the result, on Windows it even comes with the listing
+            stat = entry.stat(follow_symlinks=False)
+            size, mtime = stat.st_size, stat.st_mtime
+        except OSError as err:
+            logging.warning(f"can't stat {entry.path}: {err}")
+    return entry.path.replace("\\", "/"), is_dir, size, mtime
+
+
+def list_entries(path, options):
+    """
+    List a directory according to the dir options.
+
+    Without sorting the entries are yielded as soon as they are scanned. Sorting with a limit
+    keeps only the best `limit` entries in memory. Complete listings are kept in listing_cache,
+    so listing the same directory again doesn't touch the disk until it changes.
+
+    :param path: The path of the directory.
+    :type path: str
+
+    :param options: The dir options, see dir_options().
+    :type options: dict
+
+    :return: The entries, see entry_info().
+    :rtype: iterator of tuple[str, bool, int, float]
+    """
+    with_stat = options["meta"] or options["sort"] in ("size", "mtime")
+    root = os.path.normpath(os.path.abspath(path))
+    key = (root, options["recursive"], options["files"], options["glob"], with_stat)
+    relative = listing_cache.get(key)
+    if relative is None:
+        # scan the directory, the listing is cached if it is consumed to the end. It holds the paths
+        # relative to the directory, so every spelling of the directory and every regex share it
+        stamps = []
+        skip = len(os.path.join(root, ""))
+        scanned = (entry_info(entry, is_dir, with_stat)
+                   for entry, is_dir in scan_directory(root, dict(options, regex=None), stamps))
+        relative = listing_cache.collect(key, ((info[0][skip:],) + info[1:] for info in scanned), stamps, with_stat)
+    entries = ((os.path.join(path, info[0]).replace("\\", "/"),) + info[1:] for info in relative)
+    if options["regex"] is not None:
+        # filter the paths as the client spelled them
+        entries = (info for info in entries if options["regex"].search(info[0]))
+    if options["sort"] is None:
+        return islice(entries, options["limit"] or None)
+
+    key = itemgetter(DIR_SORT_KEYS[options["sort"]])
+    if options["limit"]:
+        select_entries = heapq.nlargest if options["reverse"] else heapq.nsmallest
+        return iter(select_entries(options["limit"], entries, key=key))
+    return iter(sorted(entries, key=key, reverse=options["reverse"]))
+
+
+def format_entry(info, meta):
+    """
+    Format a directory entry as a line of the listing.
+
+    :param info: The entry, see entry_info().
+    :type info: tuple[str, bool, int, float]
+
+    :param meta: Include the size and the modification time.
+    :type meta: bool
+
+    :return: The formatted line, directories end with '/'.
+    :rtype: str
+    """
+    path, is_dir, size, mtime = info
+    line = path + '/' if is_dir else path
+    if meta:
+        modified = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+        line = f"{size:>14} {modified} {line}"
+    return line
+
+
+def get_file_list(path, options=None):
+    """
+    Get the listing of the specified directory as a single string.
+
+    :param path: The path of the directory.
+    :type path: str
+
+    :param options: The dir options, see dir_options(), None for the defaults.
+    :type options: dict or None
+
+    :return: One line per entry, or NO_PATH_ERROR if nothing was found.
+    :rtype: str
+    """
+    options = DIR_DEFAULTS if options is None else options
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    lines = [format_entry(info, options["meta"]) for info in list_entries(path, options)]
+
+    # Set the return value and log warning if no files were found
+    str1 = '\n'.join(lines) if len(lines) > 0 \
+        else logging.warning(f"no files found at path: '{path}'") or NO_PATH_ERROR
+    return str1
+
+
+def stream_file_list(conn, options, path):
+    """
+    Send the listing of a directory in pages, so the client can show it while it is scanned.
+
+    Every page is a partial text frame, the listing ends with a text frame holding the number
+    of entries.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param options: The dir options, see dir_options().
+    :type options: dict
+
+    :param path: The path of the directory.
+    :type path: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    count = 0
+    page = []
+    for info in list_entries(path, options):
+        page.append(format_entry(info, options["meta"]))
+        count += 1
+        if len(page) == options["page"]:
+            return_code = send(conn, '\n'.join(page), partial=True)
+            if return_code != 0:
+                return return_code
+            page.clear()
+    if page:
+        return_code = send(conn, '\n'.join(page), partial=True)
+        if return_code != 0:
+            return return_code
+
+    if count == 0:
+        logging.warning(f"no files found at path: '{path}'")
+        return send(conn, NO_PATH_ERROR)
+    return send(conn, f"END OF LIST: {count} entries")
+
+
+def delete_file(path):
+    """
+    Delete a file at the specified path.
+
+    :param path: The path of the file to be deleted.
+    :type path: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    return_code = 0
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    try:
+        os.remove(path)
+        # Signal removal as successful
+    except OSError as err:
+        logging.error(f"error while trying to delete file at {path}: {err}")
+        # Return error code
+        return_code = err.args[0]
+
+    return return_code
+
+
+def copy_file(src, dest):
+    """
+    Copy a file from source to destination.
+
+    :param src: The source path of the file.
+    :type src: str
+
+    :param dest: The destination path for the copied file.
+    :type dest: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    return_code = 0
+    # Ensure the paths are using only /
+    src = src.replace("\\", "/")
+    dest = dest.replace("\\", "/")
+    try:
+        bulkcopy.copy_file(src, dest)
+        # Signal copy as successful
+    except OSError as err:
+        logging.error(f"error while trying to copy file from {src} to {dest}: {err}")
+        # Return error code
+        return_code = err.args[0]
+
+    return return_code
+
+
+def bulk_copy_options(text):
+    """
+    Parse and validate the options of the bulk copy command.
+
+    :param text: The options written after the command name, e.g. 'tree parallel=16 progress=0.5 quiet'.
+    :type text: str
+
+    :return: The bulk copy options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
+    """
+    options = dict(BULK_COPY_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key not in options:
+            raise ValueError(f"unknown option '{key}'")
+        if key in ("tree", "quiet"):
+            value = value is True or str(value).lower() in ("1", "yes", "true")
+        elif value is True:
+            raise ValueError(f"option '{key}' needs a value")
+        elif key == "parallel":
+            value = int(value)
+            if not 1 <= value <= MAX_COPY_PARALLEL:
+                raise ValueError(f"parallel must be between 1 and {MAX_COPY_PARALLEL}")
+        else:
+            value = float(value)
+            if value < 0:
+                raise ValueError("progress must be positive, or 0 to turn it off")
+        options[key] = value
+    return options
+
+
+def copy_rate(size, seconds):
+    """
+    :return: The throughput of a copy in MiB/s.
+    :rtype: float
+    """
+    return size / max(seconds, 1e-6) / (1024 * 1024)
+
+
+def bulk_copy(conn, paths, options):
+    """
+    Copy many files, or whole trees, in parallel and report the progress as it goes.
+
+    Every copied file is reported in a partial frame starting with its position in the copy,
+    the overall progress is reported every few seconds, and the copy ends with a text frame
+    summing it up.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param paths: Pairs of source and destination paths, one after the other.
+    :type paths: list[str]
+
+    :param options: The bulk copy options, see bulk_copy_options().
+    :type options: dict
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    pairs = []
+    for src, dest in zip(paths[::2], paths[1::2]):
+        # Ensure the paths are using only /
+        src = src.replace("\\", "/")
+        dest = dest.replace("\\", "/")
+        if options["tree"] and os.path.isdir(src):
+            try:
+                pairs.extend(plan_tree(src, dest))
+            except OSError as err:
+                logging.error(f"error while trying to copy tree from {src} to {dest}: {err}")
+                return send(conn, f"SOMETHING WENT WRONG! ({err})")
+        else:
+            pairs.append((src, dest))
+
+    copier = BulkCopy(pairs, options["parallel"])
+    return_code = send(conn, f"COPYING {len(pairs)} files, {copier.total_bytes} bytes", partial=True)
+    failed = 0
+    results = copier.run(options["progress"] or None)
+    for result in results:
+        if return_code != 0:
+            break
+        if isinstance(result, CopyProgress):
+            rate = copy_rate(result.bytes_done, result.seconds)
+            message = f"PROGRESS: {result.files_done}/{result.files} files, " \
+                      f"{result.bytes_done}/{result.bytes} bytes, {rate:.1f} MiB/s"
+        elif result.error is not None:
+            logging.error(f"error while trying to copy file from {result.src} to {result.dest}: {result.error}")
+            failed += 1
+            message = f"{result.index} FAILED {result.src}: {result.error}"
+        elif options["quiet"]:
+            continue
+        else:
+            message = f"{result.index} COPIED {result.src} -> {result.dest}: {result.size} bytes, " \
+                      f"{copy_rate(result.size, result.seconds):.1f} MiB/s, {result.method}"
+        return_code = send(conn, message, partial=True)
+    if return_code != 0:
+        # the client is gone, stop the copies still running
+        results.close()
+        return return_code
+
+    done = copier.snapshot()
+    return send(conn, f"END OF COPY: {done.files} files, {failed} failed, {done.bytes_done} bytes in "
+                      f"{done.seconds:.2f}s, {copy_rate(done.bytes_done, done.seconds):.1f} MiB/s")
+
+
+def hash_options(text):
+    """
+    Parse and validate the options of the hash command.
+
+    :param text: The options written after the command name, e.g. 'algorithm=blake2b parallel=8'.
+    :type text: str
+
+    :return: The hash options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
+    """
+    options = dict(HASH_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key == "algorithm":
+            if value is True or value.lower() not in ALGORITHMS:
+                raise ValueError(f"algorithm must be one of {', '.join(ALGORITHMS)}")
+            options[key] = value.lower()
+        elif key == "parallel":
+            value = int(value) if value is not True else 0
+            if not 1 <= value <= MAX_HASH_PARALLEL:
+                raise ValueError(f"parallel must be between 1 and {MAX_HASH_PARALLEL}")
+            options[key] = value
+        elif key == "mmap" and value is True:
+            options[key] = True
+        else:
+            raise ValueError(f"unknown option '{key}'")
+    return options
+
+
+def hash_files(conn, options, *paths):
+    """
+    Hash files, or every file of directory trees, in one pass over the data.
+
+    Every file gets a line like the ones of sha256sum, '<digest>  <path>', so the client can check
+    many copies with a single request. Over protocol v2 the lines are sent in pages as the files
+    are hashed, and the response ends with a text frame summing it up.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param options: The hash options, see hash_options().
+    :type options: dict
+
+    :param paths: Paths of files and directories.
+    :type paths: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    # Ensure the paths are using only /
+    paths = [path.replace("\\", "/") for path in paths]
+    try:
+        files = list(plan_hashes(paths))
+    except OSError as err:
+        logging.error(f"error while trying to list the files to hash: {err}")
+        return send(conn, f"SOMETHING WENT WRONG! ({err})")
+
+    hasher = FileHasher(files, options["algorithm"], options["parallel"], hash_cache, options["mmap"])
+    lines = []
+    failed = 0
+    return_code = 0
+    results = hasher.run()
+    for result in results:
+        if result.error is not None:
+            logging.error(f"error while trying to hash file at {result.path}: {result.error}")
+            failed += 1
+            lines.append(f"FAILED {result.path}: {result.error}")
+        else:
+            lines.append(f"{result.digest}  {result.path}")
+        if conn.version == PROTOCOL_V2 and len(lines) == HASH_PAGE:
+            return_code = send(conn, '\n'.join(lines), partial=True)
+            lines.clear()
+            if return_code != 0:
+                # the client is gone, stop the hashes still running
+                results.close()
+                return return_code
+
+    seconds = hasher.seconds()
+    summary = f"END OF HASH: {len(files)} files, {failed} failed, {hasher.cached_files} cached, " \
+              f"{hasher.hashed_bytes} bytes hashed in {seconds:.2f}s, " \
+              f"{copy_rate(hasher.hashed_bytes, seconds):.1f} MiB/s, {options['algorithm']}"
+    if conn.version == PROTOCOL_V2:
+        if lines:
+            return_code = send(conn, '\n'.join(lines), partial=True)
+        return return_code or send(conn, summary)
+    # legacy clients get the whole response at once
+    return send(conn, '\n'.join(lines + [summary]))
+
+
+def execute_options(text):
+    """
+    Parse and validate the options of the execute command.
+
+    :param text: The options written after the command name, e.g. 'timeout=30 follow'.
+    :type text: str
+
+    :return: The execute options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
+    """
+    options = dict(EXECUTE_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key not in options:
+            raise ValueError(f"unknown option '{key}'")
+        if key == "follow":
+            value = value is True or str(value).lower() in ("1", "yes", "true")
+        elif value is True:
+            raise ValueError(f"option '{key}' needs a value")
+        else:
+            value = float(value)
+            if value < 0:
+                raise ValueError("timeout must be positive, or 0 to let the program run")
+        options[key] = value
+    return options
+
+
+def execute_program(conn, options, path):
+    """
+    Start a program at the specified path in the background.
+
+    The client gets the id of the job right away. With the follow option the output of the
+    program is streamed to the client too, see follow_job().
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param options: The execute options, see execute_options().
+    :type options: dict
+
+    :param path: The path of the program to be executed.
+    :type path: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    try:
+        job = job_manager.start(path, options["timeout"] or None)
+    except JobLimitError as err:
+        logging.warning(f"can't execute program at {path}: {err}")
+        return send(conn, f"JOB LIMIT REACHED: {err}")
+    except (OSError, ValueError) as err:
+        logging.error(f"os error while trying to execute program at {path}: {err}")
+        return err.args[0]
+
+    if not options["follow"]:
+        return send(conn, f"JOB {job.id} STARTED")
+    return_code = send(conn, f"JOB {job.id} STARTED", partial=True)
+    if return_code != 0:
+        return return_code
+    return follow_job(conn, job)
+
+
+def follow_job(conn, job):
+    """
+    Send the output of a job as it is printed, until the job ends or the client detaches.
+
+    The output is sent in partial frames, lines the program printed to stderr start with
+    '[stderr] '. The client detaches by sending any frame, the job keeps running. The stream
+    ends with a text frame describing the job.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param job: The job.
+    :type job: jobs.Job
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    position = 0
+    while True:
+        if conn.pending() or select.select([conn], [], [], 0)[0]:
+            conn.read_frame()
+            return send(conn, f"JOB {job.id} DETACHED, IT KEEPS RUNNING")
+        lines, position, skipped = job.read_output(position, STREAM_POLL_INTERVAL)
+        if not lines and job.ended is not None:
+            break
+        text = [f"[{skipped} lines dropped]"] if skipped else []
+        text.extend(line if stream == "stdout" else f"[stderr] {line}" for stream, line in lines)
+        if text:
+            return_code = send(conn, '\n'.join(text), partial=True)
+            if return_code != 0:
+                return return_code
+    return send(conn, job.describe())
+
+
+def handle_job(conn, req, text):
+    """
+    Handle the commands that inspect and control jobs.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param req: JOB STATUS, JOB OUTPUT or JOB KILL.
+    :type req: str
+
+    :param text: The job id, optional for JOB STATUS.
+    :type text: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    if req == "JOB STATUS" and not text:
+        jobs = job_manager.list()
+        return send(conn, '\n'.join(job.describe() for job in jobs) if jobs else "NO JOBS")
+    job = job_manager.get(int(text)) if text.isdigit() else None
+    if job is None:
+        return send(conn, f"NO SUCH JOB: {text}")
+
+    if req == "JOB STATUS":
+        return send(conn, job.describe())
+    if req == "JOB KILL":
+        return send(conn, f"JOB {job.id} KILLED" if job.kill() else f"JOB {job.id} HAS ALREADY ENDED")
+    if conn.version == PROTOCOL_V2:
+        return follow_job(conn, job)
+    # legacy clients can't be streamed to, they get the output printed so far
+    lines, _, skipped = job.read_output(0, 0)
+    text = [f"[{skipped} lines dropped]"] if skipped else []
+    text.extend(line if stream == "stdout" else f"[stderr] {line}" for stream, line in lines)
+    return send(conn, '\n'.join(text + [job.describe()]))
+
+
+def grab_screen(bbox=None, all_screens=True):
+    """
+    Capture the screen using PIL.
+
+    :param bbox: The region to capture (left, top, right, bottom), None for everything.
+    :type bbox: tuple or None
+
+    :param all_screens: Capture all the screens or only the primary one.
+    :type all_screens: bool
+
+    :return: The captured image.
+    :rtype: PIL.Image.Image
+    """
+    return ImageGrab.grab(bbox=bbox, all_screens=all_screens)
+
+
+def synthetic_capture(bbox=None, all_screens=True):
+    """
+    Generate a fake screen, used to run the server on a headless machine.
+
+    The image has a fixed gradient background and a square that moves every second.
+
+    :param bbox: The region to capture (left, top, right, bottom), None for everything.
+    :type bbox: tuple or None
+
+    :param all_screens: Ignored, the fake machine has a single screen.
+    :type all_screens: bool
+
+    :return: The generated image.
+    :rtype: PIL.Image.Image
+    """
+    width, height = SYNTHETIC_SCREEN_SIZE
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    left = int(time.time()) * 97 % (width - 100)
+    draw.rectangle((left, height // 3, left + 100, height // 3 + 100), fill=(200, 40, 40))
+    if bbox is not None:
+        image = image.crop(bbox)
+    return image
+
+
+# the function used to capture the screen, replaced by set_capture_source()
+capture_source = grab_screen
+
+
+def set_capture_source(source):
+    """
+    Replace the function used to capture the screen.
+
+    :param source: A function with the signature of grab_screen().
+    :type source: callable
+    """
+    global capture_source
+    capture_source = source
+
+
+def parse_options(text):
+    """
+    Parse command options of the form 'key=value flag ...'.
+
+    :param text: The options written after the command name.
+    :type text: str
+
+    :return: The options, flags are mapped to True.
+    :rtype: dict
+    """
+    options = {}
+    for word in text.split():
+        key, has_value, value = word.partition('=')
+        options[key.lower()] = value if has_value else True
+    return options
+
+
+def screenshot_options(text, defaults=None):
+    """
+    Parse and validate the options of the screenshot and stream commands.
+
+    :param text: The options written after the command name,
+                 e.g. 'format=png quality=60 max=1280 scale=0.5 gray region=0,0,800,600 screen=primary'.
+    :type text: str
+
+    :param defaults: The options the command accepts and their defaults, SCREENSHOT_DEFAULTS if None.
+    :type defaults: dict or None
+
+    :return: The screenshot options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
+    """
+    options = dict(SCREENSHOT_DEFAULTS if defaults is None else defaults)
+    for key, value in parse_options(text).items():
+        if key not in options:
+            raise ValueError(f"unknown option '{key}'")
+        if key in ("gray", "delta"):
+            value = value is True or str(value).lower() in ("1", "yes", "true")
+        elif value is True:
+            raise ValueError(f"option '{key}' needs a value")
+        elif key == "format":
+            if value.upper() not in SCREENSHOT_FORMATS:
+                raise ValueError(f"unsupported format '{value}'")
+            value = SCREENSHOT_FORMATS[value.upper()]
+        elif key == "quality":
+            value = int(value)
+            if not 1 <= value <= 100:
+                raise ValueError("quality must be between 1 and 100")
+        elif key in ("max", "tile"):
+            value = int(value)
+            if value < 1:
+                raise ValueError(f"{key} must be positive")
+        elif key == "scale":
+            value = float(value)
+            if not 0 < value <= 1:
+                raise ValueError("scale must be in (0, 1]")
+        elif key == "region":
+            value = tuple(int(x) for x in value.split(','))
+            if len(value) != 4 or value[0] >= value[2] or value[1] >= value[3]:
+                raise ValueError("region must be left,top,right,bottom")
+        elif key == "screen":
+            value = value.lower()
+            if value not in ("all", "primary"):
+                raise ValueError("screen must be 'all' or 'primary'")
+        elif key == "fps":
+            value = float(value)
+            if not 0 < value <= MAX_STREAM_FPS:
+                raise ValueError(f"fps must be in (0, {MAX_STREAM_FPS}]")
+        elif key == "frames":
+            value = int(value)
+            if value < 0:
+                raise ValueError("frames can't be negative")
+        options[key] = value
+    return options
+
+
+def capture(options):
+    """
+    Capture the screen and scale it down according to the screenshot options.
+
+    :param options: The screenshot options, see screenshot_options().
+    :type options: dict
+
+    :return: The captured image.
+    :rtype: PIL.Image.Image
+    """
+    image = capture_source(bbox=options["region"], all_screens=options["screen"] == "all")
+    if options["gray"]:
+        image = image.convert('L')
+
+    width, height = image.size
+    factor = options["scale"]
+    if options["max"] is not None:
+        factor = min(factor, options["max"] / max(width, height))
+    if factor < 1:
+        reduce_by = 1 / factor
+        if reduce_by == int(reduce_by):
+            # reduce() averages whole blocks and is much faster than resampling
+            image = image.reduce(int(reduce_by))
+        else:
+            image = image.resize((max(1, int(width * factor)), max(1, int(height * factor))),
+                                 Image.BILINEAR)
+    return image
+
+
+def encode_image(image, options):
+    """
+    Encode an image according to the screenshot options.
+
+    :param image: The image to encode.
+    :type image: PIL.Image.Image
+
+    :param options: The screenshot options, see screenshot_options().
+    :type options: dict
+
+    :return: The encoded image.
+    :rtype: memoryview
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    params = {}
+    if options["format"] in ("JPEG", "WEBP"):
+        params["quality"] = options["quality"]
+    encoded = BytesIO()
+    image.save(encoded, options["format"], **params)
+    # a view of the encoded bytes, sent as is without copying them
+    return encoded.getbuffer()
+
+
+def changed_tiles(previous, current, tile):
+    """
+    Find the tiles that differ between two frames.
+
+    :param previous: The previous frame, shaped (height, width, channels).
+    :type previous: numpy.ndarray
+
+    :param current: The current frame, with the same shape.
+    :type current: numpy.ndarray
+
+    :param tile: The size of a tile's side in pixels.
+    :type tile: int
+
+    :return: A boolean grid, True for every tile that changed.
+    :rtype: numpy.ndarray
+    """
+    height, width, channels = current.shape
+    rows, cols = -(-height // tile), -(-width // tile)
+    # pad the edges so the frame splits into whole tiles, then compare all tiles at once
+    padding = ((0, rows * tile - height), (0, cols * tile - width), (0, 0))
+    diff = np.pad(previous != current, padding)
+    return diff.reshape(rows, tile, cols, tile, channels).any(axis=(1, 3, 4))
+
+
+def encode_delta(session, image, options):
+    """
+    Encode only the parts of an image that changed since the last one encoded for the session.
+
+    Adjacent changed tiles in a row are merged into one rectangle and every rectangle is
+    encoded separately. The first frame, or one whose size or mode changed, is a key frame
+    holding the whole image.
+
+    :param session: The state kept for the connection, holds the previous frame.
+    :type session: dict
+
+    :param image: The image to encode.
+    :type image: PIL.Image.Image
+
+    :param options: The screenshot options, see screenshot_options().
+    :type options: dict
+
+    :return: The encoded delta.
+    :rtype: bytes
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    current = np.asarray(image)
+    if current.ndim == 2:
+        current = current[:, :, np.newaxis]
+    previous = session.get("delta_frame")
+    key_frame = previous is None or previous.shape != current.shape
+    tile = options["tile"]
+
+    rects = []
+    if key_frame:
+        rects.append((0, 0, image.width, image.height))
+    else:
+        changed = changed_tiles(previous, current, tile)
+        for row, cols in enumerate(changed):
+            # turn every run of changed tiles into a single rectangle
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], cols.view(np.int8), [0]))))
+            for first, last in zip(edges[::2], edges[1::2]):
+                rects.append((first * tile, row * tile,
+                              min(last * tile, image.width), min((row + 1) * tile, image.height)))
+
+    parts = [DELTA_HEADER.pack(DELTA_MAGIC, key_frame, image.width, image.height, len(rects))]
+    for rect in rects:
+        encoded = encode_image(image.crop(rect), options)
+        parts.append(DELTA_RECT.pack(rect[0], rect[1], len(encoded)))
+        parts.append(encoded)
+    session["delta_frame"] = current
+    logging.debug("delta screenshot with %d rectangles, key frame: %s", len(rects), key_frame, extra=SAMPLED)
+    return b''.join(parts)
+
+
+def delta_screenshot(session, options):
+    """
+    Capture a screenshot and encode only the parts that changed since the last one.
+
+    :param session: The state kept for the connection, holds the previous frame.
+    :type session: dict
+
+    :param options: The screenshot options, see screenshot_options().
+    :type options: dict
+
+    :return: the encoded delta if successful, None otherwise.
+    :rtype: bytes or None
+    """
+    return_value = None
+    try:
+        return_value = encode_delta(session, capture(options), options)
+    except OSError as err:
+        logging.error(f"os error while trying to take a screenshot: {err}")
+        return_value = None
+
+    return return_value
+
+
+def screenshot(options=None):
+    """
+    Capture a screenshot and encode it in memory.
+
+    :param options: The screenshot options, see screenshot_options(), None for the defaults.
+    :type options: dict or None
+
+    :return: the encoded image if successful, None otherwise.
+    :rtype: memoryview or None
+    """
+    return_value = None
+    options = SCREENSHOT_DEFAULTS if options is None else options
+    try:
+        return_value = encode_image(capture(options), options)
+    except OSError as err:
+        logging.error(f"os error while trying to take a screenshot: {err}")
+        # Return error code
+        return_value = None
+
+    return return_value
+
+
+def capture_frames(options, frames, stop):
+    """
+    Capture the screen at the stream frame rate, runs on its own thread.
+
+    Only the newest frames are kept, when the queue is full the oldest frame is dropped so a
+    slow client always gets a fresh frame instead of a backlog of stale ones.
+
+    :param options: The stream options, see screenshot_options().
+    :type options: dict
+
+    :param frames: The queue the captured images are put in, a captured OSError ends the stream.
+    :type frames: queue.Queue
+
+    :param stop: Set to stop capturing.
+    :type stop: threading.Event
+    """
+    interval = 1 / options["fps"]
+    next_capture = time.monotonic()
+    while not stop.is_set():
+        try:
+            image = capture(options)
+        except OSError as err:
+            image = err
+        try:
+            frames.put_nowait(image)
+        except queue.Full:
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            frames.put_nowait(image)
+        if isinstance(image, OSError):
+            return
+        next_capture += interval
+        # don't try to catch up on frames that were missed, just keep the rate from now on
+        next_capture = max(next_capture, time.monotonic())
+        stop.wait(next_capture - time.monotonic())
+
+
+def stream_screen(conn, options):
+    """
+    Push screenshots to the client until it cancels or the frame limit is reached.
+
+    Every frame is a binary frame, the stream ends with a text frame holding the achieved
+    statistics. The client cancels the stream by sending any frame.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param options: The stream options, see screenshot_options().
+    :type options: dict
+
+    :return: 0 if the end of the stream was sent, error code otherwise.
+    :rtype: int
+    """
+    error = None
+    frames = queue.Queue(maxsize=STREAM_QUEUE_LEN)
+    stop = threading.Event()
+    capturer = threading.Thread(target=capture_frames, args=(options, frames, stop), daemon=True)
+    session = {}
+    sent_frames = 0
+    sent_bytes = 0
+    started = time.monotonic()
+    capturer.start()
+    try:
+        while options["frames"] == 0 or sent_frames < options["frames"]:
+            # anything the client sends cancels the stream
+            if conn.pending() or select.select([conn], [], [], 0)[0]:
+                conn.read_frame()
+                break
+            try:
+                image = frames.get(timeout=STREAM_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if isinstance(image, OSError):
+                logging.error(f"os error while trying to stream the screen: {image}")
+                error = image
+                break
+            if options["delta"]:
+                # deltas are made here, against the frames the client actually got
+                data = encode_delta(session, image, options)
+            else:
+                data = encode_image(image, options)
+            conn.write_frame(data)
+            sent_frames += 1
+            sent_bytes += len(data)
+    finally:
+        stop.set()
+        capturer.join()
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    stats = f"STREAM ENDED frames={sent_frames} fps={sent_frames / elapsed:.1f} " \
+            f"bytes/s={sent_bytes / elapsed:.0f} seconds={elapsed:.1f}"
+    if error is not None:
+        stats += f" error={error}"
+    logging.info(stats)
+    return send(conn, stats)
+
+
+def open_part(path):
+    """
+    Open the partial file of a transfer for writing, creating it if needed.
+
+    :param path: The path of the partial file.
+    :type path: str
+
+    :return: The opened file, positioned at its start.
+    :rtype: io.BufferedRandom
+    """
+    return open(path, 'r+b' if os.path.isfile(path) else 'w+b')
+
+
+def download_file(conn, path, offset):
+    """
+    Send a file to the client, starting from `offset` to resume an interrupted download.
+
+    The client first gets 'size offset checksum', with the offset the server actually
+    starts from, and then the bytes from that offset as a single binary frame.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param path: The path of the file to send.
+    :type path: str
+
+    :param offset: The amount of bytes the client already has.
+    :type offset: str
+
+    :return: 0 if successful, error code otherwise.
+    :rtype: int
+    """
+    return_code = 0
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    try:
+        offset = int(offset)
+        file = open(path, 'rb')
+    except ValueError as err:
+        logging.error(f"invalid download offset {offset}: {err}")
+        return 1
+    except OSError as err:
+        logging.error(f"error while trying to download file at {path}: {err}")
+        return err.args[0]
+
+    # errors from here on are communication errors, handle_general takes care of them
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        if not 0 <= offset <= size:
+            # the client has something else, start over
+            offset = 0
+        checksum = hash_file(file).hexdigest()
+        return_code = send(conn, f"{size} {offset} {checksum}")
+        if return_code == 0:
+            logging.info("sending %d bytes of %s from offset %d", size - offset, path, offset)
+            conn.send_file(file, offset, size - offset)
+
+    return return_code
+
+
+def upload_file(conn, path, size, checksum):
+    """
+    Receive a file from the client, resuming a previous upload of it if there is one.
+
+    The server answers with 'OFFSET n', the amount of bytes it already has, and then reads
+    the rest of the file from the client as a single binary frame straight into a partial
+    file. The partial file replaces `path` once its checksum matches.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param path: The path to save the file at.
+    :type path: str
+
+    :param size: The size of the file.
+    :type size: str
+
+    :param checksum: The checksum of the whole file, see protocol.CHECKSUM_ALGORITHM.
+    :type checksum: str
+
+    :return: 0 if successful, error code otherwise, None if the client disconnected.
+    :rtype: int or None
+    """
+    return_code = 0
+    # Ensure the path is using only /
+    path = path.replace("\\", "/")
+    part = path + PART_SUFFIX
+    try:
+        size = int(size)
+        file = open_part(part)
+    except ValueError as err:
+        logging.error(f"invalid upload size {size}: {err}")
+        return 1
+    except OSError as err:
+        logging.error(f"error while trying to upload file to {path}: {err}")
+        return err.args[0]
+
+    with file:
+        offset = os.fstat(file.fileno()).st_size
+        if offset > size:
+            offset = 0
+        file.truncate(offset)
+        # the checksum covers the whole file, including what was received before
+        hasher = hash_file(file, offset)
+        file.seek(offset)
+        if send(conn, f"OFFSET {offset}") != 0:
+            return None
+        frame = conn.read_frame_to(file, hasher)
+
+    if frame is None:
+        logging.warning(f"client disconnected during the upload of {path}, keeping {part}")
+        return_code = None
+    elif frame.frame_type != TYPE_BINARY or offset + frame.data != size:
+        logging.error(f"upload of {path} ended with a wrong amount of data")
+        return_code = 1
+    elif hasher.hexdigest() != checksum.lower():
+        logging.error(f"checksum mismatch in the upload of {path}")
+        os.remove(part)
+        return_code = 1
+    else:
+        try:
+            os.replace(part, path)
+        except OSError as err:
+            logging.error(f"error while trying to upload file to {path}: {err}")
+            return_code = err.args[0]
+
+    return return_code
+
+
+def sync_options(text):
+    """
+    Parse and validate the options of the sync command.
+
+    :param text: The options written after the command name, e.g. 'delete checksum'.
+    :type text: str
+
+    :return: The sync options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown.
+    """
+    options = dict(SYNC_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key not in options or value is not True:
+            raise ValueError(f"unknown option '{key}'")
+        options[key] = True
+    return options
+
+
+def parse_manifest(text):
+    """
+    Parse the manifest the client sends, a line for every file of its directory.
+
+    :param text: Lines of the form '<size> <mtime_ns> <octal mode> <digest or -> <relative path>'.
+    :type text: str
+
+    :return: The relative path, size, modification time, mode and digest of every file.
+    :rtype: list[tuple[str, int, int, int, str or None]]
+
+    :raises ValueError: If a line is malformed or a path leads out of the directory.
+    """
+    manifest = []
+    for line in filter(None, text.split('\n')):
+        fields = line.split(' ', 4)
+        if len(fields) != 5:
+            raise ValueError(f"malformed line '{line}'")
+        size, mtime, mode, digest, path = fields
+        parts = path.split('/')
+        if path.startswith('/') or any(part in ('', '.', '..') or ':' in part for part in parts):
+            raise ValueError(f"invalid path '{path}'")
+        manifest.append((path, int(size), int(mtime), int(mode, 8), None if digest == '-' else digest))
+    return manifest
+
+
+def finish_synced_file(path, mode, mtime):
+    """
+    Give a synced file the mode and modification time of the client's copy, so the next sync
+    sees it is unchanged without reading it.
+    """
+    os.chmod(path, mode)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def receive_synced_file(conn, path, block_size, mode, mtime):
+    """
+    Rebuild a file from the delta frames the client sends, ended by a 'DONE <checksum>' or
+    'SKIP <reason>' text frame.
+
+    The delta is applied to a new file next to the old copy as it streams in, which it replaces
+    only once the checksum of the whole new file matches the client's.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param path: The path of the file.
+    :type path: str
+
+    :param block_size: The block size of the signature the client made the delta from.
+    :type block_size: int
+
+    :param mode: The permission bits of the client's copy.
+    :type mode: int
+
+    :param mtime: The modification time of the client's copy in nanoseconds.
+    :type mtime: int
+
+    :return: The error, None if the file was synced, the literal and matched bytes.
+             None if the client disconnected.
+    :rtype: tuple[str or None, int, int] or None
+    """
+    temp = path + SYNC_SUFFIX
+    hasher = hashlib.new(CHECKSUM_ALGORITHM)
+    error = None
+    basis = output = None
+    try:
+        try:
+            basis = open(path, 'rb')
+        except FileNotFoundError:
+            pass
+        output = open(temp, 'wb')
+    except OSError as err:
+        error = str(err)
+    writer = DeltaWriter(basis, block_size, output, hasher)
+    # after an error the rest of the delta is read and dropped, to stay in step with the client
+    writer.error = error
+    try:
+        while True:
+            frame = conn.read_frame_to(writer)
+            if frame is None:
+                return None
+            if frame.frame_type != TYPE_BINARY:
+                end = frame.data
+                break
+            writer.end_frame()
+    finally:
+        for file in (basis, output):
+            if file is not None:
+                file.close()
+
+    error, literal, matched = writer.error, writer.literal, writer.matched
+    if error is None:
+        if end.startswith("SKIP "):
+            error = end[len("SKIP "):]
+        elif end != f"DONE {hasher.hexdigest()}":
+            error = "checksum mismatch"
+    try:
+        if error is None:
+            os.replace(temp, path)
+            finish_synced_file(path, mode, mtime)
+        elif output is not None:
+            os.remove(temp)
+    except OSError as err:
+        error = str(err)
+    return error, literal, matched
+
+
+def sync_directory(conn, options, dest, manifest):
+    """
+    Bring a directory in line with the client's copy of it, sending only what changed.
+
+    The client sends a manifest of its files along with the path. Files with the same size
+    and modification time, or the same checksum with the checksum option, are left alone. For
+    the others the server sends a signature of its copy, block checksums in the rsync style, and
+    the client answers with a delta made of blocks the server has and literal data. The sync
+    ends with a report of every changed file and a summary.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param options: The sync options, see sync_options().
+    :type options: dict
+
+    :param dest: The path of the directory on the server, created if missing.
+    :type dest: str
+
+    :param manifest: The files of the client's copy, see parse_manifest().
+    :type manifest: str
+
+    :return: 0 if successful, error code otherwise, None if the client disconnected.
+    :rtype: int or None
+    """
+    # Ensure the path is using only /
+    dest = dest.replace("\\", "/")
+    try:
+        manifest = parse_manifest(manifest)
+    except ValueError as err:
+        return send(conn, f"INVALID MANIFEST: {err}")
+    try:
+        os.makedirs(dest, exist_ok=True)
+    except OSError as err:
+        logging.error(f"error while trying to sync directory {dest}: {err}")
+        return send(conn, f"SOMETHING WENT WRONG! ({err})")
+
+    # scanned and stated afresh, a cached listing may miss a file rewritten in place since
+    existing = {}
+    for entry, is_dir in scan_directory(dest, dict(DIR_DEFAULTS, recursive=True, files=True)):
+        path, _, size, mtime = entry_info(entry, is_dir, True)
+        if not path.endswith(SYNC_SUFFIX):
+            existing[os.path.relpath(path, dest).replace("\\", "/")] = (path, size, mtime)
+    digests = {}
+    if options["checksum"]:
+        paths = [path for path, _, _ in existing.values()]
+        # never mapped, the files being synced may be rewritten at the same time
+        hasher = FileHasher(paths, workers=HASH_DEFAULTS["parallel"], cache=hash_cache, mapped=False)
+        digests = {result.path: result.digest for result in hasher.run() if result.error is None}
+
+    changed = []
+    unchanged = set()
+    for index, (rel, size, mtime, mode, digest) in enumerate(manifest):
+        have = existing.get(rel)
+        if have is not None and options["checksum"]:
+            same = digests.get(have[0]) == digest
+        else:
+            same = have is not None and have[1] == size and abs(have[2] - mtime / 1e9) <= SYNC_MTIME_WINDOW
+        if same:
+            unchanged.add(rel)
+            if options["checksum"] and abs(have[2] - mtime / 1e9) > SYNC_MTIME_WINDOW:
+                # the content is the same, keep the time too so the next sync can skip the checksum
+                try:
+                    finish_synced_file(have[0], mode, mtime)
+                except OSError as err:
+                    logging.warning(f"error while trying to sync file {have[0]}: {err}")
+        else:
+            changed.append(index)
+
+    # files that stay as they are can be copied on the server instead of being sent
+    wanted = {entry[0] for entry in manifest}
+    by_digest = {digests[path]: path for rel, (path, _, _) in existing.items()
+                 if path in digests and (rel in unchanged or rel not in wanted)}
+    report = []
+    needed = []
+    copied = 0
+    for index in changed:
+        rel, size, mtime, mode, digest = manifest[index]
+        target = os.path.join(dest, *rel.split('/'))
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        except OSError as err:
+            report.append(f"FAILED {rel}: {err}")
+            continue
+        source = by_digest.get(digest)
+        if source is not None and copy_file(source, target) == 0:
+            try:
+                finish_synced_file(target, mode, mtime)
+                copied += 1
+                report.append(f"COPIED {rel} from {os.path.relpath(source, dest)}")
+                continue
+            except OSError as err:
+                logging.warning(f"error while trying to sync file {target}: {err}")
+        needed.append(index)
+
+    block_sizes = []
+    for index in needed:
+        target = os.path.join(dest, *manifest[index][0].split('/'))
+        try:
+            with open(target, 'rb') as basis:
+                signature = file_signature(basis, os.fstat(basis.fileno()).st_size, index)
+        except OSError:
+            # there is no old copy to take blocks from, the client sends the whole file
+            signature = file_signature(None, 0, index)
+        if send(conn, encode_signature(signature)) != 0:
+            return None
+        block_sizes.append(signature.block_size)
+    return_code = send(conn, f"END OF PLAN: {len(needed)} files to send, {len(unchanged)} unchanged, "
+                             f"{copied} copied on the server")
+    if return_code != 0:
+        return None
+
+    literal = matched = failed = sent = 0
+    for index, length in zip(needed, block_sizes):
+        rel, size, mtime, mode, digest = manifest[index]
+        created = rel not in existing
+        result = receive_synced_file(conn, os.path.join(dest, *rel.split('/')), length, mode, mtime)
+        if result is None:
+            logging.warning(f"client disconnected during the sync of {dest}")
+            return None
+        error, file_literal, file_matched = result
+        literal += file_literal
+        matched += file_matched
+        if error is not None:
+            logging.error(f"error while trying to sync file {rel} in {dest}: {error}")
+            failed += 1
+            report.append(f"FAILED {rel}: {error}")
+        else:
+            sent += 1
+            report.append(f"{'CREATED' if created else 'UPDATED'} {rel}: {file_literal} literal bytes, "
+                          f"{file_matched} matched bytes")
+
+    deleted = 0
+    if options["delete"]:
+        for rel, (path, _, _) in existing.items():
+            if rel in wanted:
+                continue
+            try:
+                os.remove(path)
+                deleted += 1
+                report.append(f"DELETED {rel}")
+            except OSError as err:
+                failed += 1
+                report.append(f"FAILED {rel}: {err}")
+
+    for start in range(0, len(report), SYNC_PAGE):
+        return_code = send(conn, '\n'.join(report[start:start + SYNC_PAGE]), partial=True)
+        if return_code != 0:
+            return return_code
+    return send(conn, f"END OF SYNC: {len(manifest)} files, {sent} sent, {copied} copied on the server, "
+                      f"{len(unchanged)} unchanged, {deleted} deleted, {failed} failed, "
+                      f"{literal} literal bytes, {matched} matched bytes")
+
+
+def batch_options(text):
+    """
+    Parse and validate the options of the batch command.
+
+    :param text: The options written after the command name, e.g. 'parallel=8'.
+    :type text: str
+
+    :return: The batch options, missing options get the server defaults.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown or has an invalid value.
     """
-    Get the list of files in the specified directory.
+    options = dict(BATCH_DEFAULTS)
+    for key, value in parse_options(text).items():
+        if key != "parallel":
+            raise ValueError(f"unknown option '{key}'")
+        value = int(value) if value is not True else 0
+        if not 1 <= value <= MAX_BATCH_PARALLEL:
+            raise ValueError(f"parallel must be between 1 and {MAX_BATCH_PARALLEL}")
+        options[key] = value
+    return options
 
-    :param path: The path of the directory.
-    :type path: str
 
-    :return: A list of file paths in the directory.
-    :rtype: list
+def parse_batch(items):
     """
-    # Ensure the path is in a valid format for glob search
-    path = path.replace("/", "\\")
-    files = glob.glob(rf"{path}/*.*", recursive=False)
+    Split the arguments of a batch request into operations.
 
-    # Change format back to /
-    files = list(map(lambda x: x.replace("\\", "/"), files))
+    Every operation is its command, with options for DIR, followed by its paths,
+    e.g. ['DELETE', 'a.txt', 'COPY', 'b.txt', 'c.txt', 'DIR recursive', 'logs'].
 
-    # Set the return value and log warning if no files were found
-    str1 = str(files) if len(files) > 0 else logging.warning(f"no files found at path: '{path}'") or NO_PATH_ERROR
-    return str1
+    :param items: The arguments sent after the batch command.
+    :type items: list[str]
 
+    :return: The command name, the options and the paths of every operation.
+    :rtype: list[tuple[str, dict or None, list[str]]]
 
-def delete_file(path):
+    :raises ValueError: If an operation is unknown, has invalid options or misses paths.
     """
-    Delete a file at the specified path.
+    operations = []
+    position = 0
+    while position < len(items):
+        name, options = split_command(items[position], BATCH_OPERATIONS)
+        if name not in BATCH_OPERATIONS:
+            raise ValueError(f"unknown operation '{name}' at argument {position + 1}")
+        if name == "DIR":
+            options = dir_options(options)
+        elif options:
+            raise ValueError(f"{name} takes no options")
+        else:
+            options = None
+        count = registry.get(name).args
+        paths = items[position + 1:position + 1 + count]
+        if len(paths) != count:
+            raise ValueError(f"{name} at argument {position + 1} needs {count} paths")
+        operations.append((name, options, paths))
+        position += 1 + len(paths)
+    if not operations:
+        raise ValueError("no operations")
+    return operations
 
-    :param path: The path of the file to be deleted.
-    :type path: str
 
-    :return: 0 if successful, error code otherwise.
-    :rtype: int
+def run_operation(name, options, paths):
     """
-    return_code = 0
-    # Ensure the path is using only /
-    path = path.replace("\\", "/")
-    try:
-        os.remove(path)
-        # Signal removal as successful
-    except OSError as err:
-        logging.error(f"error while trying to delete file at {path}: {err}")
-        # Return error code
-        return_code = err.args[0]
+    Run a single operation of a batch.
 
-    return return_code
+    :param name: The command name.
+    :type name: str
 
+    :param options: The dir options for DIR, None otherwise.
+    :type options: dict or None
 
-def copy_file(src, dest):
+    :param paths: The paths the command takes.
+    :type paths: list[str]
+
+    :return: Whether the operation succeeded and the result to send the client.
+    :rtype: tuple[bool, str]
     """
-    Copy a file from source to destination.
+    if name == "DIR":
+        listing = get_file_list(paths[0], options)
+        return listing != NO_PATH_ERROR, listing
+    if name == "DELETE":
+        return_code, message = delete_file(*paths), "FILE DELETED"
+    else:
+        return_code, message = copy_file(*paths), "FILE COPY"
+    if return_code != 0:
+        return False, f"SOMETHING WENT WRONG! ({return_code})"
+    return True, message
 
-    :param src: The source path of the file.
-    :type src: str
 
-    :param dest: The destination path for the copied file.
-    :type dest: str
+def run_batch(conn, operations, options):
+    """
+    Run the operations of a batch and send the result of each one as soon as it is done.
+
+    Every result is a partial frame starting with the position of its operation in the batch,
+    since parallel operations finish out of order. The batch ends with a text frame counting
+    the failed operations.
+
+    :param conn: The client connection, must use protocol v2.
+    :type conn: protocol.FramedConnection
+
+    :param operations: The operations, see parse_batch().
+    :type operations: list[tuple[str, dict or None, list[str]]]
+
+    :param options: The batch options, see batch_options().
+    :type options: dict
 
     :return: 0 if successful, error code otherwise.
     :rtype: int
     """
-    return_code = 0
-    # Ensure the paths are using only /
-    src = src.replace("\\", "/")
-    dest = dest.replace("\\", "/")
-    try:
-        shutil.copy(src, dest)
-        # Signal copy as successful
-    except OSError as err:
-        logging.error(f"error while trying to copy file from {src} to {dest}: {err}")
-        # Return error code
-        return_code = err.args[0]
+    failed = 0
+    # the operations run on their own pool, the connection workers may all be busy with batches
+    with ThreadPoolExecutor(max_workers=options["parallel"], thread_name_prefix="batch") as pool:
+        futures = {pool.submit(run_operation, *operation): index
+                   for index, operation in enumerate(operations, start=1)}
+        for future in as_completed(futures):
+            index = futures[future]
+            name = operations[index - 1][0]
+            try:
+                succeeded, result = future.result()
+            except Exception as err:
+                logging.exception(f"unexpected error in operation {index} of a batch: {err}")
+                succeeded, result = False, "SOMETHING WENT WRONG!"
+            failed += not succeeded
+            separator = "\n" if name == "DIR" and succeeded else " "
+            return_code = send(conn, f"{index} {name}:{separator}{result}", partial=True)
+            if return_code != 0:
+                for pending in futures:
+                    pending.cancel()
+                return return_code
 
-    return return_code
+    return send(conn, f"END OF BATCH: {len(operations)} operations, {failed} failed")
 
 
-def execute_program(path):
+def collect_server_metrics(registry):
     """
-    Execute a program at the specified path.
+    Update the gauges read from the cache and the jobs, called whenever the metrics are rendered.
 
-    :param path: The path of the program to be executed.
-    :type path: str
+    :param registry: The server metrics.
+    :type registry: metrics.Metrics
+    """
+    registry.set_gauge("dir_cache_listings", len(listing_cache.listings))
+    registry.set_gauge("dir_cache_bytes", listing_cache.size)
+    registry.set_gauge("dir_cache_hits", listing_cache.hits)
+    registry.set_gauge("dir_cache_misses", listing_cache.misses)
+    registry.set_gauge("jobs_running", job_manager.running)
+    registry.set_gauge("hash_cache_hits", hash_cache.hits)
+    registry.set_gauge("hash_cache_misses", hash_cache.misses)
 
-    :return: 0 if successful, error code otherwise.
-    :rtype: int
+
+metrics.add_collector(collect_server_metrics)
+
+
+def stats_options(text):
     """
-    return_code = 0
-    # Ensure the path is using only /
-    path = path.replace("\\", "/")
-    try:
-        subprocess.call(path)
-    except OSError as err:
-        logging.error(f"os error while trying to execute program at {path}: {err}")
-        return_code = err.args[0]
-    except subprocess.CalledProcessError as err:
-        logging.error(f"program error while trying to execute program at {path}: {err}")
-        return_code = err.args[0]
+    Parse and validate the options of the stats command.
 
-    return return_code
+    :param text: The options written after the command name, e.g. 'prometheus'.
+    :type text: str
+
+    :return: The stats options.
+    :rtype: dict
+
+    :raises ValueError: If an option is unknown.
+    """
+    options = {"prometheus": False}
+    for key, value in parse_options(text).items():
+        if key != "prometheus" or value is not True:
+            raise ValueError(f"unknown option '{key}'")
+        options[key] = True
+    return options
+
+
+def server_stats(options):
+    """
+    Describe what the server did since it started.
+
+    :param options: The stats options, see stats_options().
+    :type options: dict
+
+    :return: A summary with a line per command, handler and error code,
+             or every metric in the Prometheus text format.
+    :rtype: str
+    """
+    # a prefork worker answers with the metrics of every worker, as merged by the supervisor
+    stats = metrics if worker_link is None or worker_link.cluster is None else worker_link.cluster
+    if options["prometheus"]:
+        return stats.render_prometheus()
+    stats.collect()
+    uptime = time.time() - stats.started
+    lines = [f"UPTIME {uptime:.0f}s, {stats.gauge_value('connections')} CONNECTIONS, "
+             f"{stats.gauge_value('requests_in_flight')} REQUESTS IN FLIGHT, "
+             f"{stats.gauge_value('jobs_running')} JOBS RUNNING, DIR CACHE "
+             f"{stats.gauge_value('dir_cache_hits')} HITS {stats.gauge_value('dir_cache_misses')} MISSES"]
+    lines.append("COMMANDS:")
+    lines.extend(stats.render_summary("command_seconds", "command"))
+    lines.append("HANDLERS:")
+    lines.extend(stats.render_summary("handler_seconds", "handler"))
+    lines.append("FRAMES:")
+    lines.extend(stats.render_summary("receive_seconds", "protocol"))
+    errors = [f"{labels['handler']} code={labels['code']} count={value}"
+              for labels, value in stats.counter_values("handler_errors_total")]
+    errors.extend(f"receive {labels['reason']} count={value}"
+                  for labels, value in stats.counter_values("receive_errors_total"))
+    lines.append("ERRORS:" if errors else "ERRORS: none")
+    lines.extend(errors)
+    return '\n'.join(lines)
 
 
-def screenshot():
+def set_log_level(conn, text):
     """
-    Capture a screenshot of all screens and save it as 'screenshot.jpg'.
+    Change the level of the server log while it runs.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param text: The new level, e.g. 'debug', empty to only get the current level.
+    :type text: str
 
     :return: 0 if successful, error code otherwise.
     :rtype: int
     """
-    return_value = None
-    try:
-        ImageGrab.grab(all_screens=True).save('screenshot.jpg')
-        # call function to read photo
-        base64_bytes = b''
-        with open('screenshot.jpg', 'rb') as img:
-            base64_bytes = base64.b64encode(img.read()).decode('utf-8')
-        return base64_bytes
-    except OSError as err:
-        logging.error(f"os error while trying to take a screenshot: {err}")
-        # Return error code
-        return_value = None
+    root = logging.getLogger()
+    if text:
+        try:
+            level = parse_level(text)
+        except ValueError as err:
+            return send(conn, f"INVALID LEVEL: {err}")
+        logging.warning(f"log level changed to {logging.getLevelName(level)} by a client")
+        root.setLevel(level)
+        if worker_link is not None:
+            # the other workers and the supervisor follow
+            worker_link.set_level(level)
+    return send(conn, f"LOG LEVEL {logging.getLevelName(root.level)}")
 
-    return return_value
+
+def handler_name(func):
+    """
+    :param func: A command handler, possibly wrapped by functools.partial.
+    :type func: callable
+
+    :return: The name of the function behind the handler, e.g. 'delete_file'.
+    :rtype: str
+    """
+    while isinstance(func, partial):
+        func = func.func
+    return getattr(func, '__name__', str(func))
 
 
-def send(comm, data, args=0):
+def send(comm, data, args=0, partial=False):
     """
     Send data over a communication channel.
 
     :param args: number of arguments the server expects in the next request
     :type args: int
 
+    :param partial: the data is one part of a response that continues in the next frames,
+                    requires protocol v2
+    :type partial: bool
+
     :param comm: The communication channel.
-    :type comm: socket.socket
+    :type comm: protocol.FramedConnection
 
-    :param data: The data to be sent.
-    :type data: str
+    :param data: The data to be sent, binary data requires protocol v2.
+    :type data: str or list[str] or bytes
 
     :return: 0 if successful, error code otherwise.
     :rtype: int
     """
-    logging.info(f"trying to send{data}")
+    logging.debug("sending %s", Payload(data), extra=SAMPLED)
     return_code = 0
-    data_len = len(data)
-    # Include type information along with the data length and actual data
-    to_send = str(args) + '$' + str(data_len) + '$' + data
-    sent = 0
-    logging.info("sending data...")
+    if data is None:
+        logging.error("there is no data to send to client!")
+        return 1
+
+    if not isinstance(data, (str, list)) and comm.version == PROTOCOL_V1:
+        # legacy clients can only receive text, give them base64 like they always got
+        data = base64.b64encode(data).decode()
     try:
-        while sent < len(to_send):
-            sent += comm.send(to_send[sent:].encode())
-        logging.info("data sent successfully")
+        comm.write_frame(data, args, partial=partial)
+        logging.debug("data sent successfully", extra=SAMPLED)
+
+    except ValueError as err:
+        logging.error(f"can't send data to client!: {err}")
+        return_code = 1
+
+    except socket.timeout:
+        logging.error("the client stopped reading, sending timed out")
+        return_code = errno.ETIMEDOUT
 
     except socket.error as err:
         logging.error(f"error while trying to send data to client!: {err}")
@@ -191,88 +1860,91 @@ def receive(comm):
     Receive data over a communication channel.
 
     :param comm: The communication channel.
-    :type comm: socket.socket
+    :type comm: protocol.FramedConnection
 
-    :return: string of the data from the client if successful, None otherwise.
-    :rtype: str or None
+    :return: the arguments sent by the client if successful, None otherwise.
+    :rtype: list or None
     """
-    data_len_str = ""
-    received_data = ""
-    num_of_args = ""
-    logging.info("starting receiving data...")
-    # Receive num of args
+    received_data = None
+    logging.debug("starting receiving data...", extra=SAMPLED)
+    started = time.perf_counter()
     try:
-        while True:
-            buff = comm.recv(1).decode()
-            if buff == '$':
-                break
-            if buff == '':
-                num_of_args = None
-                break
-            num_of_args += buff
-
-        if num_of_args is not None:
-            num_of_args = int(num_of_args)
-            # Receive length of the data
-            logging.info("receiving data len...")
-            while True:
-                buff = comm.recv(1).decode()
-                if buff == '$':
-                    break
-                if buff == '':
-                    data_len_str = None
-                    break
-                data_len_str += buff
-
-            # Convert the length to an integer
-            if data_len_str is not None:
-                data_len = int(data_len_str)
-
-                # Receive the actual data
-                logging.info("receiving the data...")
-                i = 0
-                while len(received_data) < data_len:
-                    buff = comm.recv(data_len - len(received_data)).decode()
-                    if buff == '':
-                        received_data = None
-                        break
-                    received_data += buff
-                received_data = received_data.split("$")
-                if len(received_data) != max(num_of_args, 1):
-                    logging.warning("server received a different request than expected!")
-                    received_data = None
-                logging.info("received successfully")
-            else:
+        # the arguments are split as they arrive, the payload is never held whole
+        frame = comm.read_args()
+        if frame is not None:
+            metrics.observe("receive_seconds", time.perf_counter() - started, protocol=f"v{frame.version}")
+            num_of_args = frame.num_of_args
+            received_data = frame.data
+            if len(received_data) != max(num_of_args, 1):
+                logging.warning("server received a different request than expected!")
+                metrics.inc("receive_errors_total", reason="argument count")
                 received_data = None
-        else:
-            received_data = None
+            logging.debug("received %s", Payload(received_data), extra=SAMPLED)
+
+    except FrameTooLarge as err:
+        logging.error(f"the client sent a frame larger than the limit!: {err}")
+        metrics.inc("receive_errors_total", reason="too large")
+        received_data = None
+
+    except ValueError as err:
+        logging.error(f"received a malformed frame from client!: {err}")
+        metrics.inc("receive_errors_total", reason="malformed")
+        received_data = None
+
+    except socket.timeout:
+        logging.error("the client stalled, receiving timed out")
+        metrics.inc("receive_errors_total", reason="timeout")
+        received_data = None
 
     except socket.error as err:
         logging.error(f"error while trying to receive data from client!: {err}")
+        metrics.inc("receive_errors_total", reason="socket")
         # Return None for failure
         received_data = None
 
     finally:
-        print(received_data)
         return received_data
 
 
+def call_handler(func, *args):
+    """
+    Run a command handler, timing it and counting the error codes it returns.
+
+    :param func: The handler.
+    :type func: callable
+
+    :return: Whatever the handler returns.
+    """
+    name = handler_name(func)
+    started = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception as err:
+        metrics.inc("handler_errors_total", handler=name, code=type(err).__name__)
+        raise
+    finally:
+        metrics.observe("handler_seconds", time.perf_counter() - started, handler=name)
+    # handlers return 0 or an error code, or their data, and None when they failed without a code
+    if result is None or (type(result) is int and result != 0):
+        metrics.inc("handler_errors_total", handler=name, code=result)
+    return result
+
+
 # def assert user response
 
 def handle_general(comm, message, num_of_args, return_data, func):
     return_code = 0
     try:
         if num_of_args != 0 and message is not None:
-            logging.debug(f"sending message to client: {message}")
+            logging.debug("sending message to client: %s", message)
             return_code = send(comm, message, num_of_args)
             if return_code == 0:
-                logging.info("receiving response from client...")
+                logging.debug("receiving response from client...")
                 res = receive(comm)
                 if res is not None:
-                    logging.debug(f"Executing function {func.__name__}() with {num_of_args} args")
+                    logging.debug("Executing function %s() with %d args", handler_name(func), num_of_args)
                     if len(res) == num_of_args:
-                        print(*res[:num_of_args])
-                        data = func(*res[:num_of_args])
+                        data = call_handler(func, *res[:num_of_args])
                         if return_data:  # signify if you want to return the function return value
                             return_code = send(comm, data, num_of_args)
                         else:
@@ -281,7 +1953,7 @@ def handle_general(comm, message, num_of_args, return_data, func):
                         return_code = 1
 
         elif num_of_args == 0 and message is None:
-            data = func()
+            data = call_handler(func)
             if return_data:
                 return_code = send(comm, data)
             else:
@@ -296,85 +1968,696 @@ def handle_general(comm, message, num_of_args, return_data, func):
     return return_code
 
 
-def main():
+def handle_command(comm, paths, message, num_of_args, return_data, func):
+    """
+    Like handle_general(), but a client that sent the paths inline, in the command frame,
+    isn't asked for them. That saves a round trip and lets clients pipeline requests.
+
+    :param paths: The paths sent in the command frame, empty to ask the client for them.
+    :type paths: list[str]
+    """
+    if paths:
+        return handle_general(comm, None, 0, return_data, partial(func, *paths))
+    return handle_general(comm, message, num_of_args, return_data, func)
+
+
+def answer(conn, r_code, done=None):
+    """
+    Answer the outcome of a command handler, the same way for every command.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param r_code: What the handler returned, 0 if successful, an error code, None if the client is gone.
+    :type r_code: int or None
+
+    :param done: The message sent if the handler succeeded, None if the handler sent its own answer.
+    :type done: str or None
+
+    :return: True if the client should be disconnected, False otherwise.
+    :rtype: bool
+    """
+    if r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0:
+        return True
+    return r_code is None or (r_code == 0 and done is not None and send(conn, done) != 0)
+
+
+def dir_command(conn, options, items):
+    if conn.version == PROTOCOL_V2:
+        # the listing is sent in pages as it is scanned
+        r_code = handle_command(conn, items, "ENTER PATH", 1, False, partial(stream_file_list, conn, options))
+    else:
+        r_code = handle_command(conn, items, "ENTER PATH", 1, True, partial(get_file_list, options=options))
+    return answer(conn, r_code)
+
+
+def delete_command(conn, options, items):
+    return answer(conn, handle_command(conn, items, "ENTER PATH", 1, False, delete_file), "FILE DELETED")
+
+
+def copy_command(conn, options, items):
+    return answer(conn, handle_command(conn, items, "ENTER PATHS", 2, False, copy_file), "FILE COPY")
+
+
+def execute_command(conn, options, items):
+    if options["follow"] and conn.version != PROTOCOL_V2:
+        return send(conn, "FOLLOW REQUIRES PROTOCOL V2") != 0
+    return answer(conn, handle_command(conn, items, "ENTER PATH", 1, False, partial(execute_program, conn, options)))
+
+
+def job_command(name, conn, text, items):
+    return handle_job(conn, name, text) != 0
+
+
+def screenshot_command(conn, options, items):
+    if options["delta"] and conn.version == PROTOCOL_V2:
+        func = partial(delta_screenshot, conn.session, options)
+    else:
+        # legacy clients can't apply deltas, they get the whole image
+        func = partial(screenshot, options)
+    return answer(conn, handle_general(conn, None, 0, True, func))
+
+
+def stream_command(conn, options, items):
+    return stream_screen(conn, options) != 0
+
+
+def download_command(conn, options, items):
+    r_code = handle_command(conn, items, "ENTER PATH AND OFFSET", 2, False, partial(download_file, conn))
+    return answer(conn, r_code, "FILE DOWNLOADED")
+
+
+def upload_command(conn, options, items):
+    r_code = handle_command(conn, items, "ENTER PATH, SIZE AND CHECKSUM", 3, False, partial(upload_file, conn))
+    return answer(conn, r_code, "FILE UPLOADED")
+
+
+def bulk_copy_command(conn, options, items):
+    if not items or len(items) % 2:
+        return send(conn, "BULK COPY TAKES PAIRS OF SOURCE AND DESTINATION PATHS") != 0
+    return bulk_copy(conn, items, options) != 0
+
+
+def hash_command(conn, options, items):
+    return answer(conn, handle_command(conn, items, "ENTER PATH", 1, False, partial(hash_files, conn, options)))
+
+
+def sync_command(conn, options, items):
+    r_code = handle_command(conn, items, "ENTER PATH AND MANIFEST", 2, False, partial(sync_directory, conn, options))
+    return answer(conn, r_code)
+
+
+def batch_command(conn, options, items):
+    try:
+        operations = parse_batch(items)
+    except ValueError as err:
+        return send(conn, f"INVALID BATCH: {err}") != 0
+    return run_batch(conn, operations, options) != 0
+
+
+def stats_command(conn, options, items):
+    return send(conn, server_stats(options)) != 0
+
+
+def log_level_command(conn, text, items):
+    return set_log_level(conn, text) != 0
+
+
+def stop_command(conn, options, items):
+    # the client cancelled a stream that had already ended, there is nothing to answer
+    logging.debug("received a stop for a stream that already ended")
+    return False
+
+
+def negotiate_command(conn, options, items):
+    # confirm in the legacy format the client still expects, then switch
+    disconnect = send(conn, NEGOTIATE_COMMAND) != 0
+    conn.version = PROTOCOL_V2
+    return disconnect
+
+
+def compress_command(conn, compression, items):
+    # answer with the settings in use before switching, the client reads the answer first
+    answer_text = compression.describe() if compression is not None else "none"
+    disconnect = send(conn, f"{COMPRESS_COMMAND} {answer_text}") != 0
+    conn.compression = compression
+    return disconnect
+
+
+def ping_command(conn, options, items):
+    return send(conn, PONG_ANSWER) != 0
+
+
+def exit_command(conn, options, items):
+    # send disconnect message
+    send(conn, "GOODBYE")
+    return True
+
+
+# the commands of the server, plugins add theirs with registry.add()
+registry = CommandRegistry([
+    Command("DIR", dir_command, dir_options, args=1, streams=True),
+    Command("DELETE", delete_command, args=1),
+    Command("COPY", copy_command, args=2, blocking=True),
+    Command("BULK COPY", bulk_copy_command, bulk_copy_options, args=ANY_ARGS, v2=True, blocking=True, streams=True),
+    Command("EXECUTE", execute_command, execute_options, args=1, blocking=True, streams=True),
+    Command("JOB STATUS", partial(job_command, "JOB STATUS"), str),
+    Command("JOB OUTPUT", partial(job_command, "JOB OUTPUT"), str, blocking=True, streams=True),
+    Command("JOB KILL", partial(job_command, "JOB KILL"), str),
+    Command("TAKE SCREENSHOT", screenshot_command, screenshot_options, blocking=True),
+    Command("STREAM SCREEN", stream_command, partial(screenshot_options, defaults=STREAM_DEFAULTS), v2=True,
+            blocking=True, streams=True),
+    Command(STOP_STREAM_COMMAND, stop_command),
+    Command("DOWNLOAD", download_command, args=2, v2=True, blocking=True, streams=True),
+    Command("UPLOAD", upload_command, args=3, v2=True, blocking=True, streams=True),
+    Command("BATCH", batch_command, batch_options, args=ANY_ARGS, v2=True, blocking=True, streams=True),
+    Command("HASH", hash_command, hash_options, args=ANY_ARGS, blocking=True, streams=True),
+    Command("SYNC", sync_command, sync_options, args=2, v2=True, blocking=True, streams=True),
+    Command("STATS", stats_command, stats_options),
+    Command("LOG LEVEL", log_level_command, str),
+    Command(PING_COMMAND, ping_command),
+    Command("EXIT", exit_command),
+    Command(NEGOTIATE_COMMAND, negotiate_command),
+    Command(COMPRESS_COMMAND, compress_command, Compression.parse, v2=True),
+])
+
+
+def handle_request(conn, offload=None):
+    """
+    Receive a single request from a client and execute it.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param offload: Called with the rest of the request, a function returning whether the client
+                    should be disconnected, to run blocking commands on another thread.
+                    None runs every command on this thread.
+    :type offload: callable or None
+
+    :return: True if the client should be disconnected, False otherwise, None if the request was offloaded.
+    :rtype: bool or None
+    """
+    started = time.perf_counter()
+    counted = (conn.bytes_received, conn.bytes_sent)
+    req = receive(conn)
+    if req is None:
+        logging.error("client hasn't responded!")
+        return True
+    name, options = registry.route(req[0])
+    command = registry.get(name)
+    # arguments sent along with the command in the same frame
+    run = partial(execute_request, conn, command, name, options, req[1:], started, counted)
+    if offload is not None and command is not None and command.blocking:
+        offload(run)
+        return None
+    return run()
+
+
+def execute_request(conn, command, name, options, items, started, counted):
+    """
+    Validate a request and run the handler of its command.
+
+    :param conn: The client connection.
+    :type conn: protocol.FramedConnection
+
+    :param command: The command, None if there is no command by that name.
+    :type command: registry.Command or None
+
+    :param name: The command name the client sent.
+    :type name: str
+
+    :param options: The options written after the name.
+    :type options: str
+
+    :param items: The arguments sent in the command frame.
+    :type items: list[str]
+
+    :param started: When the request started, by time.perf_counter().
+    :type started: float
+
+    :param counted: The bytes received and sent on the connection before the request.
+    :type counted: tuple[int, int]
+
+    :return: True if the client should be disconnected, False otherwise.
+    :rtype: bool
+    """
+    logging.debug("user input: %s %s %s", name, options, Payload(items))
+    if command is None:
+        logging.warning(f"unknown command: {name}")
+        disconnect = send(conn, "UNKNOWN COMMAND") != 0
+        label = UNKNOWN_COMMAND_LABEL
+    else:
+        label = command.name
+        if command.streams:
+            metrics.add_gauge("streams_in_flight", 1)
+        try:
+            try:
+                options = command.prepare(options, items, conn.version)
+            except ValueError as err:
+                disconnect = send(conn, str(err)) != 0
+            else:
+                disconnect = command.handler(conn, options, items)
+        finally:
+            if command.streams:
+                metrics.add_gauge("streams_in_flight", -1)
+
+    metrics.observe("command_seconds", time.perf_counter() - started, command=label)
+    metrics.inc("bytes_received_total", conn.bytes_received - counted[0], command=label)
+    metrics.inc("bytes_sent_total", conn.bytes_sent - counted[1], command=label)
+    if disconnect:
+        metrics.inc("disconnects_total", command=label)
+    return disconnect
+
+
+class ConnectionLoop:
+    """
+    Selector based event loop that serves many clients at once.
+
+    The loop thread only accepts connections and waits for idle clients to become readable.
+    Once a client sends a request its socket is taken out of the selector and the request is
+    executed on a bounded worker pool, so slow commands never stall the other clients. Commands
+    marked blocking in the registry are handed on to a second pool, so they can't take every
+    worker from the quick ones.
+
+    Every socket gets read and write deadlines, and clients that stay idle in the selector longer
+    than the idle timeout are dropped, so stuck or vanished peers don't keep their slot.
+    """
+
+    def __init__(self, serv, max_connections=MAX_CONNECTIONS, max_workers=MAX_WORKERS,
+                 max_blocking=MAX_BLOCKING_WORKERS, io_timeout=IO_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 max_frame=MAX_FRAME):
+        """
+        :param serv: A bound and listening server socket.
+        :type serv: socket.socket
+
+        :param max_connections: The maximum number of clients connected at the same time.
+        :type max_connections: int
+
+        :param max_workers: The number of requests executed at the same time.
+        :type max_workers: int
+
+        :param max_blocking: The number of blocking commands executed at the same time.
+        :type max_blocking: int
+
+        :param io_timeout: The seconds a client socket may make no progress in the middle of a frame,
+                           None to wait forever.
+        :type io_timeout: float or None
+
+        :param idle_timeout: The seconds a client may stay silent between frames, None to wait forever.
+        :type idle_timeout: float or None
+
+        :param max_frame: The largest frame a client may send to be read into memory, None for no limit.
+        :type max_frame: int or None
+        """
+        self.serv = serv
+        self.io_timeout = io_timeout
+        self.idle_timeout = idle_timeout
+        self.max_frame = max_frame
+        self.max_connections = max_connections
+        self.selector = selectors.DefaultSelector()
+        self.workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker")
+        self.blocking = ThreadPoolExecutor(max_workers=max_blocking, thread_name_prefix="blocking")
+        self.connections = set()
+        # when every socket waiting in the selector started waiting, oldest first
+        self.idle_since = {}
+        self.last_reap = time.monotonic()
+        # sockets handed back by the workers, the loop thread is the only one touching the selector
+        self.returned = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.running = False
+
+    def run(self):
+        """
+        Run the loop until stop() is called.
+        """
+        self.serv.setblocking(False)
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.serv, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.running = True
+        try:
+            while self.running:
+                for key, _ in self.selector.select(SELECT_TIMEOUT):
+                    if key.fileobj is self.serv:
+                        self.accept()
+                    elif key.fileobj is self.wakeup_recv:
+                        self.collect_returned()
+                    else:
+                        # the client sent a request, let a worker handle it
+                        self.selector.unregister(key.fileobj)
+                        self.idle_since.pop(key.fileobj, None)
+                        self.workers.submit(self.work, key.fileobj)
+                self.reap_idle()
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Ask the loop to stop, safe to call from any thread.
+        """
+        self.running = False
+        self.wake()
+
+    def wake(self):
+        """
+        Interrupt the selector of the loop thread.
+        """
+        try:
+            self.wakeup_send.send(b'\0')
+        except socket.error:
+            pass
+
+    def accept(self):
+        """
+        Accept a pending connection, refuse it if the server is full.
+        """
+        try:
+            conn, addr = self.serv.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(True)
+        tune_socket(conn)
+        conn = FramedConnection(conn, max_frame=self.max_frame)
+        conn.set_deadlines(self.io_timeout, self.idle_timeout)
+        if len(self.connections) >= self.max_connections:
+            logging.warning(f"refusing connection from {addr}: server is full")
+            metrics.inc("connections_refused_total")
+            send(conn, BUSY_MESSAGE)
+            conn.close()
+            return
+        logging.info(f"connection established with {addr}")
+        self.connections.add(conn)
+        metrics.inc("connections_accepted_total")
+        metrics.set_gauge("connections", len(self.connections))
+        self.wait_for_request(conn)
+
+    def wait_for_request(self, conn):
+        """
+        Put a client socket in the selector until it sends its next request.
+        """
+        self.selector.register(conn, selectors.EVENT_READ)
+        self.idle_since[conn] = time.monotonic()
+
+    def reap_idle(self):
+        """
+        Drop the clients that have been idle longer than the idle timeout, checked once a second.
+        """
+        now = time.monotonic()
+        if self.idle_timeout is None or now - self.last_reap < SELECT_TIMEOUT:
+            return
+        self.last_reap = now
+        expired = []
+        # the sockets are kept in the order they started waiting, so the first fresh one ends the search
+        for conn, since in self.idle_since.items():
+            if now - since <= self.idle_timeout:
+                break
+            expired.append(conn)
+        for conn in expired:
+            logging.info("dropping a client that was idle for %d seconds", now - self.idle_since.pop(conn))
+            metrics.inc("idle_disconnects_total")
+            self.selector.unregister(conn)
+            self.disconnect(conn)
+
+    def work(self, conn):
+        """
+        Handle one request of a client on a worker thread and return the socket to the loop.
+
+        :param conn: The client connection.
+        :type conn: protocol.FramedConnection
+        """
+        self.serve(conn, partial(handle_request, conn, partial(self.offload, conn)))
+
+    def offload(self, conn, run):
+        """
+        Run the rest of a request for a blocking command on the blocking pool, which returns the socket.
+        """
+        self.blocking.submit(self.serve, conn, run)
+
+    def serve(self, conn, run):
+        """
+        Run a request and return the socket to the loop, unless the request was offloaded.
+
+        :param conn: The client connection.
+        :type conn: protocol.FramedConnection
+
+        :param run: Runs the request, returns whether to disconnect the client or None if it was offloaded.
+        :type run: callable
+        """
+        disconnect = True
+        metrics.add_gauge("requests_in_flight", 1)
+        try:
+            disconnect = run()
+        except socket.error as err:
+            logging.error(f"error in communication with client: {err}")
+        except Exception as err:
+            logging.exception(f"unexpected error while handling client request: {err}")
+        finally:
+            metrics.add_gauge("requests_in_flight", -1)
+            if disconnect is not None:
+                self.returned.put((conn, disconnect))
+                self.wake()
+
+    def collect_returned(self):
+        """
+        Register the sockets returned by the workers again or close them.
+        """
+        try:
+            while self.wakeup_recv.recv(MAX_PACKET):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.returned.empty():
+            conn, disconnect = self.returned.get()
+            if disconnect or not self.running:
+                self.disconnect(conn)
+            elif conn.pending():
+                # the client already sent its next request, the selector won't report it
+                self.workers.submit(self.work, conn)
+            else:
+                self.wait_for_request(conn)
+
+    def disconnect(self, conn):
+        """
+        Close a client socket.
+
+        :param conn: The client connection.
+        :type conn: protocol.FramedConnection
+        """
+        logging.info("disconnecting client socket")
+        self.connections.discard(conn)
+        metrics.set_gauge("connections", len(self.connections))
+        conn.close()
+        logging.info("terminated connection with client socket")
+
+    def close(self):
+        """
+        Close every client and release the loop resources.
+        """
+        # workers stuck on a client are released by closing its socket below
+        self.workers.shutdown(wait=False, cancel_futures=True)
+        self.blocking.shutdown(wait=False, cancel_futures=True)
+        self.collect_returned()
+        for conn in list(self.connections):
+            try:
+                self.selector.unregister(conn)
+            except (KeyError, ValueError):
+                pass
+            self.disconnect(conn)
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+
+def main(backlog=Q_LEN, max_connections=MAX_CONNECTIONS, max_workers=MAX_WORKERS,
+         max_blocking=MAX_BLOCKING_WORKERS, io_timeout=IO_TIMEOUT, idle_timeout=IDLE_TIMEOUT, max_frame=MAX_FRAME,
+         link=None):
     """
     the main function; responsible for running the server code
+
+    :param backlog: The size of the listen queue.
+    :type backlog: int
+
+    :param max_connections: The maximum number of clients connected at the same time.
+    :type max_connections: int
+
+    :param max_workers: The number of requests executed at the same time.
+    :type max_workers: int
+
+    :param max_blocking: The number of blocking commands executed at the same time.
+    :type max_blocking: int
+
+    :param io_timeout: The seconds a client socket may make no progress in the middle of a frame.
+    :type io_timeout: float or None
+
+    :param idle_timeout: The seconds a client may stay silent between frames.
+    :type idle_timeout: float or None
+
+    :param max_frame: The largest frame a client may send to be read into memory.
+    :type max_frame: int or None
+
+    :param link: The link to the supervisor when running as a prefork worker, the port is then
+                 shared with the other workers.
+    :type link: prefork.WorkerLink or None
+
+    :return: True if the server listened, False if the server socket couldn't be opened.
+    :rtype: bool
     """
-    # define an ipv4 tcp socket and listen for an incoming connection
+    # define an ipv4 tcp socket and listen for incoming connections
     serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening = False
     try:
+        serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if link is not None:
+            # every worker listens on the port and the kernel spreads the connections between them
+            serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         serv.bind((LISTEN_IP, LISTEN_PORT))
-        serv.listen(Q_LEN)
+        serv.listen(backlog)
+        listening = True
         logging.debug(f"server is listening on port {LISTEN_PORT}")
-        while True:
-            # accept connection
-            logging.info("waiting for connection...")
-            conn, addr = serv.accept()
-            logging.info("connection established")
-            disconnect = False
-            try:
-                while not disconnect:
-                    req = receive(conn)
-                    if req is not None:
-                        req = ''.join(req).upper()
-                        logging.debug(f"user input: {req}")
-                        if req == "DIR":
-                            r_code = handle_general(conn, "ENTER PATH", 1, True, get_file_list)
-                            if (r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0) or r_code is None:
-                                disconnect = True
-                        elif req == "DELETE":
-                            print("what?")
-                            r_code = handle_general(conn, "ENTER PATH", 1, False, delete_file)
-                            if (r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0) \
-                                    or (r_code is None or (r_code == 0 and send(conn, "FILE DELETED") != 0)):
-                                disconnect = True
-
-                        elif req == "COPY":
-                            r_code = handle_general(conn, "ENTER PATHS", 2, False, copy_file)
-                            if (r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0) \
-                                    or (r_code is None or (r_code == 0 and send(conn, "FILE COPY") != 0)):
-                                disconnect = True
-                        # handle copy request
-                        elif req == "EXECUTE":
-                            r_code = handle_general(conn, "ENTER PATH", 1, False, execute_program)
-                            if (r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0) \
-                                    or (r_code is None or (r_code == 0 and send(conn, "FILE EXECUTE") != 0)):
-                                disconnect = True
-                        # handle execute request
-                        elif req == "TAKE SCREENSHOT":
-                            r_code = handle_general(conn, None, 0, True, screenshot)
-                            if r_code != 0 and send(conn, "SOMETHING WENT WRONG!") != 0:
-                                disconnect = True
-                        # handle screenshot request
-                        elif req == "EXIT":
-                            # send disconnect message
-                            send(conn, "GOODBYE")
-                            disconnect = True
-                        else:
-                            logging.warning(f"unknown command: {req}")
-                            if send(conn, "UNKNOWN COMMAND") != 0:
-                                disconnect = True
-                    else:
-                        logging.error("client hasn't responded!")
-                        disconnect = True
-            except socket.error as err:
-                logging.error(f"error in communication with client: {err}")
-            finally:
-                logging.info("disconnecting client socket")
-                conn.close()
-                logging.info("terminated connection with client socket")
+        loop = ConnectionLoop(serv, max_connections, max_workers, max_blocking, io_timeout, idle_timeout, max_frame)
+        if link is not None:
+            link.start(metrics, loop.stop)
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            logging.warning("server stopped using keyboard interrupt")
 
     except socket.error as err:
         logging.error(f"error while opening server socket: {err}")
 
     finally:
         serv.close()
+    return listening
+
+
+def configure(options):
+    """
+    Apply the command line options that shape the commands, in the server or in every prefork worker.
+
+    :param options: The command line options.
+    :type options: argparse.Namespace
+    """
+    job_manager.max_jobs = options.max_jobs
+    if options.fake_screen:
+        set_capture_source(synthetic_capture)
+    for plugin in options.plugin:
+        try:
+            registry.load_plugin(plugin)
+            logging.info(f"loaded the commands of plugin {plugin}")
+        except (ImportError, ValueError) as err:
+            logging.error(f"can't load plugin {plugin}: {err}")
+
+
+def start_server(options, link=None):
+    """
+    Run main() with the command line options.
+
+    :param options: The command line options.
+    :type options: argparse.Namespace
+
+    :param link: The link to the supervisor, see main().
+    :type link: prefork.WorkerLink or None
+
+    :return: True if the server listened, see main().
+    :rtype: bool
+    """
+    return main(options.backlog, options.max_connections, options.workers, options.blocking_workers,
+                options.io_timeout or None, options.idle_timeout or None, options.max_frame * 1024 * 1024 or None, link)
+
+
+def serve_worker(index, link, options):
+    """
+    Serve clients in a worker process of the prefork mode, see prefork.Supervisor.
+
+    Every worker has its own caches, jobs and metrics. A connection stays on the worker that
+    accepted it, but the jobs a client started can't be reached from a connection that landed
+    on another worker.
+
+    :param index: The position of the worker, starting at 0.
+    :type index: int
+
+    :param link: The link to the supervisor.
+    :type link: prefork.WorkerLink
+
+    :param options: The command line options of the server.
+    :type options: argparse.Namespace
+    """
+    global worker_link
+    # ctrl-c reaches every process of the terminal, the supervisor handles it and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handler = log_to_queue(link.log_queue, options.log_level, options.log_sample)
+    metrics.add_collector(lambda registry: registry.set_gauge("log_records_dropped", handler.dropped))
+    worker_link = link
+    configure(options)
+    logging.info(f"worker {index + 1} is serving")
+    if not start_server(options, link):
+        # tell the supervisor the worker couldn't start, rather than that it died while serving
+        sys.exit(EXIT_STARTUP_FAILED)
 
 
 if __name__ == "__main__":
     # make sure we have a logging directory and configure the logging
     if not os.path.isdir(LOG_DIR):
         os.makedirs(LOG_DIR)
-    logging.basicConfig(format=LOG_FORMAT, filename=LOG_FILE, level=LOG_LEVEL)
+    parser = argparse.ArgumentParser(description="A basic commands server")
+    parser.add_argument("--backlog", type=int, default=Q_LEN, help="size of the listen queue")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="maximum number of connected clients")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="number of worker threads")
+    parser.add_argument("--blocking-workers", type=int, default=MAX_BLOCKING_WORKERS,
+                        help="number of threads running blocking commands like copies, hashes and streams")
+    parser.add_argument("--io-timeout", type=float, default=IO_TIMEOUT,
+                        help="seconds a client may stall in the middle of a frame, 0 to wait forever")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a client may stay idle before it is dropped, 0 to keep it forever")
+    parser.add_argument("--max-frame", type=int, default=MAX_FRAME // (1024 * 1024),
+                        help="MiB a request frame may take in memory, 0 for no limit")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port, to use more cores, 1 runs a single process")
+    parser.add_argument("--plugin", action="append", default=[],
+                        help="a module whose register(registry) adds commands, can be given many times")
+    parser.add_argument("--max-jobs", type=int, default=MAX_JOBS,
+                        help="number of programs running at the same time")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve prometheus metrics on this local port, 0 to turn it off")
+    parser.add_argument("--log-level", type=parse_level, default=LOG_LEVEL,
+                        help="debug, info, warning, error or critical, the LOG LEVEL command changes it later")
+    parser.add_argument("--log-sample", type=int, default=LOG_SAMPLE,
+                        help="log one in this many of the records written for every frame")
+    parser.add_argument("--log-queue", type=int, default=LOG_QUEUE_SIZE,
+                        help="records waiting to be written before new ones are dropped")
+    parser.add_argument("--fake-screen", action="store_true", help="capture a generated image instead of the screen")
+    options = parser.parse_args()
+    if options.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--processes needs SO_REUSEPORT, which this system doesn't have")
+    # the workers of the prefork mode log through the queue of the supervisor
+    log_queue = shared_queue(options.log_queue) if options.processes > 1 else None
+    # the log is written on a thread of its own, the workers only queue the records
+    log = AsyncLogging(LOG_FILE, LOG_FORMAT, options.log_level, options.log_queue, options.log_sample, log_queue)
+    log.start()
+    supervisor = None
+    if options.processes > 1:
+        supervisor = Supervisor(serve_worker, options.processes, (options,), log_queue)
+    else:
+        configure(options)
+    # in the prefork mode the supervisor's own metrics are the ones merged with those of the workers
+    (metrics if supervisor is None else supervisor.own).add_collector(
+        lambda registry: registry.set_gauge("log_records_dropped", log.dropped))
+    if options.metrics_port:
+        try:
+            start_exporter(metrics if supervisor is None else supervisor.metrics, options.metrics_port)
+        except OSError as err:
+            logging.error(f"can't serve metrics on port {options.metrics_port}: {err}")
 
-    main()
+    status = 0
+    try:
+        if supervisor is None:
+            status = 0 if start_server(options) else 1
+        else:
+            try:
+                status = supervisor.run()
+            except KeyboardInterrupt:
+                logging.warning("server stopped using keyboard interrupt")
+    finally:
+        log.stop()
+    sys.exit(status)